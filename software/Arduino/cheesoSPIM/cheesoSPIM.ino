@@ -8,6 +8,23 @@ laser TTL on laserPin with PWM power control
 Communicates over serial
 Corresponding Python device driver included with cheesoSPIM_GUI
 
+One line may hold several commands separated by ';'
+A command prefixed with !<token> (eg "!12 M 100") replies "!12" 
+once it has finished, so the host knows when a move is done.
+Batching saves serial round-trips only. Moves run one after another
+and take as long as before; a lens move is 4 x lensByteDelay.
+
+Sequence mode runs a list of uploaded positions without the host :
+  S C                   clear sequence
+  S A f m p d           append entry - focus move f (relative, as F),
+                        motor steps m (relative, as M), laser power p 
+                        (0-255, -1 to leave as is), dwell d milliseconds
+  S R                   run sequence
+  S X                   stop running sequence
+  S N                   query number of entries
+At each entry, once moves are done, tickPin goes high for the dwell
+and "T <index>" is sent. "T E" is sent when the sequence ends.
+
 */
 
 #include <SPI.h>
@@ -29,8 +46,32 @@ volatile byte laserPower = 128; // 0-255, analogWrite argument
 
 volatile int motorMove = 0;
 
+// ms after each SPI byte to lens. Value from original setFocus(); not 
+// tested shorter on the lens, so each lens move still blocks ~120 ms.
+const int lensByteDelay = 30;
+
+// Sequence mode
+const int tickPin = 8; // High while sequence dwells at a position
+const int maxSequenceLength = 64;
+
+struct sequenceEntry {
+  int focusMove;   // relative lens move
+  int motorSteps;  // relative stepper move
+  int laserSet;    // 0-255, or -1 for no change
+  unsigned int dwell; // ms
+};
+
+sequenceEntry sequence[maxSequenceLength];
+int sequenceLength = 0;
+int sequenceIndex = 0;
+bool sequenceRunning = false;
+bool sequenceDwelling = false;
+unsigned long dwellStart = 0;
+
 volatile unsigned int digitCount = 0;
-String inputString = "";         // a string to hold incoming data
+const int inputBufferSize = 128;
+char inputBuffer[inputBufferSize]; // holds incoming line, null terminated
+unsigned int inputLength = 0;      // characters in inputBuffer
 bool stringComplete = false;  // whether the string is complete
 
 void setup() {
@@ -52,6 +93,9 @@ void setup() {
 
   rotStepper.setSpeed(2000);
 
+  pinMode(tickPin, OUTPUT);
+  digitalWrite(tickPin, LOW);
+
     //Serial.println("rot init");
 
   InitLens();
@@ -68,6 +112,168 @@ void loop() {
 
   //Going to deal with Serial here
   if (stringComplete) {
+
+    // Line can hold a batch of commands separated by ';'
+    char* cmd = strtok(inputBuffer, ";");
+    while (cmd != NULL) {
+      runTokenCommand(cmd);
+      cmd = strtok(NULL, ";");
+    }
+
+    // Reset incoming serial
+    inputLength = 0;
+    stringComplete = false;
+  }
+
+  if (sequenceRunning) {
+    runSequenceStep();
+  }
+  
+}
+
+void runSequenceStep() {
+  // Non-blocking between positions so serial (eg S X) is still handled
+  if (sequenceDwelling) {
+    if (millis() - dwellStart < sequence[sequenceIndex].dwell) {
+      return;
+    }
+    // Dwell over
+    digitalWrite(tickPin, LOW);
+    sequenceDwelling = false;
+    sequenceIndex++;
+  }
+
+  if (sequenceIndex >= sequenceLength) {
+    sequenceRunning = false;
+    Serial.println("T E");
+    return;
+  }
+
+  sequenceEntry entry = sequence[sequenceIndex];
+
+  if (entry.motorSteps != 0) {
+    rotStepper.step(entry.motorSteps);
+  }
+
+  if (entry.focusMove != 0) {
+    // Same encoding of negative moves as F command
+    if (entry.focusMove < 0) {
+      focusPosition = 65535 + entry.focusMove;
+    }
+    else {
+      focusPosition = entry.focusMove;
+    }
+    setFocus();
+  }
+
+  if (entry.laserSet >= 0) {
+    laserPower = entry.laserSet;
+    analogWrite(laserPin, laserPower);
+  }
+
+  // Moves done. Tick + dwell.
+  digitalWrite(tickPin, HIGH);
+  Serial.print("T ");
+  Serial.println(sequenceIndex);
+  dwellStart = millis();
+  sequenceDwelling = true;
+}
+
+void sequenceCommand(const char* inputString) {
+  switch(char(inputString[2])) {
+    case('C'):
+      sequenceRunning = false;
+      sequenceLength = 0;
+      break;
+
+    case('A'): {
+      long values[4];
+      if ((parseLongs(inputString + 3, values, 4) == 4) && (sequenceLength < maxSequenceLength)) {
+        sequence[sequenceLength].focusMove = values[0];
+        sequence[sequenceLength].motorSteps = values[1];
+        sequence[sequenceLength].laserSet = values[2];
+        sequence[sequenceLength].dwell = values[3];
+        sequenceLength++;
+      }
+      else {
+        Serial.println(15, HEX); // Bad entry or sequence full
+      }
+      break;
+    }
+
+    case('R'):
+      sequenceIndex = 0;
+      sequenceDwelling = false;
+      sequenceRunning = (sequenceLength > 0);
+      if (!sequenceRunning) {
+        Serial.println("T E");
+      }
+      break;
+
+    case('X'):
+      if (sequenceRunning) {
+        sequenceRunning = false;
+        digitalWrite(tickPin, LOW);
+        Serial.println("T E");
+      }
+      break;
+
+    case('N'):
+      Serial.println(sequenceLength);
+      break;
+
+    default:
+      Serial.println(15, HEX);
+      break;
+  }
+}
+
+int parseLongs(const char* text, long* values, int maxValues) {
+  // Read up to maxValues signed integers separated by spaces
+  // Returns number read
+  int nValues = 0;
+  while ((*text != '\0') && (nValues < maxValues)) {
+    if (((*text >= '0') && (*text <= '9')) || (*text == '-')) {
+      char* end;
+      values[nValues] = strtol(text, &end, 10);
+      if (end == text) {
+        text++;
+        continue;
+      }
+      nValues++;
+      text = end;
+    }
+    else {
+      text++;
+    }
+  }
+  return nValues;
+}
+
+void runTokenCommand(char* cmd) {
+  // Skip leading spaces
+  while (*cmd == ' ') {
+    cmd++;
+  }
+
+  if (cmd[0] == '!') {
+    // Acknowledged command : !<token> <command>
+    // Reply !<token> after command completes
+    char* rest = cmd + 1;
+    long token = strtol(rest, &rest, 10);
+    while (*rest == ' ') {
+      rest++;
+    }
+    runCommand(rest);
+    Serial.print('!');
+    Serial.println(token);
+  }
+  else {
+    runCommand(cmd);
+  }
+}
+
+void runCommand(const char* inputString) {
     
     char firstChar = char(inputString[0]);
 
@@ -114,7 +320,7 @@ void loop() {
 
       case('F') :
         // Set focus to XXXX where XXXX is 16-bit integer
-        serialInputToLong(1);
+        serialInputToLong(inputString, 1);
         setFocus();
         break;
 
@@ -159,7 +365,7 @@ void loop() {
 
       case('P') : 
         // Laser set
-        serialInputToLong(2); // rest of input is power to set to
+        serialInputToLong(inputString, 2); // rest of input is power to set to
                               // nb - 0-255 is valid here. 
         analogWrite(laserPin, laserPower);
         break;
@@ -175,10 +381,15 @@ void loop() {
         break;
 
       case('M') :
-        serialInputToLong(3);
+        serialInputToLong(inputString, 3);
         rotStepper.step(motorMove);
         break;
 
+      case('S') :
+        // Sequence mode
+        sequenceCommand(inputString);
+        break;
+
       case('Y') :
         // Device ID
         Serial.println("cheesoSPIM");
@@ -198,17 +409,12 @@ void loop() {
             break;
             
         }
+        break; // One reply line per query
 
        default:
         Serial.println(15, HEX);
         break;
     }
-
-    // Reset incoming serial
-    inputString = "";
-    stringComplete = false;
-  }
-  
 }
 
 void demoStage(){
@@ -221,21 +427,26 @@ void demoStage(){
 
 void serialEvent() {
 
-  while (Serial.available()) {
+  // Leave further bytes in Serial buffer until current line is handled
+  while (Serial.available() && !stringComplete) {
     // get the new byte:
     char inChar = (char)Serial.read();
-    // add it to the inputString:
-    inputString += inChar;
     // if the incoming character is a newline, set a flag
     // so the main loop can do something about it:
     if (inChar == '\n') {
+      inputBuffer[inputLength] = '\0';
       stringComplete = true;
       //Serial.println("Input:");
-    /*  Serial.println(inputString);
+    /*  Serial.println(inputBuffer);
       Serial.println("Size:");
-      Serial.println(inputString.length()-1);
+      Serial.println(inputLength);
       */
     }
+    else if ((inChar != '\r') && (inputLength < inputBufferSize - 1)) {
+      // add it to the inputBuffer. Overlong lines are truncated.
+      inputBuffer[inputLength] = inChar;
+      inputLength++;
+    }
   }
 }
 
@@ -273,22 +484,22 @@ void InitLens()
 void setFocus() // Hoping this sets the position of the focus to middle.
 {  
   SPI.transfer(0x44); // Relative move command
-  delay(30);
+  delay(lensByteDelay);
   SPI.transfer(highByte(focusPosition));
-  delay(30);
+  delay(lensByteDelay);
   SPI.transfer(lowByte(focusPosition));
-  delay(30);
+  delay(lensByteDelay);
   SPI.transfer(0);
-  delay(30);
+  delay(lensByteDelay);
 
 }
 
-void serialInputToLong(int setMode) {
+void serialInputToLong(const char* inputString, int setMode) {
         //Serial.println(inputString);
         long tempValue = 0;
         bool isNegNumber = false;
         digitCount = 0;
-        for (int i = 2; i < inputString.length(); i++) {
+        for (int i = 2; inputString[i] != '\0'; i++) {
 
           if ((inputString[i] >= 48) & (inputString[i] < 58)) {
             tempValue = tempValue*10;
@@ -0,0 +1,340 @@
+# -*- coding: utf-8 -*-
+"""
+End-to-end acquisition pipeline benchmark
+
+Drives camera -> frameQueue -> routing -> preprocessor (median filter pool)
+-> saveQueue -> writeVideo process from the synthetic camera, with a display
+stage doing the same work as vidRecorder.showLastFrame (minus the Tk call)
+at the display rate cap.
+Each scenario runs in its own process so peak RSS is per scenario.
+
+Reports per scenario:
+    - sustained fps (frames written / run time)
+    - dropped frames (camera queue drops + frames overwritten before write)
+    - latency percentiles, ms, from capture to route, filtered, display and write
+    - display conversion time percentiles, ms
+    - CPU seconds (acquiring process + writer process) and peak RSS, MB
+
+Usage (from software/Python/cheesoSPIM_gui, or anywhere w/ cheesoSPIM_gui installed):
+    python benchmarks/pipelineBenchmark.py [--duration 5] [--out results.json] [--scenario name ...]
+
+Every frame is accounted for: acquired = written + dropped, where dropped 
+counts camera queue drops, frames lost before filtering and frames 
+overwritten before the writer read them.
+
+Output is JSON, one record per scenario, so runs can be diffed.
+
+@author: rusty
+"""
+
+import argparse
+import json
+import multiprocessing
+import pathlib
+import platform
+import queue
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+# Run from a checkout w/o installing: package folder is one up from here
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+
+from cheesoSPIM_gui.utilities import simCamera
+from cheesoSPIM_gui.utilities.framePreprocessor import framePreprocessor
+from cheesoSPIM_gui.utilities.acquisitionEngine import saveQueueSlots
+from cheesoSPIM_gui.utilities.frameDisplay import frameDisplay
+from cheesoSPIM_gui.utilities.frameWriters import streamFormats, writeVideo
+
+try:
+    import resource # Unix only. CPU + RSS are None elsewhere.
+except ImportError:
+    resource = None
+
+
+scenarioDefaults = {'width' : 640,
+                    'height' : 480,
+                    'bitDepth' : 8,
+                    'channels' : 3,
+                    'monochrome' : False, # True converts colour frames to mono in camera, as GUI does
+                    'fps' : 0, # 0 = camera as fast as possible; measures max sustained rate
+                    'roi' : None, # (x, y, w, h) camera crop, unbinned pixels
+                    'binning' : 1,
+                    'hardwareGeometry' : False, # True crops + bins in synthetic source, as on-chip; False in software
+                    'medianFilterSize' : 3,
+                    'format' : 'raw',
+                    'queueSize' : 64, # camera frameQueue length. Ring buffer is 2x this, or more to fit saveQueue.
+                    'filterWorkers' : 2,
+                    'saveQueueSize' : None, # None fits ring buffer, as acquisitionEngine. Set sizes grow the ring to fit.
+                    'displayMaxFps' : 30,
+                    'displaySize' : (648, 486)}
+
+scenarios = [
+    {'name' : 'vga_8bit_avi', 'format' : 'avi'},
+    {'name' : 'vga_8bit_raw', 'format' : 'raw'},
+    {'name' : 'vga_8bit_tiff', 'format' : 'tiff'},
+    {'name' : 'vga_8bit_raw_median5', 'medianFilterSize' : 5},
+    {'name' : 'vga_8bit_raw_nofilter', 'medianFilterSize' : 1},
+    {'name' : 'vga_8bit_raw_queue8', 'queueSize' : 8},
+    {'name' : 'vga_8bit_raw_median5_1worker', 'medianFilterSize' : 5, 'filterWorkers' : 1},
+    {'name' : 'vga_8bit_raw_savequeue16', 'saveQueueSize' : 16}, # backpressure reaches camera sooner
+    {'name' : 'vga_8bit_raw_savequeue100', 'saveQueueSize' : 100}, # ring grown to fit
+    {'name' : '720p_8bit_avi', 'width' : 1280, 'height' : 720, 'format' : 'avi'},
+    {'name' : '720p_8bit_raw', 'width' : 1280, 'height' : 720},
+    {'name' : '1080p_8bit_raw', 'width' : 1920, 'height' : 1080},
+    {'name' : '1080p_8bit_bgr_to_mono_raw', 'width' : 1920, 'height' : 1080, 'monochrome' : True},
+    {'name' : '1080p_16bit_mono_avi', 'width' : 1920, 'height' : 1080, 'bitDepth' : 16, 'channels' : 1, 'format' : 'avi'},
+    {'name' : '1080p_16bit_mono_raw', 'width' : 1920, 'height' : 1080, 'bitDepth' : 16, 'channels' : 1},
+    {'name' : '1080p_16bit_mono_bin2_raw', 'width' : 1920, 'height' : 1080, 'bitDepth' : 16, 'channels' : 1, 'binning' : 2},
+    {'name' : '1080p_16bit_mono_band_raw', 'width' : 1920, 'height' : 1080, 'bitDepth' : 16, 'channels' : 1, 
+     'roi' : (0, 440, 1920, 200)}, # Light sheet band, cropped in software
+    {'name' : '1080p_16bit_mono_band_hw_30fps_raw', 'width' : 1920, 'height' : 1080, 'bitDepth' : 16, 'channels' : 1, 
+     'roi' : (0, 440, 1920, 200), 'hardwareGeometry' : True, 'fps' : 30}, # Fewer rows read out -> camera fps above 30
+    {'name' : '4k_8bit_raw', 'width' : 3840, 'height' : 2160},
+    ]
+
+
+def percentiles(values):
+    """
+    p50/p90/p99/max of list, in ms. None if empty.
+    """
+    if len(values) == 0:
+        return None
+    v = np.asarray(values) * 1000
+    return {'p50' : float(np.percentile(v, 50)),
+            'p90' : float(np.percentile(v, 90)),
+            'p99' : float(np.percentile(v, 99)),
+            'max' : float(v.max())}
+
+
+class timedCamera(simCamera.camera):
+    """
+    Synthetic camera that records capture time of each frame by sequence number
+    """
+
+    def __init__(self, simParams):
+        self.captureTimes = {}
+        super().__init__(simParams = simParams)
+        return
+
+    def storeFrame(self, frame, timestamp = None):
+        t = time.monotonic()
+        seq = super().storeFrame(frame, t)
+        self.captureTimes[seq] = t
+        return seq
+
+
+def runScenario(scenario, duration, resultQueue):
+    """
+    Run one scenario. Called in own process; result dict goes in resultQueue.
+    """
+    s = dict(scenarioDefaults)
+    s.update(scenario)
+
+    camera = timedCamera({'width' : s['width'],
+                          'height' : s['height'],
+                          'fps' : s['fps'],
+                          'bitDepth' : s['bitDepth'],
+                          'channels' : s['channels'],
+                          'hardwareGeometry' : s['hardwareGeometry']})
+    camera.monochrome = s['monochrome']
+    camera.setGeometry(s['roi'], s['binning'])
+    camera.nBufferSlots = 2 * s['queueSize']
+    camera.frameQueue.maxsize = s['queueSize']
+    camera.setQueuePolicy('block') # Record mode
+    routeTimes = {}
+    filterTimes = {}
+    state = {'lastSeq' : None}
+    
+    def filtered(seq, record):
+        # Same job as acquisitionEngine.frameFiltered
+        filterTimes[seq] = time.monotonic()
+        state['lastSeq'] = seq
+        saveQueue.put(record)
+        return
+    
+    preprocessor = framePreprocessor(filterSize = s['medianFilterSize'], 
+                                     nWorkers = s['filterWorkers'], 
+                                     callback = filtered)
+    saveQueueSize = saveQueueSlots(camera, preprocessor, s['saveQueueSize']) # Before ring is allocated
+    frameBuffer = preprocessor.allocateBuffer(camera.allocateBuffer())
+
+    outDir = tempfile.TemporaryDirectory()
+    saveQueue = multiprocessing.Queue(maxsize = saveQueueSize)
+    timingQueue = multiprocessing.Queue()
+
+    writer = multiprocessing.Process(target = writeVideo,
+                                     args = (saveQueue, {'fileName' : str(pathlib.Path(outDir.name) / 'bench'),
+                                                         'format' : s['format'],
+                                                         'frameRate' : 30.0,
+                                                         'size' : (frameBuffer.frameShape[1], frameBuffer.frameShape[0]),
+                                                         'frameBuffer' : frameBuffer.description(),
+                                                         'medianFilterSize' : None, # Filtered by preprocessor
+                                                         'timingQueue' : timingQueue}))
+    writer.start()
+
+    displayLatency = []
+    displayCost = []
+
+    def routePending():
+        # Same job as acquisitionEngine.routePending
+        while True:
+            try:
+                record = camera.frameQueue.get_nowait()
+            except queue.Empty:
+                break
+            routeTimes[record.seq] = time.monotonic()
+            preprocessor.submit(camera.frameBuffer, record.seq, record)
+        return
+
+    def route():
+        # Same job as acquisitionEngine.routeFrames
+        while camera.isStreaming or not camera.frameQueue.empty():
+            if camera.newFrame.wait(timeout = 0.5):
+                camera.newFrame.clear()
+                routePending()
+        return
+
+    def display():
+        # Same work as vidRecorder.showLastFrame, w/o Tk
+        shown = None
+        display = frameDisplay(*s['displaySize'])
+        while camera.isStreaming:
+            time.sleep(1.0 / s['displayMaxFps'])
+            seq = state['lastSeq']
+            if (seq is None) or (seq == shown):
+                continue
+            t0 = time.monotonic()
+            frame = frameBuffer.read(seq, copy = False)
+            if frame is None:
+                continue
+            if frame.dtype != np.uint8:
+                frame = (frame >> 8).astype(np.uint8)
+            display.toImage(frame) # PhotoImage.paste() not timed; needs Tk
+            t1 = time.monotonic()
+            displayCost.append(t1 - t0)
+            displayLatency.append(t1 - camera.captureTimes[seq])
+            shown = seq
+        return
+
+    cpu0 = time.process_time()
+    camera.startStream()
+    routeThread = threading.Thread(target = route, daemon = True)
+    displayThread = threading.Thread(target = display, daemon = True)
+    routeThread.start()
+    displayThread.start()
+
+    time.sleep(duration)
+
+    camera.stopStream()
+    routeThread.join()
+    routePending() # Last frame can land after route() saw stream stop, as in acquisitionEngine.stop()
+    preprocessor.flush()
+    displayThread.join()
+    tStop = time.monotonic()
+    saveQueue.put(None)
+    writeStats = timingQueue.get()
+    writer.join()
+    tDone = time.monotonic()
+    cpuSelf = time.process_time() - cpu0
+
+    counts = camera.frameCounts()
+    nFilterDropped = preprocessor.nDropped
+    preprocessor.close()
+    camera.releaseBuffer()
+    outDir.cleanup()
+
+    writeTimes = writeStats['writeTimes']
+    captureTimes = camera.captureTimes
+    routeLatency = [routeTimes[k] - captureTimes[k] for k in routeTimes]
+    filterLatency = [filterTimes[k] - captureTimes[k] for k in filterTimes]
+    writeLatency = [t - captureTimes[k] for (k, t) in writeTimes]
+
+    result = {'scenario' : s['name'],
+              'parameters' : {k : v for k, v in s.items() if k != 'name'},
+              'duration' : duration,
+              'frameShape' : list(frameBuffer.frameShape), # After ROI + binning
+              'acquired' : counts['acquired'],
+              'written' : len(writeTimes),
+              'dropped' : counts['dropped'] + nFilterDropped + writeStats['overwritten'],
+              'unaccounted' : counts['acquired'] - len(writeTimes) - (counts['dropped'] + nFilterDropped + writeStats['overwritten']), # 0 unless a frame went missing
+              'sustainedFps' : len(writeTimes) / (tStop - (min(captureTimes.values()) if captureTimes else tStop)) if writeTimes else 0.0,
+              'drainTime' : tDone - tStop, # s for writer to catch up after stop
+              'measuredFps' : writeStats['timing']['measuredFps'], # from capture timestamps of written frames
+              'latency' : {'route' : percentiles(routeLatency),
+                           'filtered' : percentiles(filterLatency),
+                           'display' : percentiles(displayLatency),
+                           'write' : percentiles(writeLatency)},
+              'displayConversion' : percentiles(displayCost),
+              'cpuSeconds' : None,
+              'peakRssMB' : None}
+
+    if resource is not None:
+        child = resource.getrusage(resource.RUSAGE_CHILDREN)
+        self_ = resource.getrusage(resource.RUSAGE_SELF)
+        result['cpuSeconds'] = {'acquire' : cpuSelf,
+                                'writer' : child.ru_utime + child.ru_stime}
+        # ru_maxrss is KB on Linux, bytes on macOS
+        scale = 1 / 1024**2 if platform.system() == 'Darwin' else 1 / 1024
+        result['peakRssMB'] = {'acquire' : self_.ru_maxrss * scale,
+                               'writer' : child.ru_maxrss * scale}
+
+    resultQueue.put(result)
+
+    return
+
+
+def runBenchmarks(names = None, duration = 5.0):
+    """
+    Run scenarios (all if names is None), each in a fresh process.
+    Returns list of result dicts.
+    """
+    results = []
+    ctx = multiprocessing.get_context('spawn') # Clean process; RSS not inherited
+
+    for scenario in scenarios:
+        if (names is not None) and (scenario['name'] not in names):
+            continue
+        if scenario.get('format', scenarioDefaults['format']) not in streamFormats:
+            continue
+
+        resultQueue = ctx.Queue()
+        p = ctx.Process(target = runScenario, args = (scenario, duration, resultQueue))
+        p.start()
+        try:
+            result = resultQueue.get(timeout = duration + 120)
+        except queue.Empty:
+            result = {'scenario' : scenario['name'], 'error' : 'timed out'}
+        p.join()
+
+        print('{:28s} {:8.1f} fps  {:6d} dropped'.format(result['scenario'],
+                                                        result.get('sustainedFps', 0.0),
+                                                        result.get('dropped', -1)))
+        results.append(result)
+
+    return results
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description = 'cheesoSPIM acquisition pipeline benchmark')
+    parser.add_argument('--duration', type = float, default = 5.0, help = 'seconds per scenario')
+    parser.add_argument('--out', type = str, default = None, help = 'JSON output file')
+    parser.add_argument('--scenario', nargs = '*', default = None, help = 'scenario names to run')
+    args = parser.parse_args()
+
+    results = runBenchmarks(args.scenario, args.duration)
+
+    output = {'platform' : platform.platform(),
+              'python' : platform.python_version(),
+              'time' : time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'results' : results}
+
+    if args.out is not None:
+        with open(args.out, 'w') as f:
+            json.dump(output, f, indent = 2)
+    else:
+        print(json.dumps(output, indent = 2))
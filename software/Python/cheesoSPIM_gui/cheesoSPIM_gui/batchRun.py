@@ -0,0 +1,479 @@
+# -*- coding: utf-8 -*-
+"""
+Command-line batch acquisition, no GUI
+
+Runs acquisitions described in YAML or JSON run files, one after the
+other, and prints progress + a throughput summary for each.
+
+Usage:
+    python -m cheesoSPIM_gui.batchRun run1.yaml [run2.json ...] [--simulate] [--dry-run]
+    python -m cheesoSPIM_gui.batchRun --recover D:/specimens/specimen01_0000.seg
+
+A run file is one run, or shared settings + a list of runs:
+
+    scope:
+        port: COM3 # serial port, or 'sim' for simulated scope
+    camera:
+        backend: opencv # name in cameraBackends registry
+        id: 0
+        parameters: # as vidRecorder cameraParameters
+            exposureTime: 50
+            autoGain: false
+            gainValue: 12
+            binning: 2
+    output:
+        path: D:/specimens
+        format: avi # key in frameWriters.streamFormats (record runs)
+    runs:
+        - name: specimen01
+          mode: record # 'record', 'sweep' or 'snap'
+          duration: 30 # s
+        - name: specimen01_stack
+          mode: sweep
+          sweep: # see sweepAcquisition.sweepDefaults
+              focusStop: 200
+              angles: [0, 800]
+
+Each run's sections override the shared ones key by key, so a run only
+lists what differs. See runDefaults for every field. YAML needs PyYAML;
+JSON run files need nothing extra.
+
+For long recordings use format 'segments' (crash-safe). With
+resume: true, a run carries on the last unfinished recording of the
+same name (eg after a crash or power cut) instead of starting a new one.
+--recover repairs cut-short recordings w/o acquiring anything.
+
+Exit status is the number of runs that failed (0 if all finished).
+
+@author: rusty
+"""
+
+import argparse
+import copy
+import json
+import pathlib
+import sys
+import time
+
+from cv2 import imwrite
+
+from cheesoSPIM_gui.utilities.cameraBackends import cameraBackends, openCamera
+from cheesoSPIM_gui.utilities.acquisitionEngine import acquisitionEngine, uniqueFileName
+from cheesoSPIM_gui.utilities.frameWriters import writerBackends, streamFormats, segmentedWriter, recoverSegments
+from cheesoSPIM_gui.utilities.sweepAcquisition import sweepAcquisition, checkSweep
+from cheesoSPIM_gui.utilities.autofocus import autofocus
+
+
+runDefaults = {'name' : 'run', # prefix of output file names
+               'mode' : 'record', # 'record' for a timed stream, 'sweep' for Z-stack / angles, 'snap' for single image
+               'duration' : 10, # s, 'record'
+               'frames' : None, # stop 'record' after this many frames instead, if set
+               'resume' : False, # 'record' in 'segments' format carries on last unfinished recording of this name
+               'snapFrames' : 1, # frames combined for 'snap'. >1 saves a 32-bit composite .tif
+               'snapAccumulate' : 'sum', # 'sum', 'mean' or 'median'
+               'laserPower' : None, # 0 - 255, None to leave as is
+               'scope' : {'port' : 'COM3', # serial port, or 'sim'
+                          'baudrate' : 115200},
+               'camera' : {'backend' : 'opencv',
+                           'id' : 0,
+                           'parameters' : {}}, # passed to camera.setParameters()
+               'output' : {'path' : 'vids',
+                           'format' : 'avi'},
+               'engine' : {}, # overrides for acquisitionEngine.engineDefaults
+               'sweep' : {}, # overrides for sweepAcquisition.sweepDefaults
+               'autofocus' : None} # overrides for autofocus.autofocusDefaults; runs before acquiring if set
+
+runModes = ('record', 'sweep', 'snap')
+
+
+def mergeSettings(base, override):
+    """
+    Copy of base w/ override on top. Nested dicts merge key by key.
+    """
+    merged = copy.deepcopy(base)
+
+    for key, value in override.items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = mergeSettings(merged[key], value)
+        else:
+            merged[key] = copy.deepcopy(value)
+
+    return merged
+
+def loadRunFile(fileName):
+    """
+    List of complete run dicts from a YAML or JSON run file
+    """
+    fileName = pathlib.Path(fileName)
+
+    with open(fileName, 'r') as f:
+        if fileName.suffix.lower() in ('.yaml', '.yml'):
+            import yaml # Optional dependency, only needed for YAML run files
+            description = yaml.safe_load(f)
+        else:
+            description = json.load(f)
+
+    if description is None:
+        return []
+
+    shared = {k : v for (k, v) in description.items() if k != 'runs'}
+    runList = description.get('runs', [{}])
+
+    runs = []
+    for k, run in enumerate(runList):
+        run = mergeSettings(mergeSettings(runDefaults, shared), run)
+        checkRun(run, '{} run {}'.format(fileName.name, k))
+        runs.append(run)
+
+    return runs
+
+def checkRun(run, label):
+    """
+    Raise ValueError for settings that would only fail once hardware is up
+    """
+    unknown = set(run.keys()) - set(runDefaults.keys())
+    if len(unknown) > 0:
+        raise ValueError('{} : unknown settings {}'.format(label, sorted(unknown)))
+
+    if run['mode'] not in runModes:
+        raise ValueError('{} : mode must be one of {}, got {}'.format(label, runModes, run['mode']))
+
+    if run['camera']['backend'] not in cameraBackends:
+        raise ValueError('{} : unknown camera backend {}'.format(label, run['camera']['backend']))
+
+    formats = [run['output']['format']]
+    if run['mode'] == 'sweep':
+        formats.append(run['sweep'].get('format', 'zarr'))
+    for fileFormat in formats:
+        if fileFormat not in writerBackends:
+            raise ValueError('{} : unknown writer format {}. Choose from {}'.format(label, fileFormat, list(writerBackends.keys())))
+
+    if (run['mode'] == 'record') and (run['output']['format'] not in streamFormats):
+        raise ValueError('{} : record format must be one of {}, got {}'.format(label, streamFormats, run['output']['format']))
+
+    if run['mode'] == 'sweep':
+        try:
+            checkSweep(run['sweep'])
+        except ValueError as e:
+            raise ValueError('{} : {}'.format(label, e))
+
+    return
+
+
+def unfinishedRecording(path, prefix):
+    """
+    Newest prefix_NNNN.seg recording in path that wasn't closed, or None
+    One w/ segments but no manifest (cut short before its first flush) counts.
+    """
+    for recording in sorted(pathlib.Path(path).glob('{}_*{}'.format(prefix, segmentedWriter.extension)), reverse = True):
+        manifestFile = recording / segmentedWriter.manifestName
+        if not(manifestFile.exists()):
+            if len(list(recording.glob('segment_*.npy'))) > 0:
+                return recording
+            continue
+        with open(manifestFile, 'r') as f:
+            if not(json.load(f)['complete']):
+                return recording
+
+    return None
+
+
+def openScope(port, baudrate = 115200):
+    """
+    cheesoSPIM_driver on serial port, or on simulated scope if port is 'sim'
+    """
+    # Only imported here so --dry-run works w/o pyserial
+    from cheesoSPIM_gui.utilities.cheesoSPIMDriver import cheesoSPIM_driver
+    from cheesoSPIM_gui.utilities.simScope import simSerial
+
+    if str(port).lower() == 'sim':
+        serialDevice = simSerial()
+    else:
+        import serial
+        serialDevice = serial.Serial(port, baudrate = baudrate)
+        time.sleep(2) # Arduino resets on connect
+
+    return cheesoSPIM_driver(serialDevice)
+
+
+class batchRun():
+    """
+    One run from a run file: open hardware, acquire, close
+    """
+
+    def __init__(self, run, simulate = False):
+        """
+        Arguments:
+            - run = complete run dict, see runDefaults
+            - simulate = bool, True runs on simulated scope + camera whatever the run file says
+        """
+        self.run = run
+        self.simulate = simulate
+
+        self.scope = None
+        self.camera = None
+        self.engine = None
+
+        self.lensPosition = 0 # Tracked from lensAllIn(), as in GUI
+        self.rotationPosition = 0
+        self.summary = {} # Filled in by execute()
+
+        self.outputPath = pathlib.Path(run['output']['path'])
+
+        return
+
+    def stageState(self):
+        return {'exposureTime' : self.run['camera']['parameters'].get('exposureTime'),
+                'lensPosition' : self.lensPosition,
+                'rotationPosition' : self.rotationPosition,
+                'laserPower' : self.run['laserPower']}
+
+    def openHardware(self):
+        run = self.run
+
+        self.scope = openScope('sim' if self.simulate else run['scope']['port'], run['scope']['baudrate'])
+        self.scope.lensAllIn()
+        if run['laserPower'] is not None:
+            self.scope.setLaserPower(int(run['laserPower']))
+
+        self.camera = openCamera('synthetic' if self.simulate else run['camera']['backend'], run['camera']['id'])
+        self.camera.setParameters(run['camera']['parameters'])
+
+        engineParams = dict({'format' : run['output']['format'],
+                             'exposureTime' : run['camera']['parameters'].get('exposureTime')},
+                            **run['engine'])
+        self.engine = acquisitionEngine(self.camera, self.scope, engineParams, stageState = self.stageState)
+
+        return
+
+    def closeHardware(self):
+        if self.engine is not None:
+            self.engine.close()
+        if self.camera is not None:
+            self.camera.close()
+        if self.scope is not None:
+            self.scope.close()
+
+        return
+
+    def execute(self):
+        """
+        Whole run. Returns summary dict.
+        """
+        run = self.run
+        self.outputPath.mkdir(parents = True, exist_ok = True)
+
+        t0 = time.monotonic()
+        try:
+            self.openHardware()
+
+            if run['autofocus'] is not None:
+                self.runAutofocus()
+
+            if run['mode'] == 'record':
+                self.runRecord()
+            elif run['mode'] == 'sweep':
+                self.runSweep()
+            else:
+                self.runSnap()
+        finally:
+            self.closeHardware()
+
+        self.summary['totalTime'] = time.monotonic() - t0
+
+        return self.summary
+
+    def runAutofocus(self):
+        search = autofocus(self.scope, self.camera, self.run['autofocus'], startPosition = self.lensPosition)
+        try:
+            search.run()
+        finally:
+            self.lensPosition = search.lensPosition # Start position if search failed
+
+        print('  Autofocus : lens @ {} ({} positions, {:.1f} s)'.format(search.bestPosition, len(search.results), search.elapsed))
+        self.summary['lensPosition'] = self.lensPosition
+
+        return
+
+    def runRecord(self):
+        run = self.run
+        extension = writerBackends[run['output']['format']].extension
+        fileName = None
+        if run['resume'] and (run['output']['format'] == 'segments'):
+            fileName = unfinishedRecording(self.outputPath, run['name'])
+        resume = fileName is not None
+        if not(resume):
+            fileName = uniqueFileName(self.outputPath, run['name'], extension)
+
+        t0 = time.monotonic() # Before record(), which waits for first frames
+        fileName = self.engine.record(fileName, resume = resume)
+        print('  {} {}'.format('Resuming' if resume else 'Recording to', fileName))
+
+        lastPrint = t0
+        while True:
+            time.sleep(0.1)
+            now = time.monotonic()
+            counts = self.engine.frameCounts()
+
+            if (now - t0) >= run['duration']:
+                break
+            if counts['writerError'] is not None:
+                break # Recording already stopped
+            if (run['frames'] is not None) and (counts['delivered'] >= run['frames']):
+                break
+
+            if (now - lastPrint) >= 1:
+                fps = self.camera.measuredFrameRate()
+                print('  {:6.1f} s : {} frames, {} fps, {} dropped'.format(now - t0,
+                                                                         counts['delivered'],
+                                                                         '-' if fps is None else '{:.1f}'.format(fps),
+                                                                         counts['dropped']))
+                lastPrint = now
+
+        counts = self.engine.stop(waitForWriter = True)
+        elapsed = time.monotonic() - t0 # Includes writer finishing file
+        if counts['writerError'] is not None:
+            raise RuntimeError(counts['writerError'])
+
+        self.summary.update(counts)
+        self.summary.update({'fileName' : str(fileName),
+                             'elapsed' : elapsed,
+                             'fps' : counts['delivered'] / elapsed,
+                             'MBps' : fileSize(fileName) / 1e6 / elapsed})
+
+        return
+
+    def runSweep(self):
+        run = self.run
+        sweep = run['sweep']
+        extension = writerBackends[sweep.get('format', 'zarr')].extension
+        fileName = uniqueFileName(self.outputPath, run['name'], extension)
+        print('  Sweep to {}'.format(fileName))
+
+        self.engine.configurePreprocessor() # Hot pixel map or median, as streamed frames
+        acquisition = sweepAcquisition(self.scope, self.camera, sweep, fileName,
+                                       startPositions = {'lensPosition' : self.lensPosition,
+                                                         'rotationPosition' : self.rotationPosition},
+                                       preprocessor = self.engine.preprocessor)
+
+        t0 = time.monotonic()
+        acquisition.start()
+        while acquisition.thread.is_alive():
+            acquisition.thread.join(timeout = 1)
+            nDone, nTotal = acquisition.progress()
+            print('  {:6.1f} s : {} / {} positions'.format(time.monotonic() - t0, nDone, nTotal))
+        elapsed = time.monotonic() - t0
+
+        self.lensPosition = acquisition.lensPosition
+        self.rotationPosition = acquisition.rotationPosition
+
+        if acquisition.error is not None:
+            raise acquisition.error # Frames so far are in fileName
+
+        nDone, nTotal = acquisition.progress()
+        nFrames = nDone * acquisition.sweep['framesPerPosition']
+        self.summary.update({'fileName' : str(fileName),
+                             'positions' : nDone,
+                             'frames' : nFrames,
+                             'elapsed' : elapsed,
+                             'fps' : nFrames / elapsed,
+                             'MBps' : fileSize(fileName) / 1e6 / elapsed})
+
+        return
+
+    def runSnap(self):
+        run = self.run
+        seq, composite = self.engine.snap(run['snapFrames'], run['snapAccumulate'])
+
+        if composite is not None:
+            fileName = uniqueFileName(self.outputPath, run['name'], '.tif') # float32
+            img = composite
+        else:
+            fileName = uniqueFileName(self.outputPath, run['name'], '.png')
+            img = self.engine.readFrame(seq)
+            if img is None:
+                raise RuntimeError('No frame from camera')
+
+        imwrite(str(fileName), img)
+        print('  Snap saved to {}'.format(fileName))
+
+        self.summary.update({'fileName' : str(fileName),
+                             'frames' : run['snapFrames']})
+
+        return
+
+
+def fileSize(fileName):
+    """
+    Bytes in file, or in all files under it for directory stores (zarr, tiff folders)
+    """
+    fileName = pathlib.Path(fileName)
+    if not(fileName.exists()):
+        return 0
+    if fileName.is_dir():
+        return sum(f.stat().st_size for f in fileName.rglob('*') if f.is_file())
+
+    return fileName.stat().st_size
+
+def printSummary(name, summary):
+    text = '  {} done in {:.1f} s'.format(name, summary['totalTime'])
+    if 'fps' in summary:
+        text += ' : {} frames, {:.1f} fps, {:.1f} MB/s'.format(summary.get('delivered', summary.get('frames')),
+                                                               summary['fps'],
+                                                               summary['MBps'])
+    if summary.get('dropped', 0) > 0:
+        text += ', {} dropped'.format(summary['dropped'])
+    print(text)
+
+    return
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = 'cheesoSPIM batch acquisition from run files')
+    parser.add_argument('runFiles', nargs = '*', help = 'YAML or JSON run files, run in order')
+    parser.add_argument('--simulate', action = 'store_true', help = 'simulated scope + camera')
+    parser.add_argument('--dry-run', action = 'store_true', help = 'check run files + print runs, no acquisition')
+    parser.add_argument('--recover', nargs = '+', default = [], help = "repair cut-short 'segments' recordings")
+    args = parser.parse_args(argv)
+
+    for recording in args.recover:
+        try:
+            manifest = recoverSegments(recording)
+        except ValueError as e:
+            print('{} : {}'.format(recording, e))
+            continue
+        print('{} : {} frames in {} segments recovered'.format(recording, manifest['frames'], len(manifest['segments'])))
+
+    if len(args.runFiles) == 0:
+        if len(args.recover) == 0:
+            parser.error('give run files and/or --recover recordings')
+        return 0
+
+    # Check every file before starting, so a typo in the last one doesn't stop the queue halfway
+    runs = []
+    for runFile in args.runFiles:
+        runs.extend(loadRunFile(runFile))
+
+    if args.dry_run:
+        print(json.dumps(runs, indent = 2, default = str))
+        return 0
+
+    nFailed = 0
+    for k, run in enumerate(runs):
+        print('[{}/{}] {} ({})'.format(k + 1, len(runs), run['name'], run['mode']))
+        try:
+            summary = batchRun(run, simulate = args.simulate).execute()
+        except Exception as e:
+            # Carry on w/ next specimen
+            print('  {} failed : {}'.format(run['name'], e))
+            nFailed += 1
+            continue
+        printSummary(run['name'], summary)
+
+    print('{} of {} runs finished'.format(len(runs) - nFailed, len(runs)))
+
+    return nFailed
+
+
+if __name__ == '__main__':
+    sys.exit(main())
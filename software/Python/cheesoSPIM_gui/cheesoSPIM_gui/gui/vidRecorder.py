@@ -19,59 +19,30 @@ import tkinter as tk
 from tkinter import ttk, filedialog
 
 import time
-from cheesoSPIM_gui.utilities import cv2Camera as cam
+import threading
+from cheesoSPIM_gui.utilities.cameraBackends import openCamera
+from cheesoSPIM_gui.utilities.simScope import simSerial
 
 from cheesoSPIM_gui.utilities.cheesoSPIMDriver import cheesoSPIM_driver as scopeController
-
-from PIL import Image, ImageTk
-from cv2 import medianBlur, VideoWriter_fourcc, VideoWriter, imwrite
-
+from cheesoSPIM_gui.utilities.frameWriters import writerBackends, streamFormats
+from cheesoSPIM_gui.utilities.acquisitionEngine import acquisitionEngine, uniqueFileName
+from cheesoSPIM_gui.utilities.sweepAcquisition import sweepAcquisition
+from cheesoSPIM_gui.utilities.autofocus import autofocus
+from cheesoSPIM_gui.utilities.focusMetric import focusMetric
+from cheesoSPIM_gui.utilities.stageTimer import stageTimer
+from cheesoSPIM_gui.utilities.frameDisplay import frameDisplay
+from cheesoSPIM_gui.utilities import sensorGeometry
+
+from cv2 import imwrite
+
+import argparse
 import pathlib
 import serial
-import multiprocessing
 
 
 scopePort = 'COM3'
 cameraID = 0
-
-
-
-def writeVideo(queue, paramDict):
-    """
-    Video write method
-    Separate method to support multiprocessing
-    
-    Arguments:
-        - queue = queue.Queue() or equivalent
-                    Queue to pull frames from
-        - paramDict = dict with keys = values:
-                    'fileName' - str, file path of output
-                    'frameRate' - float, frame rate of camera
-                    'size' - tuple of ints, height x width
-    """
-    fourcc = VideoWriter_fourcc('M','J','P','G')    # Init format
-    # Init openCV VideoWriter object
-    videoObject = VideoWriter(str(paramDict['fileName']), 
-                              fourcc,
-                              paramDict['frameRate'],
-                              paramDict['size'])
-
-    while (True):
-        # Pull last frame out of queue
-        item = queue.get()
-
-        if item is None: # Return from closed queue
-            break # Get out of while loop
-        else:
-            # item returned.  Write to file.
-            videoObject.write(item)
-        
-    # Executed after break call
-    # Close videoObject file
-    while videoObject.isOpened():
-        videoObject.release()
-
-    return
+cameraBackend = 'opencv' # Name in cameraBackends registry, eg 'opencv', 'vimba'
 
 
 
@@ -90,12 +61,16 @@ class vidRecorder:
         self.parent = parent # Init w/ supplied parent object
         
         self.demoMode = False # True will skip camera start up
+        self.simulateHardware = False # True runs everything on simulated camera + scope
         
         
         # Start up 'scope connection
         if not(self.demoMode):
-            self.serial = serial.Serial(scopePort, baudrate = 115200)
-            time.sleep(2)
+            if self.simulateHardware:
+                self.serial = simSerial()
+            else:
+                self.serial = serial.Serial(scopePort, baudrate = 115200)
+                time.sleep(2)
             self.scope = scopeController(self.serial)
         
         
@@ -112,10 +87,13 @@ class vidRecorder:
                                  "minGain" : 0, # dB, 0 is min from AlliedVision camera
                                  "maxGain" : 24, # dB, 24 is max for AlliedVision camera
                                  "medianFilterSize" : 3, # pixels, must be odd
-                                 "binning" : 2, # Pixel binning; 2 improves speed w/o much res loss
+                                 "hotPixelCorrection" : 'median', # 'median' blur w/ medianFilterSize, or 'map' to repair only dark-calibrated pixels
+                                 "binning" : 1, # Pixel binning, 1 for none. Done in software if camera can't.
                                  "cropROI" : False, # Use full chip or no
+                                 "roi" : None, # (x, y, width, height), unbinned sensor pixels. Used if cropROI, eg light sheet band.
                                  "laserPower" : 128, 
                                  "lensPosition" : 10, 
+                                 "rotationPosition" : 0, # Motor steps from start, host-side count
                                  "spin_bigStep" : 100, 
                                  "spin_smallStep" : 5,
                                  "lens_bigStep" : 100,
@@ -123,24 +101,67 @@ class vidRecorder:
         # ^ Min/max values are specified here as hard-coded.  Could use a query instead if 
         # concerned values coded here are not OK for your camera
         
+        # Z-stack / angle sweep run by 'Sweep' button
+        # See sweepAcquisition.sweepDefaults for all fields
+        self.sweepParameters = {"focusStart" : 0, # lens position of first plane
+                                "focusStop" : 200, # lens position of last plane
+                                "focusStep" : 10, # lens counts per plane
+                                "angles" : [0], # rotation positions, motor steps
+                                "framesPerPosition" : 8, 
+                                "accumulate" : 'mean', # one averaged plane per position
+                                "settleTime" : 0.2, # seconds
+                                "format" : 'zarr'}
+        self.sweep = None # sweepAcquisition while a sweep runs
+        
+        # Excitation lens autofocus run by 'Autofocus' button
+        # See autofocus.autofocusDefaults for all fields
+        self.autofocusParameters = {"searchRange" : 200, # lens counts either side of current position
+                                    "steps" : [40, 10, 2], # coarse -> fine lens counts
+                                    "metric" : 'laplacian', # or 'gradient'
+                                    "roi" : None} # (x, y, w, h) of frame to judge focus on
+        self.autofocusRun = None # autofocus while a search runs
+        self.recordThread = None # Starts engine recording, which waits for first frames, off Tk thread
+        self.recordError = None # Exception from last recording start
+        self.focusInterval = 0.2 # s between live focus metric updates
+        self.lastFocusUpdate = 0
+        
         self.parent.protocol("WM_DELETE_WINDOW",  self.haltAll) # If you close main window, shut it all down
         
         self.pathForSaving = pathlib.Path(__file__).parent.parent.parent / 'vids' # Init video record path
+        self.calibrationPath = pathlib.Path(__file__).parent.parent.parent / 'calibration' # Hot pixel map cache
         self.iconsPath = pathlib.Path(__file__).parent / 'icons' # Init local icons path
         
         self.saveFileName = None # Init file name
+        self.recordFormat = 'avi' # Key in frameWriters.streamFormats
         
         # Option flags 
         # Not exposed in GUI
         self.newImgOnSnap = True # Take image when 'Snap' button pressed
         self.saveOnSnap = True # Prompt to save file w/ Snap
+        self.snapFrames = 1 # Frames combined per Snap. >1 saves a 32-bit composite.
+        self.snapAccumulate = 'sum' # 'sum', 'mean' or 'median' of snapFrames frames
+        self.compositeFrame = None # Last Snap composite, if snapFrames > 1
+        self.darkFrames = 32 # Frames averaged for hot pixel calibration
 
         self.verbose = False # Print statements flag
         
-        self.rawFrame = None # Init placeholder for most recent frame
-        self.saveQueue = multiprocessing.Queue(maxsize = 100) # Init queue for files to save w/ multiprocessing thread
-
-        self.isRecording = False # flag for live (False) vs record (True) stream
+        self.displayMaxFps = 30 # Cap on GUI redraw rate. Independent of camera frame rate.
+        
+        # Per-stage timing of capture, dequeue, filter, display + write
+        # F2 toggles overlay of rolling stats on image, F3 saves trace in pathForSaving
+        self.timer = stageTimer()
+        self.showPerfOverlay = False
+        self.perfTraceFormat = '.csv' # '.csv' for events only, '.json' adds summary + histograms
+        self.lastOverlayUpdate = 0
+        self.lastCountsUpdate = 0 # Frame counts + measured fps refreshed once a second while streaming
+        
+        # Camera -> hot pixel filter -> disk runs in acquisition engine, w/o GUI
+        # GUI subscribes to filtered frames + reads ones it displays from engine
+        self.engine = None # acquisitionEngine, once camera is open
+        
+        self.lastSeq = None # Sequence number of most recent filtered frame
+        self.shownSeq = None # Sequence number of frame currently displayed
+        self.display = frameDisplay(648, 486) # Frame -> Tk image, sized to imgFrame
         
         self.parent.geometry("900x600") # Window size
         self.parent.title('Surgery recorder') # Window title
@@ -153,6 +174,14 @@ class vidRecorder:
         self.img = tk.PhotoImage(file=str(self.iconsPath / "logo.png")) # Init image for canvas     
         self.label = tk.Label(self.imgCanvas, image = self.img, width = 648, height = 486) # Label goes in canvas
         self.label.pack(fill = tk.BOTH, expand = tk.YES, anchor = tk.CENTER)
+        # Display size is recomputed only when window changes
+        self.imgFrame.bind('<Configure>', lambda event: self.display.setWindowSize(event.width, event.height))
+        
+        # Performance overlay. Placed over image by togglePerfOverlay()
+        self.perfLabel = tk.Label(self.imgFrame, text = '', font = ('Courier', 9), 
+                                  justify = tk.LEFT, bg = 'black', fg = 'lime')
+        self.parent.bind('<F2>', self.togglePerfOverlay)
+        self.parent.bind('<F3>', self.savePerfTrace)
 
         self.scopeFrame = tk.Frame(self.parent, height = 486, width = 200, relief = 'raised', borderwidth = 1)
         
@@ -216,7 +245,8 @@ class vidRecorder:
         if not(self.demoMode): # If self.demoMode = True, then don't try to launch camera
         
             # Alias camera            
-            self.camera = cam.camera()
+            self.camera = openCamera('synthetic' if self.simulateHardware else cameraBackend, cameraID)
+            self.cameraCapabilities = self.camera.capabilities()
             # Set camIDLabel string to show connected camera name + ID
             self.camIDstring = "{} - {}".format(self.camera.camName, self.camera.camID) # sprintf camera ID 
             self.camIDLabel['text'] = self.camIDstring
@@ -224,6 +254,16 @@ class vidRecorder:
             # Method to set camera parameters from cameraParameters dict 
             self.camera.setParameters(self.cameraParameters)
             
+            # Streaming, recording + snaps. Shares GUI timer for overlay / trace.
+            self.engine = acquisitionEngine(self.camera, 
+                                            self.scope,
+                                            {'calibrationPath' : self.calibrationPath,
+                                             'darkFrames' : self.darkFrames},
+                                            stageState = self.stageState,
+                                            timer = self.timer)
+            self.engine.subscribe(self.frameFiltered)
+            self.updateEngineParameters()
+            
             # Zero lens
             self.scope.lensAllIn()
             self.cameraParameters['lensPosition'] = 0
@@ -334,6 +374,28 @@ class vidRecorder:
         self.rotateText = tk.Label(self.scopeFrame, text = "-- Spin --")
         self.rotateText.place(x = 98, y = 440)
         
+        # Manual moves, locked out while sweep / autofocus drive the stage
+        self.stageButtons = (self.outFastButton, self.outSlowButton, self.inSlowButton, self.inFastButton,
+                             self.leftFastButton, self.leftSlowButton, self.rightSlowButton, self.rightFastButton)
+        
+        # Sweep button. Push again to abort.
+        self.sweepButton = ttk.Button(self.scopeFrame, text = "Sweep", command = self.doSweep)
+        self.sweepButton.place(x = 12, y = 500)
+        
+        self.sweepStatusText = tk.Label(self.scopeFrame, text = "")
+        self.sweepStatusText.place(x = 100, y = 503)
+        
+        # Autofocus button. Push again to abort.
+        self.autofocusButton = ttk.Button(self.scopeFrame, text = "Autofocus", command = self.doAutofocus)
+        self.autofocusButton.place(x = 12, y = 540)
+        
+        self.autofocusStatusText = tk.Label(self.scopeFrame, text = "")
+        self.autofocusStatusText.place(x = 100, y = 543)
+        
+        # Live focus metric of displayed frame
+        self.focusText = tk.Label(self.scopeFrame, text = "Focus : --")
+        self.focusText.place(x = 12, y = 270)
+        
         
         return
         
@@ -381,18 +443,32 @@ class vidRecorder:
     def rotateButtonPush(self, button):
         if (button == 'leftFast'):
             self.scope.spinMotor(self.cameraParameters['spin_bigStep'])
+            self.cameraParameters['rotationPosition'] += self.cameraParameters['spin_bigStep']
             
         elif (button == 'leftSlow'):
             self.scope.spinMotor(self.cameraParameters['spin_smallStep'])
+            self.cameraParameters['rotationPosition'] += self.cameraParameters['spin_smallStep']
             
         elif (button == 'rightSlow'):
             self.scope.spinMotor(-self.cameraParameters['spin_smallStep'])    
+            self.cameraParameters['rotationPosition'] += -self.cameraParameters['spin_smallStep']
             
         elif (button == 'rightFast'):
             self.scope.spinMotor(-self.cameraParameters['spin_bigStep'])
+            self.cameraParameters['rotationPosition'] += -self.cameraParameters['spin_bigStep']
         
         return
     
+    def stageState(self):
+        """
+        Current exposure + stage positions as dict
+        Recorded with each frame written to disk
+        """
+        return {'exposureTime' : self.cameraParameters['exposureTime'],
+                'lensPosition' : self.cameraParameters['lensPosition'],
+                'rotationPosition' : self.cameraParameters['rotationPosition'],
+                'laserPower' : self.cameraParameters['laserPower']}
+    
     def lensPushButton(self, button):   
         if (button == 'outFast'):
             self.scope.setFocus(int(self.cameraParameters['lens_bigStep']))
@@ -422,9 +498,17 @@ class vidRecorder:
         if self.cameraAcquiring:
             self.stopStream() # Local stopStream method to close out acqusition
             
-        if hasattr(self, 'serial'):
+        if hasattr(self, 'scope'):
+            self.scope.close() # Flush queued commands, stop workers, close port
+        elif hasattr(self, 'serial'):
             self.serial.close()
             
+        if self.engine is not None:
+            self.engine.close() # Finish writer, stop filter threads, free filtered frame buffer
+        
+        if hasattr(self, 'camera'):
+            self.camera.close() # Disconnect, free shared memory
+            
         self.parent.destroy() # Close main window
         
         return
@@ -441,7 +525,7 @@ class vidRecorder:
         """
         # Launch options page
         self.optWindow = tk.Tk()
-        self.optWindow.geometry("400x300")
+        self.optWindow.geometry("400x340")
         self.optWindow.title("Settings")
         
         # Option window frame
@@ -467,6 +551,19 @@ class vidRecorder:
                                     width = 47)
         self.pathTextBox.place(x = 100, y = 33)
         
+        # Record format select
+        self.formatString = tk.StringVar(self.optWindow)
+        self.formatString.set(self.recordFormat)
+        self.formatBox = ttk.Combobox(self.optWindow,
+                                      textvariable = self.formatString,
+                                      values = streamFormats,
+                                      state = 'readonly',
+                                      width = 10)
+        self.formatBox.place(x = 100, y = 83)
+        # Text label for record format
+        self.formatText = tk.Label(self.optWindow, text = "Record format :")
+        self.formatText.place(x = 10, y = 83)
+        
         '''
         # Exposure auto bool
         self.autoExpBoolVar = tk.BooleanVar(self.optWindow)
@@ -515,9 +612,59 @@ class vidRecorder:
         self.gainValueText = tk.Label(self.optWindow, text = "Gain (dB) :")
         self.gainValueText.place(x = 180, y = 153)
         
+        # Hot pixel correction select
+        self.hotPixelString = tk.StringVar(self.optWindow)
+        self.hotPixelString.set(self.cameraParameters['hotPixelCorrection'])
+        self.hotPixelBox = ttk.Combobox(self.optWindow,
+                                        textvariable = self.hotPixelString,
+                                        values = ['median', 'map'],
+                                        state = 'readonly',
+                                        width = 10)
+        self.hotPixelBox.place(x = 100, y = 200)
+        # Text label for hot pixel correction
+        self.hotPixelText = tk.Label(self.optWindow, text = "Hot pixels :")
+        self.hotPixelText.place(x = 10, y = 200)
+        
+        # Dark calibration button. Cover camera first.
+        self.darkCalButton = ttk.Button(self.optWindow, text = "Dark calibration", command = self.calibrateHotPixels)
+        self.darkCalButton.place(x = 200, y = 198)
+        
+        # Binning select. Done on camera if it can, otherwise in software.
+        self.binningString = tk.StringVar(self.optWindow)
+        self.binningString.set(str(self.cameraParameters['binning']))
+        self.binningBox = ttk.Combobox(self.optWindow,
+                                       textvariable = self.binningString,
+                                       values = ['1', '2', '4'],
+                                       state = 'readonly',
+                                       width = 10)
+        self.binningBox.place(x = 100, y = 240)
+        # Text label for binning
+        self.binningText = tk.Label(self.optWindow, text = "Binning :")
+        self.binningText.place(x = 10, y = 240)
+        
+        # Crop ROI bool + ROI as x, y, w, h
+        self.cropROIBoolVar = tk.IntVar(self.optWindow)
+        self.cropROIBoolVar.set(self.cameraParameters['cropROI'])
+        self.cropROICheckbox = tk.Checkbutton(self.optWindow, 
+                                              text = 'Crop ROI', 
+                                              variable = self.cropROIBoolVar, 
+                                              command = self.cropROICheckAction)
+        self.cropROICheckbox.place(x = 10, y = 270)
+        
+        roi = self.cameraParameters['roi']
+        self.roiString = tk.StringVar(self.optWindow)
+        self.roiString.set('' if roi is None else ', '.join(str(v) for v in roi))
+        self.roiBox = ttk.Entry(self.optWindow, 
+                                width = 20,
+                                textvariable = self.roiString)
+        self.roiBox.place(x = 250, y = 273)
+        # Text label for ROI
+        self.roiText = tk.Label(self.optWindow, text = "x, y, w, h :")
+        self.roiText.place(x = 180, y = 273)
+        
         # Call check actions to init enable/disable status from checkboxes 
         self.autoGainCheckAction()
-        self.autoExCheckAction()
+        self.cropROICheckAction()
         
         self.optWindow.mainloop() # Main loop of options window
         
@@ -537,6 +684,26 @@ class vidRecorder:
             self.gainValueBox.configure(state = tk.NORMAL)
         return
     
+    def cropROICheckAction(self):
+        """
+        ROI box only used w/ Crop ROI checked
+        """
+        if self.cropROIBoolVar.get():
+            self.roiBox.configure(state = tk.NORMAL)
+        else:
+            self.roiBox.configure(state = tk.DISABLED)
+        return
+    
+    def roiFromString(self, roiString):
+        """
+        'x, y, w, h' -> tuple of ints
+        Returns None if string isn't a valid ROI
+        """
+        try:
+            return sensorGeometry.checkROI([int(v) for v in roiString.replace(',', ' ').split()])
+        except ValueError:
+            return None
+    
     def autoExCheckAction(self):
         """
         If checkbox is enabled, then text box is disabled + ignored
@@ -598,21 +765,59 @@ class vidRecorder:
         # Called w/ OK button
         # Only function that sets these parameters from options
         
-        self.cameraParameters['autoExposure'] = self.autoExpBoolVar.get()
         self.cameraParameters['autoGain'] = self.autoGainBoolVar.get()
         self.cameraParameters['exposureTime'] = float(self.expValueFromBox.get())
         self.cameraParameters['gainValue'] = float(self.gainValueFromBox.get())
         
+        # ROI + binning. Frame buffers, display + writer follow new frame size.
+        self.cameraParameters['binning'] = int(self.binningString.get())
+        if self.cropROIBoolVar.get():
+            roi = self.roiFromString(self.roiString.get())
+            if roi is None:
+                print('ROI must be x, y, width, height; keeping full chip')
+            self.cameraParameters['roi'] = roi
+            self.cameraParameters['cropROI'] = roi is not None
+        else:
+            self.cameraParameters['cropROI'] = False
+        
         # Send values to camera
         if not(self.demoMode):
             self.camera.setParameters(self.cameraParameters)
         
         
         self.pathForSaving = pathlib.Path(self.pathEntryString.get())
+        self.recordFormat = self.formatString.get()
+        self.cameraParameters['hotPixelCorrection'] = self.hotPixelString.get()
         
         self.optWindow.destroy()
         return
         
+    def updateEngineParameters(self):
+        '''
+        Copy filter + output settings from GUI to acquisition engine
+        '''
+        self.engine.params.update({'medianFilterSize' : self.cameraParameters['medianFilterSize'],
+                                   'hotPixelCorrection' : self.cameraParameters['hotPixelCorrection'],
+                                   'exposureTime' : self.cameraParameters['exposureTime'],
+                                   'format' : self.recordFormat})
+        return
+    
+    def calibrateHotPixels(self):
+        '''
+        Build hot + dead pixel map from darkFrames frames and cache it
+        
+        Laser is switched off for the dark frames. Cover the camera first.
+        Map is for the current exposure; calibrate again after changing it.
+        '''
+        if self.demoMode or self.cameraAcquiring:
+            print('Stop Live/Record before dark calibration')
+            return
+        
+        self.updateEngineParameters()
+        self.engine.calibrateHotPixels()
+        
+        return
+    
     def savePath(self):
         # Prompt for path to folder for saving recorded vids
         self.savePathSelect = filedialog.askdirectory()
@@ -656,155 +861,86 @@ class vidRecorder:
         return
     
 
-    def imageResize(self, img):
-        '''
-        Resize images for display in GUI
-        Set so whichever dim is farther away from window
-        size is the one to scale arbitrarily.  The 'closer' dim
-        is set to window size on that axis. 
-        '''
-        
-        # img is PIL Image object w/ height and width attributes
-        
-        winWidth = self.imgFrame.winfo_width()
-        winHeight = self.imgFrame.winfo_height()
-        
-        imgHeight = img.height
-        imgWidth = img.width
-        
-        # Make width of image equal width of window
-        # Height is whatever is proportional to fit
-        
-        deltaW = winWidth/imgWidth
-        deltaH = winHeight/imgHeight
-        
-        if deltaW > deltaH:
-            # Shrink on height more than width
-            newHeight = winHeight
-            newWidth = int(imgWidth*deltaH)
-        else:
-            # Shrink width more than height
-            newWidth = winWidth
-            newHeight = int(imgHeight*deltaW)
-
-        
-        return newWidth, newHeight
-        
-        
-
     def showLastFrame(self):
         '''
-        Display routine for frame in self.rawFrame
+        Display routine for frame self.lastSeq
         This is ~last frame in queue
         
-        Median filter applied to remove hot pixels
-        Img resized 
-        Resized image in frame label
+        Most recent frame read in place from engine's filtered frameBuffer
+        (already median filtered to remove hot pixels)
+        Img downsampled to fit window + pasted into persistent Tk image
+        (see frameDisplay)
+        
+        Only redraws if a newer frame has arrived since last call
+        Re-called at most displayMaxFps times per second while streaming
         '''
+        lastSeq = self.lastSeq # Local copy; frameFiltered() updates this
         
-        if not(self.rawFrame is None): # Frame exists to show
-            # Median blur to remove hot pixels
-            cvImg = medianBlur(self.rawFrame, self.cameraParameters['medianFilterSize'])[:,:,::-1]
-            
-            # Convert to PIL image
-            filtImg = Image.fromarray(cvImg)
-            
-            # Resize to fit in frame window w/ shape preserved
-            nW, nH = self.imageResize(filtImg) # Get bounds            
-            resizeImg = filtImg.resize((nW, nH)) # Apply bounds
-            
-            # Convert to TK format
-            self.img = ImageTk.PhotoImage(image = resizeImg)
+        if not(lastSeq is None) and (lastSeq != self.shownSeq):
+            t1 = time.monotonic()
             
-            # Display it
-            self.label.configure(image = self.img)
-            
-        else:
-            pass
+            # View into shared memory; only the downsampled copy is made
+            frame = self.engine.readFrame(lastSeq, copy = False)
+            if not(frame is None):
+                self.shownSeq = lastSeq
+                
+                # Tk image updated in place. New image only on first frame / resize.
+                photo, isNew = self.display.update(frame)
+                if isNew:
+                    self.img = photo
+                    self.label.configure(image = self.img)
+                
+                self.timer.record('display', self.shownSeq, t1)
+                
+                if (t1 - self.lastFocusUpdate) > self.focusInterval:
+                    self.updateFocusMetric(frame)
+        
+        if self.showPerfOverlay:
+            self.updatePerfOverlay()
+
+        if self.recButtonState and (self.engine.checkWriter() is not None):
+            # Writer process died; end recording + show why
+            self.doRecord(self.recButton)
+            self.camIDLabel['text'] = "{} | Recording failed : {}".format(self.camIDstring, self.engine.writerError)
+            return
+
+        if self.camera.isStreaming and ((time.monotonic() - self.lastCountsUpdate) > 1):
+            self.showFrameCounts() # Measured rate drops as soon as pipeline holds camera back
 
         if self.camera.isStreaming: 
-            # If streaming, call this function again in 10 milliseconds
-            self.streamAfterID = self.label.after(10, self.showLastFrame)
+            # If streaming, call this function again at display rate cap
+            self.streamAfterID = self.label.after(int(1000/self.displayMaxFps), self.showLastFrame)
         
         return
         
-    def prepForSaving(self):
+    def updateFocusMetric(self, frame):
         '''
-        Set up paths + threads for streaming vid to disk
-        
-        Pull some parameters from camera
-        Generate unique file path
-        Initialize saveThread process
-        
+        Show focus metric of frame (on small binned copy, ~ms)
         '''
-        if self.verbose:
-            print("Record preparation")
-            
-        # Pull camera parameters relevant for video display
-        self.frameRate = self.camera.queryProperty('fps')
-        self.frameWidth = self.camera.queryProperty('width') 
-        self.frameHeight = self.camera.queryProperty('height')
-      
-        # Generate a unique file name for saving
-        # Going to be video_0000.avi, with trailing integers incremented until unique
-        x = 0
-        checkFileName = self.pathForSaving / 'video_{:04d}.avi'.format(x)
-        while (checkFileName.exists()):
-            # If file with that name exists, increment suffix
-            x = x + 1
-            checkFileName = self.pathForSaving / 'video_{:04d}.avi'.format(x)
-            
-        self.saveFileName = checkFileName
-        
-        if self.verbose:
-            print("Saving to : {}".format(self.saveFileName))
-        
-        # Init saveThread process
-        # Calls writeVideo() to write data to disk from saveQueue
-        self.saveThreadActive = True
-        self.saveThread = multiprocessing.Process(target = writeVideo, args=(self.saveQueue, {'fileName' : str(self.saveFileName),
-                                                                                              'frameRate' : self.frameRate, 
-                                                                                              'size' : (self.frameHeight, self.frameWidth)}))
-        self.saveThread.daemon = True
-        self.saveThread.start()
-        
-        if self.verbose:
-            print("Record preparation complete!")
+        value = focusMetric(frame, 
+                            self.autofocusParameters['metric'], 
+                            self.autofocusParameters['roi'])
+        self.focusText['text'] = 'Focus : {:.4g}'.format(value)
+        self.lastFocusUpdate = time.monotonic()
         
         return
+        
+    def uniqueFileName(self, prefix, extension):
+        '''
+        Generate a unique file name for saving in pathForSaving
+        Going to be prefix_0000.avi (or .npy, .tif, ...), with trailing integers incremented until unique
+        '''
+        return uniqueFileName(self.pathForSaving, prefix, extension)
     
-
-    
-    def pullAndQueue(self):
+    def frameFiltered(self, seq, record):
         '''
-        Pull from camera queue, put in display and saveQueue
-
+        Engine subscriber, once per filtered frame in acquisition order
+        Runs in engine's preprocessor thread, so only notes frame.
+        showLastFrame() picks it up at display rate.
         '''
-        if not(self.camera.frameQueue.empty()):
-
-            # Pull most recent frame from camera queue 
-            # self.rawFrame is frame to display in GUI
-            # Will be most recent frame acquired unless another frame 
-            # arrives between showLastFrame() calls
-            self.rawFrame = self.camera.frameQueue.get()
-        
-            if self.verbose:
-                print(self.rawFrame)
-                
-            if self.isRecording: # If in 'Record' mode
-                if not(self.saveQueue.full()): # Queue has space, otherwise error
-                    
-                    if self.verbose:
-                        print("Add to saveQueue")
-
-                    # Apply median filter, as in display, and add to saveQueue
-                    # nb - all frames make it here.  Not all make it to GUI display, depending on timing
-                    self.saveQueue.put(medianBlur(self.rawFrame.as_opencv_image(), self.cameraParameters['medianFilterSize']))
-                else:
-                    print('Full queue!')
-                    
-        if self.camera.isStreaming: # If streaming, call this again in 5 ms
-            self.streamAfterID = self.label.after(5, self.pullAndQueue)
+        # self.lastSeq is frame to display in GUI
+        # Will be most recent frame filtered
+        self.lastSeq = seq
                 
         return
         
@@ -814,34 +950,76 @@ class vidRecorder:
         
         Coordinates other function calls to init video streaming.
         record is bool for Record mode (True) or Live mode (False)
+        Returns True if stream started. A recording starts in own thread,
+        since engine waits for first frames; checkRecordStart() finishes
+        it. If it can't start (eg no frames from camera) buttons are put
+        back as they were + error shown.
         '''
         if self.verbose:
             print("Start stream!")
 
         self.cameraAcquiring = True # Set flag
+        self.updateEngineParameters()
 
         if record: # In 'Record' mode
             if self.verbose:
                 print("Recording!")
             
-            self.liveButton['state'] = 'disabled' # Lock out other buttons
-            self.prepForSaving() # Set up save stream
-            self.isRecording = True # Flag
+            # Lock out other buttons. Record too, until recording has started.
+            for button in (self.liveButton, self.recButton, self.optionsButton, self.snapButton):
+                button['state'] = 'disabled'
+            
+            fileName = self.uniqueFileName('video', writerBackends[self.recordFormat].extension)
+            self.recordError = None
+            self.recordThread = threading.Thread(target = self.startRecording, args = (fileName,), daemon = True)
+            self.recordThread.start()
+            self.checkRecordStart()
 
         else:
             
             self.recButton['state'] = 'disabled'# Disable other buttons
-            self.isRecording = False # flag
+            self.engine.start()
         
-
-        self.camera.startStream() # Call camera's startStream method
-        self.pullAndQueue() # Sort incoming frames into local queues
+            self.showLastFrame() # Display
+            self.optionsButton['state'] = 'disabled' # Lock out other buttons
+            self.snapButton['state'] = 'disabled'
+            
+        return True
+    
+    def startRecording(self, fileName):
+        '''
+        Recording start thread. Error kept for checkRecordStart().
+        '''
+        try:
+            self.saveFileName = self.engine.record(fileName)
+        except (RuntimeError, ValueError) as e:
+            self.recordError = e # Engine has already stopped camera
+        return
+    
+    def checkRecordStart(self):
+        '''
+        Re-called every 100 ms until recording has started (or failed)
+        '''
+        if self.recordThread.is_alive():
+            self.label.after(100, self.checkRecordStart)
+            return
+        
+        if self.recordError is not None:
+            self.cameraAcquiring = False
+            self.recButtonState = False
+            self.recButton.configure(relief = "raised")
+            for button in (self.liveButton, self.recButton, self.optionsButton, self.snapButton):
+                button['state'] = 'active'
+            self.camIDLabel['text'] = "{} | Recording failed : {}".format(self.camIDstring, self.recordError)
+            print('Recording failed : {}'.format(self.recordError))
+            return
+        
+        if self.verbose:
+            print("Saving to : {}".format(self.saveFileName))
+        
+        self.recButton['state'] = 'active' # Now stops recording
         self.showLastFrame() # Display
-        self.optionsButton['state'] = 'disabled' # Lock out other buttons
-        self.snapButton['state'] = 'disabled'
         
-
-            
         return
         
     def stopStream(self, record = False):
@@ -858,7 +1036,8 @@ class vidRecorder:
         
         self.cameraAcquiring = False # Flag
         
-        self.camera.stopStream() # Camera's stop video streaming method
+        self.engine.stop() # Every acquired frame filtered + queued for writer on return
+        self.showFrameCounts() # Report lost frames for this stream
         
         self.optionsButton['state'] = 'active' # Reset button
         self.snapButton['state'] = 'active' # Reset button
@@ -866,11 +1045,6 @@ class vidRecorder:
         if record:
             if self.verbose:
                 print("Stop recording!")
-            
-                
-            self.saveThreadActive = False # Flag
-            self.saveQueue.put(None) # Add None object to signal end of queue
-
 
             self.liveButton['state'] = 'active' # Reset button
             
@@ -881,6 +1055,73 @@ class vidRecorder:
             
         return
     
+    def drainTrace(self):
+        '''
+        Move timing events sent by writer process into timer
+        '''
+        if self.engine is not None:
+            self.engine.drainTrace()
+        return
+    
+    def updatePerfOverlay(self):
+        '''
+        Refresh per-stage stats text over image, at most twice a second
+        '''
+        now = time.monotonic()
+        if (now - self.lastOverlayUpdate) < 0.5:
+            return
+        self.lastOverlayUpdate = now
+        
+        self.drainTrace()
+        self.perfLabel['text'] = self.timer.overlayText()
+        
+        return
+    
+    def togglePerfOverlay(self, event = None):
+        '''
+        Show/hide per-stage timing overlay (F2)
+        '''
+        self.showPerfOverlay = not(self.showPerfOverlay)
+        
+        if self.showPerfOverlay:
+            self.lastOverlayUpdate = 0
+            self.updatePerfOverlay()
+            self.perfLabel.place(x = 4, y = 4)
+        else:
+            self.perfLabel.place_forget()
+            
+        return
+    
+    def savePerfTrace(self, event = None):
+        '''
+        Write timing trace of current/last stream to pathForSaving (F3)
+        '''
+        self.drainTrace()
+        fileName = self.timer.exportTrace(self.uniqueFileName('trace', self.perfTraceFormat))
+        
+        if self.verbose:
+            print("Timing trace saved to : {}".format(fileName))
+            
+        return
+    
+    def showFrameCounts(self):
+        '''
+        Put camera acquired/delivered/dropped frame counts + measured fps in camIDLabel
+        '''
+        counts = self.engine.frameCounts()
+        fps = self.camera.measuredFrameRate()
+        
+        self.camIDLabel['text'] = "{} | acquired {} - delivered {} - dropped {} | {} fps".format(self.camIDstring,
+                                                                                                 counts['acquired'],
+                                                                                                 counts['delivered'],
+                                                                                                 counts['dropped'],
+                                                                                                 '-' if fps is None else '{:.1f}'.format(fps))
+        self.lastCountsUpdate = time.monotonic()
+        if self.verbose:
+            print(counts)
+        
+        return
+    
     def doRecord(self, buttonPushed):
         '''
         Record button pushed
@@ -895,17 +1136,150 @@ class vidRecorder:
             if self.recButtonState:
                 buttonPushed.configure(relief = "raised")
                 self.stopStream(record = True)
+                self.recButtonState = False
             else:
                 buttonPushed.configure(relief = "sunken")
-                self.startStream(record = True)
-            
-            self.recButtonState = not(self.recButtonState)
+                self.recButtonState = True
+                self.startStream(record = True) # Raises button again if recording doesn't start
         # Start video stream and post to GUI AND save to disk
         if self.verbose:
             print("Record!")
         
         return
     
+    def doSweep(self):
+        '''
+        Sweep button pushed
+        
+        Start Z-stack / angle sweep from sweepParameters in own thread
+        Push again while running to abort after current position
+        '''
+        if self.demoMode:
+            return
+        
+        if (self.sweep is not None) and self.sweep.isRunning:
+            self.sweep.abort()
+            return
+        
+        if self.cameraAcquiring:
+            print('Stop Live/Record before starting a sweep')
+            return
+        
+        fileName = self.uniqueFileName('sweep', writerBackends[self.sweepParameters['format']].extension)
+        
+        # Sweep frames get same hot pixel correction (map or median) as Live/Record
+        self.updateEngineParameters()
+        self.engine.configurePreprocessor()
+        
+        try:
+            self.sweep = sweepAcquisition(self.scope, 
+                                          self.camera,
+                                          self.sweepParameters,
+                                          fileName,
+                                          startPositions = self.stageState(),
+                                          preprocessor = self.engine.preprocessor)
+        except ValueError as e:
+            self.sweep = None
+            self.sweepStatusText['text'] = 'Bad sweep'
+            print('Sweep not started : {}'.format(e))
+            return
+        
+        # Lock out other acquisition buttons while sweep runs
+        for button in (self.liveButton, self.recButton, self.snapButton, self.optionsButton) + self.stageButtons:
+            button['state'] = 'disabled'
+        self.sweepButton.configure(text = 'Abort')
+        
+        if self.verbose:
+            print("Sweep to : {}".format(fileName))
+        
+        self.sweep.start()
+        self.checkSweep()
+        
+        return
+    
+    def checkSweep(self):
+        '''
+        Update sweep progress in GUI. Re-called every 500 ms until sweep is done.
+        '''
+        nDone, nTotal = self.sweep.progress()
+        self.sweepStatusText['text'] = "{} / {}".format(nDone, nTotal)
+        
+        if self.sweep.isRunning or (self.sweep.thread.is_alive()):
+            self.label.after(500, self.checkSweep)
+        else:
+            # Stage ends wherever sweep left it
+            self.cameraParameters['lensPosition'] = self.sweep.lensPosition
+            self.cameraParameters['rotationPosition'] = self.sweep.rotationPosition
+            self.lensPositionText['text'] = 'Lens @ {}'.format(self.cameraParameters['lensPosition'])
+            
+            for button in (self.liveButton, self.recButton, self.snapButton, self.optionsButton) + self.stageButtons:
+                button['state'] = 'active'
+            self.sweepButton.configure(text = 'Sweep')
+            
+            if self.sweep.error is not None:
+                self.sweepStatusText['text'] = "Failed @ {} / {}".format(nDone, nTotal)
+                print('Sweep failed : {}'.format(self.sweep.error))
+            
+        return
+    
+    def doAutofocus(self):
+        '''
+        Autofocus button pushed
+        
+        Coarse-to-fine search of excitation lens for sharpest image, in own thread
+        Lens is parked at best position. Push again to abort (lens goes back).
+        '''
+        if self.demoMode:
+            return
+        
+        if (self.autofocusRun is not None) and self.autofocusRun.thread.is_alive():
+            self.autofocusRun.abort()
+            return
+        
+        if self.cameraAcquiring or ((self.sweep is not None) and self.sweep.isRunning):
+            print('Stop Live/Record/Sweep before autofocus')
+            return
+        
+        self.autofocusRun = autofocus(self.scope, 
+                                      self.camera,
+                                      self.autofocusParameters,
+                                      startPosition = self.cameraParameters['lensPosition'])
+        
+        # Lock out other acquisition buttons while search runs
+        for button in (self.liveButton, self.recButton, self.snapButton, self.optionsButton, self.sweepButton) + self.stageButtons:
+            button['state'] = 'disabled'
+        self.autofocusButton.configure(text = 'Abort')
+        
+        self.autofocusRun.start()
+        self.checkAutofocus()
+        
+        return
+    
+    def checkAutofocus(self):
+        '''
+        Update autofocus progress in GUI. Re-called every 200 ms until search is done.
+        '''
+        nDone, nTotal = self.autofocusRun.progress()
+        
+        if self.autofocusRun.thread.is_alive():
+            self.autofocusStatusText['text'] = "{} / {}".format(nDone, nTotal)
+            self.label.after(200, self.checkAutofocus)
+        else:
+            self.cameraParameters['lensPosition'] = self.autofocusRun.lensPosition
+            self.lensPositionText['text'] = 'Lens @ {}'.format(self.cameraParameters['lensPosition'])
+            if self.autofocusRun.bestPosition is None:
+                self.autofocusStatusText['text'] = "Failed" # Exception in search thread
+                print('Autofocus failed : {}'.format(self.autofocusRun.error))
+            else:
+                self.autofocusStatusText['text'] = "Best {} ({:.1f} s)".format(self.autofocusRun.bestPosition,
+                                                                            self.autofocusRun.elapsed)
+            
+            for button in (self.liveButton, self.recButton, self.snapButton, self.optionsButton, self.sweepButton) + self.stageButtons:
+                button['state'] = 'active'
+            self.autofocusButton.configure(text = 'Autofocus')
+            
+        return
+    
     def doSnap(self):
         '''
         Snap button pushed
@@ -916,7 +1290,7 @@ class vidRecorder:
             
         newImgOnSnap - bool
             True - call snapImage() to get image from camera
-            False - (unimplemented) Use self.rawFrame as last image
+            False - (unimplemented) Use last displayed frame as last image
             
         saveOnSnap - bool
             True - call file_save() to prompt for path and save image
@@ -938,14 +1312,19 @@ class vidRecorder:
     def snapImage(self):
         '''Single frame capture
         
-        Frame captured from camera goes into camera queue
+        Frame captured from camera goes through engine's preprocessor 
+        (hot pixel filter) like streamed frames
         Call showLastFrame() to display most recent frame
             nb - stream flag not set so showLastFrame() should not get 
             recall enabled 
+            
+        If snapFrames > 1, snapFrames filtered frames are combined 
+        in compositeFrame (float32) as they are grabbed. Last frame is displayed.
         ''' 
+        self.updateEngineParameters()
         
-        self.camera.snap()
-        
+        seq, self.compositeFrame = self.engine.snap(self.snapFrames, self.snapAccumulate)
+            
         self.showLastFrame()        
 
         return
@@ -954,14 +1333,27 @@ class vidRecorder:
     def file_save(self):
         '''
         Save last displayed frame
+        
+        If last Snap made a composite, save that instead as 32-bit float .tif
         '''
         
+        if self.compositeFrame is not None:
+            f = filedialog.asksaveasfile(mode='w', defaultextension=".tif") # Prompt file dialog
+            if f is None: # asksaveasfile return `None` if dialog closed with "cancel".
+                return
+            # Composite is already filtered frame by frame
+            imwrite(f.name, self.compositeFrame) # Write to disk
+            return
+        
         f = filedialog.asksaveasfile(mode='w', defaultextension=".png") # Prompt file dialog
         if f is None: # asksaveasfile return `None` if dialog closed with "cancel".
             return
         # Img to save is last frame from queue through showLastFrame()
-        # Convert, do median blur
-        img = medianBlur(self.rawFrame.as_opencv_image(), self.cameraParameters['medianFilterSize']) 
+        # Already median filtered by preprocessor
+        img = self.engine.readFrame(self.shownSeq)
+        if img is None:
+            print('Frame {} no longer in buffer'.format(self.shownSeq))
+            return
         imwrite(f.name, img) # Write to disk
         return
     
@@ -969,6 +1361,15 @@ class vidRecorder:
 
 if __name__ == "__main__":
     
+    # Override hardware constants above w/o editing file
+    # Unattended runs w/o GUI : see cheesoSPIM_gui.batchRun
+    parser = argparse.ArgumentParser(description = 'cheesoSPIM recorder GUI')
+    parser.add_argument('--port', default = scopePort, help = 'scope serial port')
+    parser.add_argument('--camera', type = int, default = cameraID, help = 'camera index')
+    parser.add_argument('--backend', default = cameraBackend, help = 'camera backend')
+    args = parser.parse_args()
+    scopePort, cameraID, cameraBackend = args.port, args.camera, args.backend
+    
     root = tk.Tk()
     vidRec = vidRecorder(root)
     root.mainloop()
\ No newline at end of file
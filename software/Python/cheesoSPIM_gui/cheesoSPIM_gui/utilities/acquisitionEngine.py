@@ -0,0 +1,611 @@
+# -*- coding: utf-8 -*-
+"""
+Headless acquisition engine
+
+Everything between the camera and disk, w/o any GUI:
+    camera -> frameQueue -> routing thread -> framePreprocessor (hot pixels)
+    -> subscribers + saveQueue -> writeVideo process
+
+Plain Python API:
+    engine = acquisitionEngine(camera, scope)
+    engine.subscribe(callback) # callback(seq, record) per filtered frame
+    engine.start() # Live: newest frames, old ones dropped if behind
+    engine.record(fileName) # Record: camera held back rather than lose frames
+    engine.stop()
+    seq, composite = engine.snap()
+    engine.close()
+
+Frames stay in shared memory; subscribers get sequence number +
+frameRecord (capture timestamp, stage state) and read the frames they
+want w/ readFrame(seq). Subscribers are called on the
+preprocessor's thread in acquisition order, so they should only note
+the frame and return (eg the GUI keeps the newest seq and redraws at
+its own rate).
+
+@author: rusty
+"""
+
+import atexit
+import multiprocessing
+import pathlib
+import queue
+import threading
+import time
+
+from cheesoSPIM_gui.utilities.stageTimer import stageTimer
+from cheesoSPIM_gui.utilities.framePreprocessor import framePreprocessor
+from cheesoSPIM_gui.utilities.frameAccumulator import frameAccumulator
+from cheesoSPIM_gui.utilities.frameWriters import writerBackends, streamFormats, writeVideo
+from cheesoSPIM_gui.utilities import hotPixelMap
+
+
+engineDefaults = {'medianFilterSize' : 3, # pixels, odd. 1 for no filter.
+                  'hotPixelCorrection' : 'median', # 'median' blur, or 'map' to repair only dark-calibrated pixels
+                  'exposureTime' : None, # ms, names hot pixel map cache files
+                  'filterWorkers' : 2, # median filter threads
+                  'saveQueueSize' : None, # frames waiting for writer process. None to fit camera ring buffer, see saveQueueSlots()
+                  'format' : 'avi', # key in frameWriters.streamFormats
+                  'frameRate' : 30, # written to file header if rate can't be measured or read from camera
+                  'rateFrames' : 16, # frames timed before writer is opened w/ measured rate
+                  'rateTimeout' : 1.0, # s to wait for rateFrames once first frame is in
+                  'firstFrameTimeout' : 10, # s to wait for first frame of a recording
+                  'segmentFrames' : 256, # frames per segment file, 'segments' format
+                  'flushInterval' : 2.0, # s between index + manifest flushes, 'segments' format
+                  'calibrationPath' : None, # folder for hot pixel map cache
+                  'darkFrames' : 32} # frames averaged for hot pixel calibration
+
+
+ringMargin = 8 # Spare ring buffer slots beyond every frame that can be in flight
+minSaveQueue = 16 # Shortest saveQueue picked by saveQueueSlots()
+
+
+def saveQueueSlots(camera, preprocessor, saveQueueSize = None):
+    '''
+    saveQueue length that keeps every queued frame in the ring buffers
+
+    A frame waiting for the writer stays readable until the camera has
+    stored nBufferSlots more frames. Ahead of it can be the rest of saveQueue,
+    frames pending in the preprocessor, the camera queue, one frame being
+    captured + one being written.
+    saveQueueSize None takes the ring slots left over (at least minSaveQueue).
+    The camera's ring (nBufferSlots) is grown to fit if needed; call before streaming.
+    '''
+    inFlight = camera.frameQueue.maxsize + preprocessor.pending.maxsize + 2 + ringMargin
+
+    if saveQueueSize is None:
+        saveQueueSize = max(camera.nBufferSlots - inFlight, minSaveQueue)
+
+    if camera.nBufferSlots < inFlight + saveQueueSize:
+        camera.nBufferSlots = inFlight + saveQueueSize
+        if (camera.frameBuffer is not None) and (camera.frameBuffer.nSlots < camera.nBufferSlots):
+            camera.releaseBuffer() # Reallocated w/ more slots on next frame
+
+    return saveQueueSize
+
+
+def uniqueFileName(path, prefix, extension):
+    '''
+    Unique file name in folder path
+    Going to be prefix_0000.avi (or .npy, .tif, ...), with trailing integers incremented until unique
+    '''
+    path = pathlib.Path(path)
+    x = 0
+    checkFileName = path / '{}_{:04d}{}'.format(prefix, x, extension)
+    while (checkFileName.exists()):
+        # If file with that name exists, increment suffix
+        x = x + 1
+        checkFileName = path / '{}_{:04d}{}'.format(prefix, x, extension)
+
+    return checkFileName
+
+
+class acquisitionEngine():
+    """
+    Stream, record and snap from a camera, w/ or w/o a GUI attached
+    """
+
+    def __init__(self, camera, scope = None, params = None, stageState = None, timer = None):
+        """
+        Arguments:
+            - camera = cameraBase camera
+            - scope = cheesoSPIM_driver, only needed for laser control in calibrateHotPixels()
+            - params = dict, overrides for engineDefaults
+            - stageState = function() -> dict, stage state stored w/ each frame. 
+                           Called per frame by camera, so keep it cheap.
+            - timer = stageTimer to record into. New one if None.
+        """
+        self.camera = camera
+        self.scope = scope
+
+        self.params = dict(engineDefaults)
+        if params is not None:
+            self.params.update(params)
+
+        self.camera.stageState = stageState # Read into each frameRecord at capture
+
+        # Per-stage timing of capture, dequeue, filter (+ display by subscribers) and write
+        self.timer = timer if timer is not None else stageTimer()
+        self.camera.timer = self.timer
+        self.traceQueue = multiprocessing.Queue(maxsize = 100) # Timing events from writer process
+
+        # Hot pixel filter, run once per frame in a thread pool
+        # Subscribers, writer and snap all use its frameBuffer
+        self.preprocessor = framePreprocessor(filterSize = self.params['medianFilterSize'],
+                                              nWorkers = self.params['filterWorkers'],
+                                              callback = self.frameFiltered)
+        self.preprocessor.timer = self.timer
+
+        self.subscribers = [] # function(seq, record), called per filtered frame
+        self.lastSeq = None # Sequence number of most recent filtered frame
+
+        self.isAcquiring = False # Streaming (Live or Record)
+        self.isRecording = False # Streaming to disk
+        self.routeThread = None # Thread running routeFrames() while streaming
+        # Sized so camera can't lap a frame in the ring buffer before it's written
+        self.saveQueue = multiprocessing.Queue(maxsize = saveQueueSlots(self.camera, self.preprocessor, self.params['saveQueueSize']))
+        self.saveProcess = None # writeVideo process while recording + draining
+        self.saveFileName = None
+        self.frameRate = None # Rate written to last recording
+        self.writerDropped = 0 # Frames not queued for writer (saveQueue full)
+        self.writerOverwritten = multiprocessing.Value('q', 0) # Frames overwritten before writer read them, counted by writer process
+        self.writerError = None # str, why writer process ended a recording early
+
+        # Writer isn't a daemon, so interpreter exit waits for it. If this
+        # process exits w/o close() (eg an exception while recording), end the
+        # recording first so writer can drain saveQueue + close the file.
+        self.isClosed = False
+        atexit.register(self.close)
+
+        return
+
+    def subscribe(self, callback):
+        '''
+        Call callback(seq, record) for every filtered frame, record is frameBuffer.frameRecord
+        Runs on preprocessor thread; keep it short.
+        Returns callback, for unsubscribe()
+        '''
+        self.subscribers.append(callback)
+        return callback
+
+    def unsubscribe(self, callback):
+        if callback in self.subscribers:
+            self.subscribers.remove(callback)
+        return
+
+    def readFrame(self, seq, copy = True):
+        '''
+        Filtered frame seq, None if it has been overwritten
+        copy = False returns a view into shared memory; use it straight away.
+        '''
+        if (seq is None) or (self.preprocessor.frameBuffer is None):
+            return None
+
+        return self.preprocessor.frameBuffer.read(seq, copy = copy)
+
+    def latestFrame(self, copy = True):
+        '''
+        Most recent filtered frame, or None
+        '''
+        return self.readFrame(self.lastSeq, copy = copy)
+
+    def frameCounts(self):
+        '''
+        Camera acquired, delivered and dropped frame counts for current / last stream
+        Dropped includes frames overwritten before filtering, and (recording)
+        frames that never reached the file: 'writerDropped' for a full 
+        saveQueue, 'overwritten' for frames lapped before the writer read them.
+        'writerError' is None unless writer process died + recording stopped.
+        '''
+        self.checkWriter()
+        
+        counts = self.camera.frameCounts()
+        counts['writerDropped'] = self.writerDropped
+        counts['writerError'] = self.writerError
+        counts['overwritten'] = self.writerOverwritten.value
+        counts['dropped'] += self.preprocessor.nDropped + counts['writerDropped'] + counts['overwritten']
+
+        return counts
+
+    """
+    Hot pixel correction
+    """
+
+    def hotPixelCacheFile(self, frameShape):
+        '''
+        Cache file for hot pixel map of camera + exposure
+        '''
+        cameraID = "{} - {}".format(self.camera.camName, self.camera.camID)
+        return hotPixelMap.cacheFile(self.params['calibrationPath'],
+                                     cameraID,
+                                     self.params['exposureTime'],
+                                     frameShape)
+
+    def calibrateHotPixels(self):
+        '''
+        Build hot + dead pixel map from darkFrames frames and cache it
+
+        Laser is switched off for the dark frames if there is a scope.
+        Cover the camera first. Map is for the current exposure.
+        Returns map, or None if calibration failed
+        '''
+        if self.isAcquiring:
+            print('Stop streaming before dark calibration')
+            return None
+
+        if self.params['calibrationPath'] is None:
+            print('No calibrationPath to cache hot pixel map in')
+            return None
+
+        if self.scope is not None:
+            self.scope.laserOff()
+            time.sleep(0.5) # Let laser + last exposure finish
+
+        frames = [self.camera.grab() for k in range(self.params['darkFrames'])]
+        frames = [f for f in frames if f is not None]
+
+        if self.scope is not None:
+            self.scope.laserOn()
+
+        try:
+            newMap = hotPixelMap.hotPixelMap.calibrate(frames)
+        except ValueError as e:
+            print('Dark calibration failed : {}'.format(e))
+            return None
+
+        pathlib.Path(self.params['calibrationPath']).mkdir(parents = True, exist_ok = True)
+        newMap.save(self.hotPixelCacheFile(newMap.frameShape))
+
+        self.preprocessor.hotPixels = None # Reloaded from cache on next configurePreprocessor()
+
+        print('Dark calibration : {} hot, {} dead pixels'.format(newMap.nHot, newMap.nDead))
+
+        return newMap
+
+    def configurePreprocessor(self):
+        '''
+        Set hot pixel correction in preprocessor from params
+
+        'map' loads cached map for current camera + exposure.
+        Falls back to median filter if there is none.
+        '''
+        self.preprocessor.filterSize = self.params['medianFilterSize']
+
+        if (self.params['hotPixelCorrection'] != 'map') or (self.params['calibrationPath'] is None):
+            self.preprocessor.hotPixels = None
+            return
+
+        frameBuffer = self.camera.allocateBuffer()
+        if frameBuffer is None:
+            return
+
+        cacheFile = self.hotPixelCacheFile(frameBuffer.frameShape)
+
+        current = self.preprocessor.hotPixels
+        if (current is not None) and (current.fileName == cacheFile):
+            return # Already loaded
+
+        if cacheFile.exists():
+            self.preprocessor.hotPixels = hotPixelMap.hotPixelMap.load(cacheFile)
+        else:
+            print('No hot pixel map for this exposure; using median filter. Run dark calibration.')
+            self.preprocessor.hotPixels = None
+
+        return
+
+    """
+    Streaming
+    """
+
+    def waitForFrames(self):
+        '''
+        Wait for first filtered frame of stream, then up to rateTimeout
+        for rateFrames frames so camera's frame rate estimate has settled.
+        Returns filtered frameBuffer (shaped by first real frame), or None 
+        if no frame arrived in firstFrameTimeout
+        '''
+        t0 = time.monotonic()
+        while self.lastSeq is None:
+            if not(self.camera.isStreaming) or ((time.monotonic() - t0) > self.params['firstFrameTimeout']):
+                return None
+            time.sleep(0.005)
+
+        t0 = time.monotonic()
+        while (self.camera.rateEstimator.count < self.params['rateFrames']) and ((time.monotonic() - t0) < self.params['rateTimeout']):
+            time.sleep(0.005)
+
+        return self.preprocessor.frameBuffer
+
+    def startWriter(self, fileName, fileFormat = None, resume = False):
+        '''
+        Start writeVideo process reading filtered frames from shared memory
+        Called once stream is running; frames filtered before then wait in saveQueue.
+        File is set up from first frames: geometry from frameBuffer they 
+        were stored in, rate measured from their capture timestamps.
+        Returns file name frames are written to, or None if no frames came
+        '''
+        fileFormat = fileFormat if fileFormat is not None else self.params['format']
+
+        # Shared memory writer process will read (filtered) frames from
+        frameBuffer = self.waitForFrames()
+        if frameBuffer is None:
+            return None
+
+        self.frameRate = self.camera.frameRate() # Measured, else reported by camera
+        if self.frameRate is None:
+            self.frameRate = self.params['frameRate'] # Nominal for file header
+        frameHeight, frameWidth = frameBuffer.frameShape[:2]
+
+        self.saveFileName = pathlib.Path(fileName)
+
+        self.saveProcess = multiprocessing.Process(target = writeVideo, args = (self.saveQueue, {'fileName' : str(self.saveFileName),
+                                                                                                 'format' : fileFormat,
+                                                                                                 'frameRate' : self.frameRate,
+                                                                                                 'size' : (frameWidth, frameHeight),
+                                                                                                 'frameBuffer' : frameBuffer.description(),
+                                                                                                 'medianFilterSize' : None, # Already filtered
+                                                                                                 'traceQueue' : self.traceQueue,
+                                                                                                 'overwrittenCount' : self.writerOverwritten,
+                                                                                                 'segmentFrames' : self.params['segmentFrames'],
+                                                                                                 'flushInterval' : self.params['flushInterval'],
+                                                                                                 'resume' : resume}))
+        # Not daemon, so it isn't killed at exit before closing the file
+        # close() (run at exit too) ends the recording; writer also exits if this process dies
+        self.saveProcess.daemon = False
+        self.saveProcess.start()
+
+        return self.saveFileName
+
+    def checkWriter(self):
+        '''
+        Stop recording if writer process has died (eg couldn't open file)
+        Stream carries on as live. Returns writerError, None if writer is fine.
+        '''
+        if self.isRecording and (self.saveProcess is not None) and not(self.saveProcess.is_alive()):
+            self.isRecording = False
+            self.writerError = 'Writer for {} exited (code {}), recording stopped'.format(self.saveFileName, 
+                                                                                         self.saveProcess.exitcode)
+            print(self.writerError)
+            self.saveProcess = None # Nothing to wait for
+            
+            # Nothing will read them; don't leave them for next recording
+            while True:
+                try:
+                    self.saveQueue.get_nowait()
+                except queue.Empty:
+                    break
+                    
+        return self.writerError
+
+    def startStream(self, record = False, fileName = None, fileFormat = None, resume = False):
+        '''
+        Start camera stream + routing thread
+        record = True also starts writer on fileName
+        resume = True appends to existing recording fileName ('segments' format)
+        '''
+        if self.isAcquiring:
+            print('Already streaming')
+            return
+
+        self.timer.reset() # Stats + trace cover this stream only
+        self.preprocessor.nDropped = 0
+        self.writerDropped = 0
+        self.writerOverwritten.value = 0
+        self.writerError = None
+        self.lastSeq = None
+        self.configurePreprocessor()
+
+        if record:
+            self.isRecording = True # Frames go to saveQueue from first one
+            self.camera.setQueuePolicy('block') # Hold camera back rather than lose frames
+        else:
+            self.isRecording = False
+            self.camera.setQueuePolicy('dropOldest') # Live only needs newest frames
+
+        self.isAcquiring = True
+        self.camera.startStream()
+
+        # Sort incoming frames into preprocessor as they arrive
+        self.routeThread = threading.Thread(target = self.routeFrames, daemon = True)
+        self.routeThread.start()
+
+        if record and (self.startWriter(fileName, fileFormat, resume) is None):
+            self.isRecording = False # Nothing in saveQueue + no writer to stop
+            self.stop()
+            raise RuntimeError('No frames from camera in {} s, recording not started'.format(self.params['firstFrameTimeout']))
+
+        return
+
+    def start(self):
+        '''
+        Live stream: frames to subscribers, none to disk
+        '''
+        self.startStream(record = False)
+        return
+
+    def record(self, fileName, fileFormat = None, resume = False):
+        '''
+        Record stream to fileName (extension set by writer backend)
+        resume = True carries on a 'segments' recording cut short, after
+        repairing it (frameWriters.recoverSegments). Starts fresh if there's none.
+        Returns file name
+        '''
+        fileFormat = fileFormat if fileFormat is not None else self.params['format']
+        if fileFormat not in streamFormats:
+            raise ValueError("Can't record a stream as {}. Choose from {}".format(fileFormat, streamFormats))
+        fileName = pathlib.Path(fileName).with_suffix(writerBackends[fileFormat].extension)
+
+        self.startStream(record = True, fileName = fileName, fileFormat = fileFormat, resume = resume)
+
+        return self.saveFileName
+
+    def stop(self, waitForWriter = False):
+        '''
+        Stop stream. Every frame acquired is filtered, handed to subscribers
+        and (recording) queued for the writer before this returns.
+        waitForWriter = True also waits for writer to finish the file.
+        Returns frameCounts()
+        '''
+        if not(self.isAcquiring):
+            return self.frameCounts()
+
+        self.camera.stopStream()
+
+        if self.routeThread is not None:
+            self.routeThread.join() # Let last frames reach preprocessor + saveQueue before closing it
+            self.routeThread = None
+        self.routePending() # Frame stored after routing saw stream stop + empty queue
+        self.preprocessor.flush()
+
+        self.isAcquiring = False
+
+        if self.isRecording:
+            self.isRecording = False
+            self.saveQueue.put(None) # Signal end of recording to writer
+            if waitForWriter:
+                self.waitForWriter()
+
+        return self.frameCounts()
+
+    def waitForWriter(self, timeout = None):
+        '''
+        Wait for writer process to finish last recording
+        Returns True if it has
+        '''
+        if self.saveProcess is None:
+            return True
+
+        self.saveProcess.join(timeout = timeout)
+        if self.saveProcess.is_alive():
+            return False
+
+        self.saveProcess = None
+
+        return True
+
+    def routeFrames(self):
+        '''
+        Frame routing loop. Runs in own thread while streaming.
+
+        Sleeps until camera signals new frame(s), then drains
+        everything queued in one batch with routePending()
+        Exits once stream has stopped and camera queue is empty
+        '''
+        while self.camera.isStreaming or not(self.camera.frameQueue.empty()):
+            if self.camera.newFrame.wait(timeout = 0.5):
+                self.camera.newFrame.clear() # Clear before drain so no frame is missed
+                self.routePending()
+
+        return
+
+    def routePending(self):
+        '''
+        Pull all pending frames from camera queue, send to preprocessor
+
+        Only frameRecords move here. Frame data stays
+        in camera frameBuffer (shared memory) until preprocessor filters it.
+        Filtered frames come back in order through frameFiltered()
+        '''
+        while True:
+            try:
+                # Pull next frame record from camera queue
+                record = self.camera.frameQueue.get_nowait()
+            except queue.Empty:
+                break # Queue drained
+
+            self.timer.dequeued(record.seq) # Time spent waiting in camera queue
+
+            try:
+                # Waits if filter is behind, which backs up camera queue
+                self.preprocessor.submit(self.camera.frameBuffer, record.seq, record)
+            except RuntimeError:
+                break # Filter pool shut down, interpreter is exiting
+
+        return
+
+    def frameFiltered(self, seq, record):
+        '''
+        Preprocessor callback, once per filtered frame in acquisition order
+        Runs in preprocessor thread. Hand frame to subscribers + saveQueue.
+        '''
+        self.lastSeq = seq
+
+        for callback in list(self.subscribers):
+            callback(seq, record)
+
+        if self.isRecording and (self.checkWriter() is None):
+            try:
+                # Add record (seq, capture time, stage state) to saveQueue
+                # Waits for space if writer is behind, which backs up preprocessor + camera queue
+                # nb - all frames make it here. Not all make it to subscribers' displays, depending on timing
+                self.saveQueue.put(record, timeout = 1)
+            except queue.Full:
+                self.writerDropped += 1 # Shows in frameCounts()
+
+        return
+
+    def drainTrace(self):
+        '''
+        Move timing events sent by writer process into timer
+        '''
+        while True:
+            try:
+                self.timer.merge(self.traceQueue.get_nowait())
+            except queue.Empty:
+                break
+        return
+
+    """
+    Single frames
+    """
+
+    def snap(self, nFrames = 1, accumulate = 'sum'):
+        '''
+        Single frame capture, through preprocessor like streamed frames
+        Subscribers see each frame.
+
+        nFrames > 1 combines filtered frames as they are grabbed
+        ('sum', 'mean' or 'median', see frameAccumulator)
+        Returns (seq of last frame, composite float32 frame or None)
+        '''
+        if self.isAcquiring:
+            print('Stop streaming before snap')
+            return None, None
+
+        self.configurePreprocessor()
+
+        accumulator = frameAccumulator(accumulate, nFrames) if nFrames > 1 else None
+        seq = None
+
+        for k in range(nFrames):
+            frame = self.camera.grab()
+            if frame is None:
+                continue
+
+            seq = self.camera.storeFrame(frame)
+            self.routePending() # Move frame number out of camera queue + filter it
+            self.preprocessor.flush()
+
+            if accumulator is not None:
+                filtFrame = self.readFrame(seq, copy = False)
+                if filtFrame is not None:
+                    accumulator.add(filtFrame)
+
+        composite = accumulator.result() if accumulator is not None else None
+
+        return seq, composite
+
+    def close(self):
+        '''
+        Stop streaming, finish writer, stop filter threads + free filtered frame buffer
+        Camera itself is left open. Also run at interpreter exit.
+        '''
+        if self.isClosed:
+            return
+
+        self.isClosed = True
+        atexit.unregister(self.close)
+
+        self.stop(waitForWriter = True)
+        self.preprocessor.close()
+
+        return
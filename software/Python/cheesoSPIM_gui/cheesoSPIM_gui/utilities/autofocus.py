@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+"""
+Autofocus over the excitation (DSLR) lens
+
+Coarse-to-fine search: lens positions around the start position at the
+first of steps, then a narrower window around the best one at each
+following step. After the last level the peak is interpolated with a
+parabola through the best position and its neighbours, and the lens is
+parked there.
+
+Lens motion overlaps metric computation. As soon as a frame is grabbed,
+the move to the next position is sent (acknowledged, through the
+driver's command thread), and the frame's focus metric is worked out
+while the lens travels.
+
+Lens is relative on the hardware, so position is tracked here from
+startPosition, as sweepAcquisition does.
+
+@author: rusty
+"""
+
+import threading
+import time
+
+import numpy as np
+
+from cheesoSPIM_gui.utilities.focusMetric import focusMetric
+
+
+autofocusDefaults = {'searchRange' : 200, # lens counts either side of start position
+                     'steps' : [40, 10, 2], # lens counts between positions, coarse -> fine
+                     'limits' : None, # (min, max) lens positions allowed, None for no limit
+                     'settleTime' : 0.05, # s after move finishes before grabbing
+                     'discardFrames' : 1, # frames thrown away after each move (stale in camera buffer)
+                     'metric' : 'laplacian', # see focusMetric.focusMetrics
+                     'roi' : None, # (x, y, w, h) of frame to measure, None for whole frame
+                     'maxSize' : 256, # frame binned down to this many pixels on long side for metric
+                     'moveTimeout' : 10} # s to wait for lens move acknowledgement
+
+
+class autofocus():
+    """
+    Run one autofocus search on a scope + camera pair
+
+    scope is cheesoSPIM_driver, camera is any cameraBase camera.
+    Camera must not be streaming while autofocus runs.
+    """
+
+    def __init__(self, scope, camera, params = None, startPosition = 0):
+        """
+        Arguments:
+            - scope = cheesoSPIM_driver
+            - camera = camera object w/ grab() method
+            - params = dict, overrides for autofocusDefaults
+            - startPosition = int, lens position before search
+        """
+        self.scope = scope
+        self.camera = camera
+
+        self.params = dict(autofocusDefaults)
+        if params is not None:
+            self.params.update(params)
+
+        self.startPosition = startPosition
+        self.lensPosition = startPosition
+        self.bestPosition = None # Parked position once done
+        self.results = [] # (lens position, metric) in measurement order
+        self.elapsed = None # s for whole search
+        self.error = None # Exception that ended the search, bestPosition stays None
+
+        self.nPositions = self.countPositions()
+        self.isRunning = False
+        self.abortFlag = False
+        self.thread = None
+
+        return
+
+    def levelPositions(self, center, halfWidth, step):
+        """
+        Lens positions for one search level, ordered from the end nearest the lens
+        """
+        positions = np.arange(center - halfWidth, center + halfWidth + 1, step)
+
+        if self.params['limits'] is not None:
+            lo, hi = self.params['limits']
+            positions = np.unique(np.clip(positions, lo, hi))
+
+        positions = [int(p) for p in positions]
+
+        if abs(positions[-1] - self.lensPosition) < abs(positions[0] - self.lensPosition):
+            positions.reverse()
+
+        return positions
+
+    def countPositions(self):
+        """
+        Total positions over all levels (before any clipping to limits)
+        """
+        halfWidth = self.params['searchRange']
+        n = 0
+        for step in self.params['steps']:
+            n += 2 * (halfWidth // step) + 1
+            halfWidth = step
+
+        return n
+
+    def progress(self):
+        """
+        (positions done, total positions)
+        """
+        return len(self.results), self.nPositions
+
+    def moveTo(self, lens):
+        """
+        Relative lens move to absolute position lens
+        Returns Future resolved when move is done, or None if already done
+        """
+        delta = int(lens - self.lensPosition)
+        self.lensPosition = lens
+
+        if delta == 0:
+            return None
+
+        return self.scope.setFocus(delta, ack = True)
+
+    def waitMove(self, future):
+        if future is not None:
+            future.result(timeout = self.params['moveTimeout'])
+        time.sleep(self.params['settleTime'])
+        return
+
+    def grabFrame(self):
+        """
+        Fresh frame after a move
+        """
+        for k in range(self.params['discardFrames']):
+            self.camera.grab()
+
+        return self.camera.grab()
+
+    def measure(self, positions):
+        """
+        Focus metric at each position
+        Move to next position goes out before metric of current frame is computed.
+        """
+        metrics = np.full(len(positions), np.nan)
+
+        move = self.moveTo(positions[0])
+        for k, lens in enumerate(positions):
+            self.waitMove(move)
+            frame = self.grabFrame()
+
+            if (k + 1) < len(positions) and not(self.abortFlag):
+                move = self.moveTo(positions[k + 1]) # Lens travels while metric is computed
+
+            if frame is not None:
+                metrics[k] = focusMetric(frame, self.params['metric'], self.params['roi'], self.params['maxSize'])
+            self.results.append((lens, metrics[k]))
+
+            if self.abortFlag:
+                break
+
+        return metrics
+
+    def peak(self, positions, metrics):
+        """
+        Best position from one level. Parabola through best point + neighbours
+        when they're evenly spaced, otherwise best point itself.
+        """
+        order = np.argsort(positions)
+        positions = np.asarray(positions)[order]
+        metrics = metrics[order]
+
+        if np.all(np.isnan(metrics)):
+            return None
+
+        k = int(np.nanargmax(metrics))
+        best = positions[k]
+
+        if 0 < k < (len(positions) - 1):
+            m0, m1, m2 = metrics[k - 1:k + 2]
+            step = positions[k + 1] - positions[k]
+            denom = m0 - 2 * m1 + m2
+            if (step == positions[k] - positions[k - 1]) and (denom < 0):
+                best = best + 0.5 * step * (m0 - m2) / denom
+
+        return int(round(best))
+
+    def start(self):
+        """
+        Run search in own thread. Returns immediately.
+        """
+        self.thread = threading.Thread(target = self.run, daemon = True)
+        self.thread.start()
+        return
+
+    def abort(self):
+        """
+        Stop search and return lens to start position
+        """
+        self.abortFlag = True
+        return
+
+    def run(self):
+        """
+        Full coarse-to-fine search, then park lens at best position
+        Returns best position (start position if aborted or no frames)
+        On an error (eg move timeout) lens is sent back to start position,
+        the error is kept in self.error and raised.
+        """
+        self.isRunning = True
+        self.abortFlag = False
+        self.error = None
+        t0 = time.monotonic()
+
+        try:
+            center = self.startPosition
+            halfWidth = self.params['searchRange']
+
+            for step in self.params['steps']:
+                positions = self.levelPositions(center, halfWidth, step)
+                metrics = self.measure(positions)
+
+                if self.abortFlag:
+                    break
+
+                best = self.peak(positions, metrics)
+                if best is None:
+                    print('Autofocus got no frames from camera')
+                    break
+                center = best
+                halfWidth = step
+
+            if self.abortFlag or (len(self.results) == 0) or np.all(np.isnan([m for (p, m) in self.results])):
+                bestPosition = self.startPosition
+            else:
+                bestPosition = center
+
+            self.waitMove(self.moveTo(bestPosition)) # Park
+            self.bestPosition = bestPosition
+        except Exception as e:
+            self.error = e
+            try:
+                self.waitMove(self.moveTo(self.startPosition)) # Best effort, lens back where it was
+            except Exception:
+                pass
+            raise
+        finally:
+            self.elapsed = time.monotonic() - t0
+            self.isRunning = False
+
+        return self.bestPosition
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+"""
+Camera backends by name
+
+Each entry is a module whose camera class subclasses cameraBase.cameraBase.
+Modules are imported when a backend is opened, so backends w/ SDKs that
+aren't installed (eg Vimba) don't stop the others from loading.
+
+    camera = openCamera('opencv', 0)
+    camera.capabilities()
+
+@author: rusty
+"""
+
+import importlib
+import importlib.util
+
+
+cameraBackends = {'opencv' : 'cheesoSPIM_gui.utilities.cv2Camera',
+                  'synthetic' : 'cheesoSPIM_gui.utilities.simCamera',
+                  'vimba' : 'cheesoSPIM_gui.utilities.vimbaCamera'}
+
+# SDK python packages backends import on open
+backendSDKs = {'vimba' : 'vmbpy'}
+
+
+def cameraClass(backend):
+    """
+    Camera class registered under backend name
+    """
+    if backend not in cameraBackends:
+        raise ValueError("Unknown camera backend '{}'. Choose from {}".format(backend, sorted(cameraBackends)))
+
+    return importlib.import_module(cameraBackends[backend]).camera
+
+
+def openCamera(backend, *args, **kwargs):
+    """
+    Connect to camera w/ named backend
+    Extra arguments go to the backend's camera class (eg camSourceID)
+    """
+    return cameraClass(backend)(*args, **kwargs)
+
+
+def availableBackends():
+    """
+    Names of backends whose modules + SDKs are installed
+    """
+    available = []
+    for backend in cameraBackends:
+        if (backend in backendSDKs) and (importlib.util.find_spec(backendSDKs[backend]) is None):
+            continue
+        try:
+            cameraClass(backend)
+        except ImportError:
+            continue
+        available.append(backend)
+
+    return available
@@ -0,0 +1,517 @@
+# -*- coding: utf-8 -*-
+"""
+Common camera backend interface
+
+Every camera backend (cv2Camera, simCamera, vimbaCamera, ...) subclasses
+cameraBase, which holds everything that doesn't depend on the hardware:
+shared-memory ring buffer (frameBuffer), queue of frameRecords
+(frameQueue, sequence number + capture time + stage state per frame), snap / grab, stream start + stop and frame counts.
+
+A backend only fills in:
+    - probeCapabilities() : dict, what the camera can do (see capabilityDefaults)
+    - applyParameter(name, value) : set one parameter on the camera
+    - getProperty(name) : read one property back from the camera
+    - readFrame() : next frame, or None on error
+    - startAcquisition() / stopAcquisition() : only if the SDK pushes frames
+      to a callback. Default is a thread pulling frames w/ readFrame().
+
+ROI + binning (setGeometry) are done on the camera where it reports the
+capability, and otherwise on each frame in software (sensorGeometry)
+before it is stored, so frameBuffer shape always matches what's delivered.
+
+Callback backends call storeFrame(frame) from the SDK's thread, which
+copies the frame straight from the driver's buffer into frameBuffer
+(the only copy made) before the buffer is handed back to the driver.
+
+Backends are picked by name through cameraBackends.openCamera().
+
+@author: rusty
+"""
+
+import threading
+import time
+
+from cheesoSPIM_gui.utilities.frameBuffer import frameRingBuffer, boundedFrameQueue, frameRecord
+from cheesoSPIM_gui.utilities.frameRate import frameRateEstimator
+from cheesoSPIM_gui.utilities import sensorGeometry
+
+
+# Capabilities a backend reports from capabilities(). Missing keys take these values.
+capabilityDefaults = {'exposure' : False, # Settable exposure time
+                      'autoExposure' : False, # On-camera auto exposure
+                      'gain' : False, # Settable gain
+                      'autoGain' : False, # On-camera auto gain
+                      'roi' : False, # Sensor region of interest
+                      'binning' : False, # On-sensor pixel binning
+                      'bitDepths' : (8,), # Bit depths frames can be delivered at
+                      'hardwareTrigger' : False, # External trigger input
+                      'frameTimestamps' : False, # Camera timestamps each frame
+                      'callbackDelivery' : False} # SDK pushes frames, no polling thread
+
+# cameraParameters fields -> capability needed to set them
+parameterCapabilities = {'autoExposure' : 'autoExposure',
+                         'exposureTime' : 'exposure',
+                         'autoGain' : 'autoGain',
+                         'gainValue' : 'gain'}
+
+# cameraParameters fields that set ROI + binning, applied together by setGeometry()
+geometryParameters = ('binning', 'cropROI', 'roi')
+
+# Value fields left to the camera while their auto mode is on
+autoParameters = {'exposureTime' : 'autoExposure',
+                  'gainValue' : 'autoGain'}
+
+# queryProperty() aliases -> property name passed to getProperty()
+propertyAliases = {'fps' : 'fps',
+                   'framerate' : 'fps',
+                   'w' : 'width',
+                   'width' : 'width',
+                   'h' : 'height',
+                   'height' : 'height',
+                   'exposure' : 'exposureTime',
+                   'exposuretime' : 'exposureTime',
+                   'gain' : 'gainValue',
+                   'gainvalue' : 'gainValue',
+                   'bitdepth' : 'bitDepth'}
+
+
+class cameraBase():
+    """
+    Hardware-independent half of a camera. Subclass per backend.
+    """
+
+    backendName = 'base' # Name in cameraBackends registry
+
+    def __init__(self):
+        self.camName = 'camera'
+        self.camID = ''
+
+        self.isStreaming = False  # Set flag
+        self.streamThread = None # camStream() thread while streaming
+        self.newFrame = threading.Event() # Set each time a frame is queued
+        self.frameBuffer = None # Shared-memory frame slots, allocated on first frame
+        self.nBufferSlots = 128 # Frames held in frameBuffer before overwrite
+        self.timer = None # Optional stageTimer.stageTimer; times 'capture' per frame
+        self.stageState = None # Optional function() -> dict, stage state stored in each frameRecord
+        self.rateEstimator = frameRateEstimator(64) # Measured fps from capture timestamps
+        self.monochrome = True # Deliver single-channel frames
+        self.capabilityCache = None # capabilities() result, probed once
+
+        # ROI + binning, see setGeometry()
+        self.roi = None # (x, y, width, height), unbinned sensor pixels. None for full chip.
+        self.binning = 1
+        self.geometrySet = False # False until setGeometry() has been applied once
+        self.hardwareBinning = 1 # Binning done on camera
+        self.hardwareROI = False # True if roi is cropped on camera
+        self.softwareROI = None # Crop of delivered frames, in delivered pixels
+        self.softwareBinning = 1 # Binning of delivered frames
+
+        # Init empty queue for frameRecords of acquired frames
+        # Kept shorter than frameBuffer so queued frames are still in their slots
+        self.frameQueue = boundedFrameQueue(maxsize = self.nBufferSlots // 2, policy = 'dropOldest')
+
+        return
+
+    """
+    Backend interface. Override in subclass.
+    """
+
+    def probeCapabilities(self):
+        '''
+        Ask camera what it supports
+        Returns dict w/ any of the capabilityDefaults keys
+        '''
+        return {}
+
+    def applyParameter(self, name, value):
+        '''
+        Set one parameter (cameraParameters field name) on camera
+        Only called for parameters capabilities() says are supported.
+        Geometry comes through here too, from setGeometry():
+            - 'binning' : int, on-chip binning. 1 for none.
+            - 'roi' : (x, y, width, height) in binned pixels, or None for full chip
+        Returns True if camera took it.
+        '''
+        return False
+
+    def getProperty(self, name):
+        '''
+        Read one property from camera: 'fps', 'width', 'height',
+        'exposureTime' (ms), 'gainValue' (dB), 'bitDepth'
+        Returns None if camera can't report it.
+        '''
+        return None
+
+    def readFrame(self):
+        '''
+        Next frame from camera
+        Returns None on camera error
+        '''
+        raise NotImplementedError
+
+    def startAcquisition(self):
+        '''
+        Start frames flowing into storeFrame()
+        Default is a thread polling readFrame(). Callback backends start
+        the SDK stream here instead.
+        '''
+        self.streamThread = threading.Thread(target = self.camStream, daemon = True)
+        self.streamThread.start()
+
+        return
+
+    def stopAcquisition(self):
+        '''
+        Stop frames started by startAcquisition()
+        '''
+        if self.streamThread is not None:
+            self.streamThread.join(timeout = 2)
+            self.streamThread = None
+
+        return
+
+    def closeSource(self):
+        '''
+        Disconnect from camera
+        '''
+        return
+
+    """
+    Common to all backends
+    """
+
+    def capabilities(self):
+        '''
+        What this camera supports, as dict w/ every capabilityDefaults key
+        Probed from camera on first call, then cached.
+        '''
+        if self.capabilityCache is None:
+            caps = dict(capabilityDefaults)
+            caps.update(self.probeCapabilities())
+            self.capabilityCache = caps
+
+        return dict(self.capabilityCache)
+
+    def setParameters(self, paramDict):
+        """
+        Set camera parameters from dict w/ any of the fields:
+            - autoExposure (bool)
+            - exposureTime (int, milliseconds, 0.1 - 20000 or so)
+            - autoGain (bool)
+            - gainValue (int, dB, 0-24)
+            - binning (int, pixels to bin)
+            - cropROI (bool, crop to roi or use full chip)
+            - roi ((x, y, width, height), unbinned sensor pixels, used if cropROI)
+
+        Other fields (eg GUI-only settings) are ignored, as are fields
+        the camera has no capability for. Exposure time + gain values are
+        skipped while their auto mode is on. binning, cropROI + roi go
+        to setGeometry(), which falls back to software.
+        Returns dict of fields applied -> True / False as camera took them
+        """
+        caps = self.capabilities()
+
+        applied = {}
+        if any(name in paramDict for name in geometryParameters):
+            cropROI = paramDict.get('cropROI', self.roi is not None)
+            roi = paramDict.get('roi', self.roi) if cropROI else None
+            applied['geometry'] = self.setGeometry(roi, paramDict.get('binning', self.binning))
+
+        for name, value in paramDict.items():
+            if paramDict.get(autoParameters.get(name), False):
+                continue # Camera sets this one itself
+            if caps.get(parameterCapabilities.get(name), False):
+                applied[name] = self.applyParameter(name, value)
+
+        return applied
+
+    def queryProperty(self, prop):
+        '''
+        Pass-through function for querying camera properties as class method
+        prop is string specifying which property to query.
+        Supports:
+            - Acquisition frame rate (prop = 'fps' or 'framerate')
+            - Width (prop = 'w' or 'width')
+            - Height (prop = 'h' or 'height')
+            - Exposure time, ms (prop = 'exposure' or 'exposureTime')
+            - Gain, dB (prop = 'gain' or 'gainValue')
+            - Bit depth (prop = 'bitDepth')
+
+        Width + height are of frames as delivered, after any ROI + binning.
+        Unsupported or unreported values return None.
+        '''
+        name = propertyAliases.get(prop.lower())
+        if name is None:
+            return None
+
+        if name in ('width', 'height'):
+            size = self.frameSize()
+            if size is None:
+                return None
+            return size[0] if name == 'width' else size[1]
+
+        val = self.getProperty(name)
+
+        if (name == 'fps') and (val is not None) and (val <= 0):
+            val = None # Backends report 0 or -1 for unknown
+
+        return val
+
+    def measuredFrameRate(self):
+        '''
+        Frame rate from capture timestamps of last frames stored, or None
+        Rolling over last 64 frames while streaming.
+        '''
+        return self.rateEstimator.rate()
+
+    def frameRate(self):
+        '''
+        Best known frame rate: measured if frames have arrived, 
+        else what camera reports, else None
+        '''
+        fps = self.measuredFrameRate()
+        if fps is None:
+            fps = self.queryProperty('fps')
+
+        return fps
+
+    def frameSize(self):
+        '''
+        (width, height) of delivered frames, after software ROI + binning
+        From frameBuffer if allocated, otherwise from camera. None if unknown.
+        '''
+        if self.frameBuffer is not None:
+            h, w = self.frameBuffer.frameShape[:2]
+            return (w, h)
+
+        w = self.getProperty('width')
+        h = self.getProperty('height')
+        if not(w and h) or (w <= 0) or (h <= 0):
+            return None
+
+        return sensorGeometry.outputSize(int(w), int(h), self.softwareROI, self.softwareBinning)
+
+    def setGeometry(self, roi = None, binning = 1):
+        '''
+        Crop frames to roi and bin binning x binning pixels into one
+
+        roi is (x, y, width, height) in unbinned sensor pixels, None for full chip.
+        Binning + ROI are done on camera if capabilities() has them and
+        camera accepts the values; whatever's left is done in software on
+        each frame before it's stored. frameBuffer is freed, so it's
+        reallocated at the new frame size.
+        Can't be changed while streaming.
+        Returns True if geometry was set
+        '''
+        roi = sensorGeometry.checkROI(roi)
+        binning = max(int(binning), 1)
+
+        if self.geometrySet and (roi == self.roi) and (binning == self.binning):
+            return True
+
+        if self.isStreaming:
+            print('Stop streaming before changing ROI / binning')
+            return False
+
+        caps = self.capabilities()
+
+        # Binning first; camera ROI is in binned pixels
+        hardwareBinning = 1
+        if caps['binning']:
+            if self.applyParameter('binning', binning):
+                hardwareBinning = binning
+            elif binning != 1:
+                self.applyParameter('binning', 1)
+
+        deliveredROI = sensorGeometry.scaleROI(roi, hardwareBinning)
+
+        hardwareROI = False
+        if caps['roi']:
+            hardwareROI = self.applyParameter('roi', deliveredROI) and (roi is not None)
+            if (roi is not None) and not(hardwareROI):
+                self.applyParameter('roi', None) # Full chip, crop in software
+
+        self.roi = roi
+        self.binning = binning
+        self.geometrySet = True
+        self.hardwareBinning = hardwareBinning
+        self.hardwareROI = hardwareROI
+        self.softwareROI = None if hardwareROI else deliveredROI
+        self.softwareBinning = binning // hardwareBinning
+
+        self.releaseBuffer() # Old frame size
+
+        return True
+
+    def shapeFrame(self, frame):
+        '''
+        Apply software ROI + binning to frame from camera
+        '''
+        if (frame is None) or ((self.softwareROI is None) and (self.softwareBinning == 1)):
+            return frame
+
+        return sensorGeometry.cropAndBin(frame, self.softwareROI, self.softwareBinning)
+
+    def allocateBuffer(self, frame = None):
+        '''
+        Set up shared-memory ring buffer sized for this camera's frames
+
+        If frame is None, grab one frame from the camera to get shape + dtype.
+        Existing buffer is kept if frames still fit in it.
+        Returns frameBuffer
+        '''
+        if frame is None:
+            if self.frameBuffer is not None:
+                return self.frameBuffer
+
+            frame = self.grab()
+            if frame is None:
+                return None
+
+        if (self.frameBuffer is None) or not(self.frameBuffer.fits(frame)):
+            self.releaseBuffer()
+            self.frameBuffer = frameRingBuffer(frame.shape,
+                                               dtype = frame.dtype,
+                                               nSlots = self.nBufferSlots)
+
+        return self.frameBuffer
+
+    def releaseBuffer(self):
+        '''
+        Free shared-memory ring buffer
+        Call on shut down, after any writer process is done with it
+        '''
+        if self.frameBuffer is not None:
+            self.frameBuffer.close()
+            self.frameBuffer = None
+
+        return
+
+    def close(self):
+        '''
+        Stop streaming, disconnect camera and free frameBuffer
+        '''
+        if self.isStreaming:
+            self.stopStream()
+
+        self.closeSource()
+        self.releaseBuffer()
+
+        return
+
+    def setQueuePolicy(self, policy):
+        '''
+        Set what happens when frameQueue is full
+            - 'dropOldest' : discard oldest frame (Live)
+            - 'block' : camera thread waits for space (Record)
+        '''
+        self.frameQueue.setPolicy(policy)
+        return
+
+    def frameCounts(self):
+        '''
+        Acquired, delivered and dropped frame counts since stream start
+        Returns dict
+        '''
+        return self.frameQueue.counts()
+
+    def storeFrame(self, frame, timestamp = None):
+        '''
+        Copy frame into frameBuffer and queue its frameRecord
+        Frame is stored as is; it should come from grab() or shapeFrame().
+        timestamp is time.monotonic() of arrival; now if None.
+        Stage state is read from stageState() here, as close to capture as possible.
+        Safe to call from an SDK callback thread.
+        Returns sequence number
+        '''
+        if timestamp is None:
+            timestamp = time.monotonic()
+
+        if (self.frameBuffer is None) or not(self.frameBuffer.fits(frame)):
+            self.allocateBuffer(frame)
+
+        seq = self.frameBuffer.put(frame)
+        self.rateEstimator.add(timestamp)
+        stage = self.stageState() if self.stageState is not None else None
+        self.frameQueue.put(frameRecord(seq, timestamp, stage))
+        self.newFrame.set() # Wake up anything waiting on frames
+
+        return seq
+
+    def grab(self):
+        '''
+        Take a single frame on camera and return it directly.
+        Frame does not go to frameBuffer or queue.
+        Returns None on camera error.
+        '''
+        frame = self.shapeFrame(self.readFrame())
+
+        if frame is None:
+            print('Cannot receive frame from camera')
+
+        return frame
+
+    def snap(self):
+        '''
+        Take a single frame on camera.
+        Add this frame to queue
+        '''
+        frame = self.grab()
+
+        if frame is not None:
+            # Put images into buffer + queue instead of returning directly
+            self.storeFrame(frame)
+
+        return
+
+    def startStream(self):
+        '''
+        Start camera streaming (Live or Record mode).
+
+        Set isStreaming = True
+        Start frames flowing w/ startAcquisition()
+        '''
+
+        self.isStreaming = True
+        self.frameQueue.resetCounts()
+        self.rateEstimator.reset() # Rate of this stream only
+
+        self.startAcquisition()
+
+        return
+
+    def stopStream(self):
+        '''
+        Stop camera streaming (Live or Record mode)
+
+        Set isStreaming = False
+        Wait for acquisition to finish its last frame
+        '''
+
+        self.isStreaming = False
+
+        self.stopAcquisition()
+
+        self.newFrame.set() # Release any waiters so they see stream has stopped
+
+        return
+
+    def camStream(self):
+        """
+        Pull frames from camera while streaming
+        Called in own thread by default startAcquisition()
+        """
+        while self.isStreaming:
+            t0 = time.monotonic()
+            frame = self.shapeFrame(self.readFrame())
+
+            if frame is None:
+                # Error
+                print('Cannot receive frame from camera')
+            else:
+                seq = self.storeFrame(frame)
+
+                if self.timer is not None:
+                    self.timer.record('capture', seq, t0)
+
+        return
@@ -2,10 +2,33 @@
 """
 Created on Wed Dec 28 15:12:19 2022
 
+Commands go through a worker thread by default (threaded = True).
+Commands w/o a reply are written back-to-back and return at once.
+Queries return a concurrent.futures.Future resolved by a reader thread.
+Nothing blocks the caller unless it asks for a reply value.
+
+Queries, commands sent with ack = True, and every command of a batch sent
+through submitBatch() carry a token ("!<token> <command>"). The sketch 
+replies "!<token>" when that command has finished, which resolves its 
+Future; a query's reply is the line just before its token. A query that 
+times out gives up its token, so a late reply is dropped rather than 
+handed to the next query. A batch goes out as one line, commands 
+separated by ';'. That saves round-trips, not move time: the sketch runs
+the moves in turn, and each lens move holds it ~120 ms (4 SPI bytes, 
+lensByteDelay apart).
+
+Sequence mode: uploadSequence() sends a list of positions, runSequence()
+starts the sketch stepping through them on its own. Each "T <index>"
+tick it sends back is timestamped on arrival (time.monotonic) for 
+matching against camera frames.
+
 @author: Rusty Nicovich
 """
 
 import time
+import queue
+import threading
+from concurrent.futures import Future, TimeoutError as futureTimeout
 
 config = {
     'CMD_NOT_DEFINED': 0x15,
@@ -13,7 +36,10 @@ config = {
     'ENCODING' : 'utf8',
     'comPort' : 'COM8',
     'baudRate' : 115200,
-    'timeout' : 3
+    'timeout' : 3, 
+    'pollTimeout' : 0.2, # seconds, reader thread serial timeout
+    'stepTime' : 0.002, # seconds per motor step, upper bound. For sequence timeout.
+    'lensMoveTime' : 0.15 # seconds per lens move, upper bound. For sequence timeout.
     }
 
 
@@ -45,20 +71,289 @@ class cheesoSPIM_driver():
     Class for communicating with octoDAC Arduino Shield + sketch
     
     """
-    def __init__(self, serialDevice, verbose = False):
+    def __init__(self, serialDevice, verbose = False, threaded = True):
 
         # Once connected, check that port actually has octoDAC on the receiving end
         self.serial = serialDevice
         self.verbose = verbose
+        
+        self.isThreaded = False # Synchronous until worker threads are up
+        
         devID = self.getIdentification()
         if devID == config['DeviceID']:
             if self.verbose:
                 print('Connected to cheesoSPIM on port ' + self.serial.port)
+                
+            if threaded:
+                self.startWorkers()
         else:
             print("Device Id returned : {}".format(devID))
             print("Initialization error! Disconnecting!\n")
             self.serial.close()
             
+    def startWorkers(self):
+        """
+        Start command writer + reply reader threads
+        After this all commands go through submit()
+        """
+        if (self.serial.timeout is None) or (self.serial.timeout > config['pollTimeout']):
+            self.serial.timeout = config['pollTimeout'] # Reader must wake up to see close()
+            
+        self.commandQueue = queue.Queue() # ('send', line, sentFutures) or ('pause', seconds)
+        self.ackFutures = {} # Futures waiting on "!<token>" completion line, by token
+        self.queryTokens = set() # Tokens of ackFutures that resolve w/ the reply line before them
+        self.lastReply = None # Most recent untagged line, reply of the next query token
+        self.nextToken = 0
+        self.pendingLock = threading.Lock()
+        
+        self.sequenceEntries = [] # Last uploaded sequence
+        self.sequenceTicks = [] # (entry index, host monotonic time) of running sequence
+        self.sequenceFuture = None # Resolved w/ sequenceTicks when sequence ends
+        self.tickCallback = None # function(index, timestamp) called on each tick
+        
+        self.isThreaded = True
+        
+        self.writeThread = threading.Thread(target = self.commandLoop, daemon = True)
+        self.readThread = threading.Thread(target = self.replyLoop, daemon = True)
+        self.writeThread.start()
+        self.readThread.start()
+        
+        return
+    
+    def close(self):
+        """
+        Stop worker threads, then close serial port
+        Commands already queued are sent first
+        """
+        if self.isThreaded:
+            self.commandQueue.put(None)
+            self.writeThread.join(timeout = 5)
+            self.isThreaded = False
+            self.readThread.join(timeout = 2)
+            
+            # Anything still waiting on a reply gets None
+            with self.pendingLock:
+                for future in self.ackFutures.values():
+                    future.set_result(None)
+                self.ackFutures.clear()
+                self.queryTokens.clear()
+                
+            self.endSequence() # Running sequence gets ticks so far
+                    
+        self.serial.close()
+        
+        return
+    
+    def commandLoop(self):
+        """
+        Writer thread. Sends queued commands in order.
+        """
+        while True:
+            item = self.commandQueue.get()
+            
+            if item is None: # close()
+                break
+            
+            if item[0] == 'pause':
+                time.sleep(item[1]) # Hold following commands, eg for a move to finish
+                continue
+            
+            _, sendString, sentFutures = item
+            
+            self.serial.write((sendString + '\n').encode(config['ENCODING']))
+            
+            for future in sentFutures:
+                future.set_result(None)
+                
+        return
+    
+    def replyLoop(self):
+        """
+        Reader thread. "!<token>" lines resolve the command w/ that token;
+        a query's Future gets the last other line received before it.
+        Lines no token claims (eg demo chatter, replies to timed out
+        queries) are dropped.
+        """
+        while self.isThreaded:
+            try:
+                line = self.serial.readline()
+            except Exception: # Port closed under us
+                break
+            
+            if len(line) == 0:
+                continue # Timeout, nothing received
+                
+            ret = line.decode(config['ENCODING']).strip('\r\n')
+            
+            if self.verbose:
+                print(ret)
+            
+            if ret.startswith('T '):
+                # Sequence tick or end
+                self.handleTick(ret[2:], time.monotonic())
+                continue
+            
+            if ret.startswith('!'):
+                # Completion token
+                try:
+                    token = int(ret[1:])
+                except ValueError:
+                    continue
+                
+                with self.pendingLock:
+                    future = self.ackFutures.pop(token, None)
+                    isQuery = token in self.queryTokens
+                    self.queryTokens.discard(token)
+                    reply = self.lastReply
+                    self.lastReply = None # Each reply belongs to the next token only
+                    
+                if future is not None:
+                    future.set_result(reply if isQuery else token)
+                continue
+            
+            with self.pendingLock:
+                self.lastReply = ret
+                
+        return
+    
+    def handleTick(self, tick, timestamp):
+        """
+        Record sequence tick from reader thread
+        """
+        if tick == 'E':
+            self.endSequence()
+            return
+        
+        try:
+            index = int(tick)
+        except ValueError:
+            return
+        
+        self.sequenceTicks.append((index, timestamp))
+        
+        if self.tickCallback is not None:
+            self.tickCallback(index, timestamp)
+            
+        return
+    
+    def endSequence(self):
+        """
+        Resolve sequenceFuture, if any, w/ ticks so far
+        Called from reader thread on 'T E', or by stopSequence() / close()
+        """
+        with self.pendingLock:
+            future = self.sequenceFuture
+            self.sequenceFuture = None
+        if future is not None:
+            future.set_result(list(self.sequenceTicks))
+        return
+    
+    def newAckToken(self, future, query = False):
+        """
+        Register future to be resolved by "!<token>" line. Returns token.
+        query = True resolves it w/ the reply line before the token.
+        """
+        with self.pendingLock:
+            token = self.nextToken
+            self.nextToken = (self.nextToken + 1) % 100000
+            self.ackFutures[token] = future
+            if query:
+                self.queryTokens.add(token)
+        return token
+    
+    def dropFutures(self, futures):
+        """
+        Stop waiting on futures (eg after a timeout) so their tokens,
+        and any late reply, are ignored when they arrive
+        """
+        with self.pendingLock:
+            for token, future in list(self.ackFutures.items()):
+                if future in futures:
+                    del self.ackFutures[token]
+                    self.queryTokens.discard(token)
+        for future in futures:
+            future.cancel()
+        return
+    
+    def waitFor(self, futures, timeout):
+        """
+        Results of futures, waiting up to timeout s for each
+        On timeout every one of them is dropped (see dropFutures) and
+        concurrent.futures.TimeoutError is raised.
+        """
+        try:
+            return [f.result(timeout = timeout) for f in futures]
+        except futureTimeout:
+            self.dropFutures(futures)
+            raise
+    
+    def submit(self, sendString, read = False, callback = None, ack = False):
+        """
+        Queue command for worker thread
+        
+        Inputs : sendString - str, command w/o newline
+                 read - bool, True if device sends a reply line
+                 callback - function(future) called when command is sent (read = False),
+                            completes (ack = True) or reply arrives (read = True)
+                 ack - bool, resolve when device reports command finished.
+                       Ignored for queries; their reply already marks completion.
+                            
+        Returns : concurrent.futures.Future. result() is reply string, token (ack), or None
+        """
+        future = Future()
+        if callback is not None:
+            future.add_done_callback(callback)
+            
+        if read or ack:
+            token = self.newAckToken(future, query = read)
+            self.commandQueue.put(('send', '!{} {}'.format(token, sendString), []))
+        else:
+            self.commandQueue.put(('send', sendString, [future]))
+        
+        return future
+    
+    def submitBatch(self, commands):
+        """
+        Send several commands as one line
+        
+        Inputs : commands - list of str, eg ['M 100', 'F 20', '? F']
+                 Queries ('?') resolve w/ their reply, others w/ completion token
+                 
+        Returns : list of Futures, one per command, in order
+        Raises RuntimeError if worker threads aren't running (threaded = False or closed)
+        """
+        if not self.isThreaded:
+            raise RuntimeError('Batched commands need worker threads running')
+        
+        futures = []
+        parts = []
+        for cmd in commands:
+            future = Future()
+            parts.append('!{} {}'.format(self.newAckToken(future, query = cmd.startswith('?')), cmd))
+            futures.append(future)
+            
+        self.commandQueue.put(('send', ';'.join(parts), []))
+        
+        return futures
+    
+    def sendBatch(self, commands, timeout = 30):
+        """
+        Send batch and wait for every command to finish
+        
+        Returns : list of results (reply strings for queries, tokens otherwise)
+        """
+        return self.waitFor(self.submitBatch(commands), timeout)
+    
+    def pause(self, seconds):
+        """
+        Hold command queue for seconds w/o blocking caller
+        """
+        if self.isThreaded:
+            self.commandQueue.put(('pause', seconds))
+        else:
+            time.sleep(seconds)
+        return
+            
     def numToShortInteger(self, setVal):
         """
         Utility function to convert input value to (two byte?) integer
@@ -75,7 +370,18 @@ class cheesoSPIM_driver():
     def writeAndRead(self, sendString, read = True):
         """
         Helper function for sending to serial port, returning line
+        
+        With worker threads running, commands w/o reply return at once 
+        and queries wait only for their own reply. A query w/o reply in 
+        config['timeout'] s raises concurrent.futures.TimeoutError.
         """
+        if self.isThreaded:
+            future = self.submit(sendString, read = read)
+            if read:
+                return self.waitFor([future], config['timeout'])[0]
+            else:
+                return
+        
         self.serial.reset_input_buffer()
         self.serial.reset_output_buffer()
         sendString = sendString + '\n'
@@ -119,9 +425,12 @@ class cheesoSPIM_driver():
         return
     
     # F
-    def setFocus(self, value):
+    def setFocus(self, value, ack = False):
+        # ack = True returns Future resolved when move has been sent to lens
         stringOut = "F {}".format(value)
         print(stringOut)
+        if ack and self.isThreaded:
+            return self.submit(stringOut, ack = True)
         self.writeAndRead(stringOut, read = False)
         return
     
@@ -151,41 +460,164 @@ class cheesoSPIM_driver():
         return
     
     # M
-    def spinMotor(self, steps):
+    def spinMotor(self, steps, ack = False):
         # Spin as many steps as indicated
         # Negative one way, positive the other
+        # ack = True returns Future resolved when motor has finished stepping
 
         print("Moving : {}".format(steps))
+        if ack and self.isThreaded:
+            return self.submit('M {}'.format(steps), ack = True)
         self.writeAndRead('M {}'.format(steps) , read = False)
 
         return
     
-    def lensFindLimits(self):
-        self.writeAndRead('V', read = False)
-        time.sleep(1)
-        minVal = self.queryFocus()
+    # S C, S A
+    def uploadSequence(self, entries):
+        """
+        Replace sketch's sequence with entries
         
-        self.writeAndRead('B', read = False)
-        time.sleep(1)
-        maxVal = self.queryFocus()
+        Inputs : entries - list of (focusMove, motorSteps, laserPower, dwell)
+                    focusMove - int, relative lens move (as setFocus)
+                    motorSteps - int, relative rotation (as spinMotor)
+                    laserPower - int, 0-255, or -1 to leave as is
+                    dwell - int, milliseconds to hold at position
+                 Sketch holds up to 64 entries.
+        """
+        self.sequenceEntries = list(entries)
+        commands = ['S C'] + ['S A {} {} {} {}'.format(int(f), int(m), int(p), int(d)) for (f, m, p, d) in entries]
         
-        return [minVal, maxVal]
+        # Several entries per line, kept under sketch's 128 character buffer
+        batch = []
+        for cmd in commands:
+            if len(';'.join('!00000 ' + c for c in batch + [cmd])) > 120:
+                self.sendBatch(batch)
+                batch = []
+            batch.append(cmd)
+        self.sendBatch(batch)
+        
+        nStored = self.writeAndRead('S N')
+        if str(nStored) != str(len(entries)):
+            print('Sequence upload error! {} of {} entries stored'.format(nStored, len(entries)))
+            
+        return
+    
+    # S R
+    def runSequence(self, tickCallback = None, block = False, timeout = None):
+        """
+        Run uploaded sequence on sketch
+        
+        Inputs : tickCallback - function(index, timestamp) called from reader thread
+                                as each position is reached
+                 block - bool, wait for sequence to finish
+                 timeout - s to wait if block. None for sequenceDuration() + config['timeout'].
+                           On timeout the sequence is stopped and 
+                           concurrent.futures.TimeoutError raised.
+                 
+        Returns : Future resolved w/ list of (index, timestamp) ticks, or the list if block
+        """
+        self.sequenceTicks = []
+        self.tickCallback = tickCallback
+        self.sequenceFuture = Future()
+        future = self.sequenceFuture
+        
+        self.submit('S R')
+        
+        if block:
+            if timeout is None:
+                timeout = self.sequenceDuration() + config['timeout']
+            try:
+                return future.result(timeout = timeout)
+            except futureTimeout:
+                self.stopSequence()
+                raise
+        return future
+    
+    def sequenceDuration(self):
+        """
+        Upper bound on run time of uploaded sequence, s
+        Dwells plus config['stepTime'] per motor step + config['lensMoveTime'] per lens move
+        """
+        return sum(d / 1000 + abs(m) * config['stepTime'] + (config['lensMoveTime'] if f != 0 else 0)
+                   for (f, m, p, d) in self.sequenceEntries)
+    
+    # S X
+    def stopSequence(self):
+        """
+        Stop running sequence. Its future resolves w/ ticks so far.
+        """
+        self.submit('S X')
+        self.endSequence()
+        return
+    
+    def lensFindLimits(self, block = True):
+        """
+        Drive lens to both ends, query position at each
+        
+        block = False returns a Future for [minVal, maxVal] right away.
+        Waits for the lens happen in the command queue, not on the caller's thread.
+        block = True raises concurrent.futures.TimeoutError if a reply doesn't
+        come within config['timeout'] + 2 s.
+        """
+        if not self.isThreaded:
+            self.writeAndRead('V', read = False)
+            time.sleep(1)
+            minVal = self.queryFocus()
+            
+            self.writeAndRead('B', read = False)
+            time.sleep(1)
+            maxVal = self.queryFocus()
+            
+            return [minVal, maxVal]
+        
+        self.submit('V')
+        self.pause(1)
+        minFuture = self.submit('? F', read = True)
+        
+        self.submit('B')
+        self.pause(1)
+        maxFuture = self.submit('? F', read = True)
+        
+        if block:
+            return self.waitFor([minFuture, maxFuture], config['timeout'] + 2)
+        
+        limits = Future()
+        
+        def resolveLimits(f):
+            # Replies come in order, so minFuture is done once maxFuture is
+            try:
+                limits.set_result([minFuture.result(timeout = 0), f.result()])
+            except Exception as e:
+                limits.set_exception(e) # Dropped or failed query
+            return
+        
+        maxFuture.add_done_callback(resolveLimits)
+        
+        return limits
 
 
     # ? F
-    def queryFocus(self):
+    def queryFocus(self, block = True):
         """ 
         query excitation lens position
+        block = False returns Future for reply
         """
+        if self.isThreaded and not block:
+            return self.submit('? F', read = True)
+        
         idn = self.writeAndRead('? F')
         return idn 
 
         
     # ? L
-    def queryLaser(self):
+    def queryLaser(self, block = True):
         """ 
         query laser power
+        block = False returns Future for reply
         """
+        if self.isThreaded and not block:
+            return self.submit('? L', read = True)
+        
         idn = self.writeAndRead('? L')
         return idn 
         
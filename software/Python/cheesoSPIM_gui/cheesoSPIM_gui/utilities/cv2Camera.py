@@ -2,207 +2,173 @@
 """
 Created on Wed Nov 30 12:17:34 2022
 
-Acquisition class for Allied Vision camera running through Vimba
-Install Vimba w/ python support before executing
+Camera backend for anything OpenCV's VideoCapture can open
+(webcams, UVC / Y16 cameras through V4L2, DirectShow or Media Foundation)
 
 Object fires up camera on init. 
-Set parameters by passing dict in setParameters method
-Acquired frames go into queue.Queue() object where 
-they can be accessed elsewhere (eg GUI)
+Set parameters by passing dict in setParameters method. What the
+source supports is probed once (capabilities()); exposure is converted
+from ms to the unit each OpenCV capture API expects.
+Frames are delivered single channel (monochrome = True), uint16
+if the source can give it, uint8 otherwise. Colour sources are
+converted to grayscale on read.
+Acquired frames go into a shared-memory ring buffer (frameBuffer)
+and their sequence numbers go into queue.Queue() object where 
+they can be accessed elsewhere (eg GUI, writer process)
 
-Can be a prototype for other cameras supported with same GUI
-Use same object + method names, or rename on import elsewhere
+Buffering, queueing + streaming come from cameraBase.cameraBase
 
 @author: rusty
 """
 
 import cv2
-import queue
-import threading
+import numpy as np
 
-class camera():
+from cheesoSPIM_gui.utilities.cameraBase import cameraBase
+
+
+# CAP_PROP_AUTO_EXPOSURE values for (manual, auto), by capture API
+autoExposureValues = {'V4L2' : (1, 3), # V4L2 manual / aperture priority
+                      'DSHOW' : (0.25, 0.75),
+                      'MSMF' : (0.25, 0.75)}
+
+class camera(cameraBase):
+    
+    backendName = 'opencv'
     
     def __init__(self, camSourceID = 0):
-        print('here!')
+        super().__init__()
+        
         # Connect to camera
-        self.cam = cv2.VideoCapture(camSourceID)
+        self.cam = self.openSource(camSourceID)
         print('Connected to cam port {}'.format(camSourceID))
-
-        # Defaults for important parameters        
-        self.paramDict = {"exposure" : -2} #-2 = 320 ms
-                           # Use cropped ROI
-
-        self.setParameters(self.paramDict)
         
         self.camSource = camSourceID
         self.camName = 'openCV camera'
-        self.camID = 'OpenCV camera'
-                
-        self.isStreaming = False  # Set flag
-        self.frameQueue = queue.Queue() # Init empty queue for acquired frames
+        self.camID = '{} {}'.format(self.sourceAPI(), camSourceID).strip()
+        self.bitDepth = 8 # 16 if configureSource() gets native 16-bit frames
+        
+        self.configureSource()
             
         return
     
     
-    def setParameters(self, paramDict):
-        """
-        Set camera parameters here
-        Camera-dependent API, so best to code each call in directly
-        
-        paramDict is dict w/ supported fields:
-            - autoExposure (bool)
-            - exposureTime (int, milliseconds, 0.1 - 20000 or so)
-            - autoGain (bool)
-            - gainValue (int, dB, 0-24)
-            - binning (int, pixels to bin)
-            - cropROI (bool, should always? be False)
-        
-     
-        if paramDict['autoExposure']:
-            c.ExposureAuto.set('Continuous') # On-board autoexposure per frame
-        else:
-        
-        
-        
-        
-        with Vimba.get_instance():
-            with self.cams[0] as c:
-                
-                # Go by fields in paramDict
-                # Field names should match a conditional here to get set
-                # Non-exhaustive!
-                if paramDict['autoExposure']:
-                    c.ExposureAuto.set('Continuous') # On-board autoexposure per frame
-                else:
-                    c.ExposureAuto.set('Off') # No autoexpose - set value in next command
-                    c.ExposureTime.set(paramDict['exposureTime']*1000) # milli to microseconds
-                    
-                if paramDict['autoGain']:
-                    c.GainAuto.set('Continuous') # On-board autoGain per frame
-                else:
-                    c.GainAuto.set('Off') # Fixed gain
-                    c.Gain.set(paramDict['gainValue']) # Set gain value in dB
-                    
-                if (paramDict['binning'] >= 1):
-                    # Camera supports binning in two directions independently
-                    # Set number of pixels to combine into one on the output
-                    c.BinningHorizontal.set(paramDict['binning'])
-                    c.BinningVertical.set(paramDict['binning'])
-
-                    # Make sure that regardless of binning setting, the full chip is being used
-                    # With pixel count change (such as decreasing binning value) you can 
-                    # get camera that sends part of chip instead of chip w/ pixels binned
-                    sw = c.SensorWidth.get()
-                    sh = c.SensorHeight.get()
-                    
-                    # Set chip height and width to full size, divided by binning
-                    c.Height.set(int(sh/paramDict['binning']))
-                    c.Width.set(int(sw/paramDict['binning']))
-                    
-                    
-        """   
-        return
-        
-        
+    def openSource(self, camSourceID):
+        '''
+        Open frame source. Must return object w/ read() -> (ret, frame)
+        as cv2.VideoCapture does. Override for other sources.
+        '''
+        return cv2.VideoCapture(camSourceID)
     
-    def queryProperty(self, prop):
+    def configureSource(self):
         '''
-        Pass-through function for querying camera properties as class method
-        prop is string specifying which property to query.
-        Supports:
-            - Acquisition frame rate (prop = 'fps' or 'framerate')
-            - Width (prop = 'w' or 'width')
-            - Height (prop = 'h' or 'height')
-            
-        Other parameters ToDo as needed
-        If unspecified or undefined, method will return None
+        Ask source for unconverted frames, to get native 16-bit mono
+        (eg Y16 cameras through V4L2 / DirectShow). Kept only if frames 
+        really do come back single channel uint16; otherwise source is 
+        put back to normal 8-bit conversion.
+        '''
+        if not(self.monochrome):
+            return
         
-        with Vimba.get_instance():
-            with self.cams[0] as c:
-            
-                if (prop.lower() in {'fps', 'framerate'}):
-                    
-                    val = c.AcquisitionFrameRate.get() # Frame rate as single value
-                    
-                elif (prop.lower() in {'width', 'w'}):
-                    
-                    val = c.Height.get() # Current output image height (pixels)
-                    
-                elif (prop.lower() in {'height', 'h'}):
-                    
-                    val = c.Width.get() # Current output image width (pixels)
-                    
-                else:
-                    # All other property queries yield None
-                    val = None
-                
-                
-        return val
+        if self.cam.set(cv2.CAP_PROP_CONVERT_RGB, 0):
+            ret, frame = self.cam.read()
+            if ret and (frame.ndim == 2) and (frame.dtype == np.uint16):
+                self.bitDepth = 16
+                return
+            self.cam.set(cv2.CAP_PROP_CONVERT_RGB, 1)
             
-        '''
         return
-        
     
-    def snap(self):
+    def readFrame(self):
         '''
-        Take a single frame on camera.
-        Add this frame to queue        
+        Read next frame from source, single channel if monochrome
+        Returns None on camera error
         '''
         ret, frame = self.cam.read()
-                
-        # Put images into queue instead of returning directly
-        self.frameQueue.put(frame)
         
-        return 
+        if not ret:
+            return None
+        
+        if self.monochrome and (frame.ndim == 3):
+            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+            
+        return frame
     
-    def startStream(self):
+    def closeSource(self):
+        self.cam.release()
+        return
+    
+    def sourceAPI(self):
         '''
-        Start camera streaming (Live or Record mode).
-        
-        Set isStreaming = True
-        Start thread daemon of camStream() method
+        Name of capture API behind source (eg 'V4L2', 'DSHOW', 'MSMF')
         '''
-        
-        self.isStreaming = True
-        
-        threading.Thread(target = self.camStream, daemon = True).start()
-        
-        return
+        try:
+            return self.cam.getBackendName()
+        except (cv2.error, AttributeError):
+            return ''
     
-    def stopStream(self):
+    def propertyWritable(self, propID):
         '''
-        Stop camera streaming (Live or Record mode)
-        
-        Set isStreaming = False
-        Call Vimba class method stop_streaming()
-        Clear queue
-        Shutdown frameHandler
+        True if source accepts propID. Probed by writing back its current value.
         '''
-        
-        
-        self.isStreaming = False
-
-        return
+        try:
+            return bool(self.cam.set(propID, self.cam.get(propID)))
+        except cv2.error:
+            return False
     
+    def probeCapabilities(self):
+        return {'exposure' : self.propertyWritable(cv2.CAP_PROP_EXPOSURE),
+                'autoExposure' : self.propertyWritable(cv2.CAP_PROP_AUTO_EXPOSURE),
+                'gain' : self.propertyWritable(cv2.CAP_PROP_GAIN),
+                'bitDepths' : (self.bitDepth,)}
     
-    def camStream(self):
-        """
-        Class to handle camera acquisition events
-        Called in own thread
-        """
-        # Init frame handler class w/ queue to use
-
-        while self.isStreaming:
-            ret, frame = self.cam.read()
-            
-            if not ret:
-                # Error
-                print('Cannot receive frame from camera')
-            else:
-                self.frameQueue.put(frame)
-
-                    
-        return
+    def toSourceExposure(self, ms):
+        '''
+        Exposure time in ms -> CAP_PROP_EXPOSURE units of this capture API
+        '''
+        api = self.sourceAPI()
+        if api in ('DSHOW', 'MSMF'):
+            return round(np.log2(ms / 1000)) # log2 seconds, whole steps
+        if api == 'V4L2':
+            return ms * 10 # 100 us units
+        return ms
     
-
-        
\ No newline at end of file
+    def fromSourceExposure(self, val):
+        '''
+        CAP_PROP_EXPOSURE value of this capture API -> ms
+        '''
+        api = self.sourceAPI()
+        if api in ('DSHOW', 'MSMF'):
+            return 1000 * 2.0**val
+        if api == 'V4L2':
+            return val / 10
+        return val
+    
+    def applyParameter(self, name, value):
+        if name == 'autoExposure':
+            manual, auto = autoExposureValues.get(self.sourceAPI(), (0, 1))
+            return bool(self.cam.set(cv2.CAP_PROP_AUTO_EXPOSURE, auto if value else manual))
+        
+        if name == 'exposureTime':
+            return bool(self.cam.set(cv2.CAP_PROP_EXPOSURE, self.toSourceExposure(value)))
+        
+        if name == 'gainValue':
+            return bool(self.cam.set(cv2.CAP_PROP_GAIN, value))
+        
+        return False
+    
+    def getProperty(self, name):
+        if name == 'fps':
+            return self.cam.get(cv2.CAP_PROP_FPS)
+        if name == 'width':
+            return int(self.cam.get(cv2.CAP_PROP_FRAME_WIDTH))
+        if name == 'height':
+            return int(self.cam.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        if name == 'exposureTime':
+            return self.fromSourceExposure(self.cam.get(cv2.CAP_PROP_EXPOSURE))
+        if name == 'gainValue':
+            return self.cam.get(cv2.CAP_PROP_GAIN)
+        if name == 'bitDepth':
+            return self.bitDepth
+        
+        return None
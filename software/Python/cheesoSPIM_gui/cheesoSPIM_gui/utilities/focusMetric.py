@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+"""
+Image sharpness (focus quality) metrics
+
+Computed on a small copy of the frame so they are cheap enough to run
+on every displayed frame and at every autofocus position:
+    - crop to roi (view), then integer bin (cv2 INTER_AREA) down to
+      at most maxSize pixels on the long side
+    - 3x3 median on the small image, so isolated hot pixels don't
+      read as sharp detail
+    - metric, normalised by mean intensity squared so laser power,
+      exposure and gain changes don't move it
+
+Metrics:
+    - 'laplacian' : variance of Laplacian
+    - 'gradient' : normalised gradient energy, mean of squared Sobel gradients
+
+Higher is sharper. Values only compare between frames of the same scene.
+
+@author: rusty
+"""
+
+import cv2
+import numpy as np
+
+from cheesoSPIM_gui.utilities import sensorGeometry
+
+
+focusMetrics = ('laplacian', 'gradient')
+
+
+def reduceFrame(frame, roi = None, maxSize = 256):
+    """
+    Crop to roi + bin down to <= maxSize on long side
+    Returns single channel float32 image
+    """
+    small = sensorGeometry.cropAndBin(frame, roi)
+
+    binning = max(int(np.ceil(max(small.shape[:2]) / maxSize)), 1)
+    small = sensorGeometry.cropAndBin(small, None, binning)
+
+    if small.ndim == 3:
+        small = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+
+    if small.dtype not in (np.uint8, np.uint16):
+        small = small.astype(np.float32) # medianBlur types
+
+    return cv2.medianBlur(np.ascontiguousarray(small), 3).astype(np.float32)
+
+def focusMetric(frame, metric = 'laplacian', roi = None, maxSize = 256):
+    """
+    Sharpness of frame, higher is sharper
+
+    Arguments:
+        - frame = numpy array, (h, w) or (h, w, 3) BGR
+        - metric = str, one of focusMetrics
+        - roi = (x, y, w, h) part of frame to measure, None for whole frame
+        - maxSize = int, frame binned down to this many pixels on long side first
+    """
+    img = reduceFrame(frame, roi, maxSize)
+
+    norm = max(float(img.mean()), 1e-6) ** 2
+
+    if metric == 'laplacian':
+        return float(cv2.Laplacian(img, cv2.CV_32F).var()) / norm
+
+    if metric == 'gradient':
+        gx = cv2.Sobel(img, cv2.CV_32F, 1, 0)
+        gy = cv2.Sobel(img, cv2.CV_32F, 0, 1)
+        return float(np.mean(gx * gx + gy * gy)) / norm
+
+    raise ValueError("Unknown focus metric '{}'. Choose from {}".format(metric, focusMetrics))
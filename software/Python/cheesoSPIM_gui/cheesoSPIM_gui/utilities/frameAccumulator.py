@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+"""
+Streaming frame accumulator
+
+Combines N frames into one composite as they arrive, in place of
+capturing a stack and summing it afterwards in ImageJ.
+Buffers are preallocated on the first frame and reused.
+
+Modes:
+    - 'sum' : running sum in float32 (or uint32)
+    - 'mean' : running sum / frame count, float32
+    - 'median' : per-pixel median of the last N frames, kept in a
+                 preallocated N-deep ring of frames
+
+@author: rusty
+"""
+
+import numpy as np
+
+
+accumulateModes = ('sum', 'mean', 'median')
+
+
+class frameAccumulator():
+    """
+    Accumulate up to nFrames frames into one composite
+    """
+
+    def __init__(self, mode = 'sum', nFrames = 8, sumDtype = 'float32'):
+        """
+        Arguments:
+            - mode = str, one of accumulateModes
+            - nFrames = int, frames per composite. For 'median', depth of ring.
+            - sumDtype = 'float32' or 'uint32', accumulator type for 'sum'
+        """
+        if mode not in accumulateModes:
+            raise ValueError("Accumulate mode must be one of {}, not {}".format(accumulateModes, mode))
+
+        self.mode = mode
+        self.nFrames = int(nFrames)
+        self.sumDtype = np.dtype(sumDtype) if mode == 'sum' else np.dtype('float32')
+
+        self.buffer = None # Allocated on first frame
+        self.count = 0
+
+        return
+
+    def allocate(self, frame):
+        if self.mode == 'median':
+            self.buffer = np.empty((self.nFrames,) + frame.shape, dtype = frame.dtype)
+        else:
+            self.buffer = np.zeros(frame.shape, dtype = self.sumDtype)
+        return
+
+    def reset(self):
+        """
+        Start a new composite. Buffers are kept.
+        """
+        self.count = 0
+        if (self.buffer is not None) and (self.mode != 'median'):
+            self.buffer.fill(0)
+        return
+
+    def isFull(self):
+        return self.count >= self.nFrames
+
+    def add(self, frame):
+        """
+        Add frame to composite
+        """
+        if (self.buffer is None) or (self.buffer.shape[-frame.ndim:] != frame.shape):
+            self.allocate(frame)
+            self.count = 0
+
+        if self.mode == 'median':
+            self.buffer[self.count % self.nFrames] = frame
+        else:
+            np.add(self.buffer, frame, out = self.buffer, casting = 'unsafe')
+
+        self.count += 1
+
+        return
+
+    def result(self, dtype = None):
+        """
+        Current composite. None if no frames added.
+        dtype (eg the frames' own uint8 / uint16) rounds + clips the composite 
+        to that integer type, for writers that can't store floats. 
+        A 'sum' saturates at the type's max.
+        """
+        if self.count == 0:
+            return None
+
+        if self.mode == 'sum':
+            composite = self.buffer.copy()
+        elif self.mode == 'mean':
+            composite = self.buffer / np.float32(self.count)
+        else:
+            nValid = min(self.count, self.nFrames)
+            composite = np.median(self.buffer[:nValid], axis = 0).astype(np.float32)
+
+        if dtype is not None:
+            limits = np.iinfo(dtype)
+            composite = np.clip(np.rint(composite), limits.min, limits.max).astype(dtype)
+
+        return composite
@@ -0,0 +1,312 @@
+# -*- coding: utf-8 -*-
+"""
+Shared-memory ring buffer for camera frames
+
+Preallocated block of fixed-shape frame slots in
+multiprocessing.shared_memory. Camera thread writes each new frame
+into the next slot and gets back a sequence number. Display and the
+writer process read frames by sequence number straight out of
+shared memory, so frames are never pickled between processes.
+
+Each slot carries the sequence number of the frame it holds.
+A read of a slot that has been overwritten (reader lapped by camera)
+returns None instead of the wrong frame.
+
+Frames are announced by a frameRecord (sequence number, capture
+timestamp, stage state) travelling through a boundedFrameQueue, which
+caps memory use and counts acquired, delivered and dropped frames.
+
+@author: rusty
+"""
+
+import queue
+import numpy as np
+from multiprocessing import shared_memory
+
+
+queuePolicies = ('dropOldest', 'block')
+
+
+class frameRingBuffer():
+    """
+    Fixed-size ring of frame slots in shared memory
+
+    Create in the acquiring process with create = True.
+    Attach elsewhere (eg writer process) with frameRingBuffer.attach(description)
+    where description comes from the description() method of the owner.
+    """
+
+    def __init__(self, frameShape, dtype = 'uint8', nSlots = 128, name = None, create = True):
+        """
+        Arguments:
+            - frameShape = tuple of ints, shape of a single frame (h, w) or (h, w, c)
+            - dtype = str or numpy dtype of frames
+            - nSlots = int, number of frames held before oldest is overwritten
+            - name = str, shared memory block name. Required if create = False
+            - create = bool, True to allocate new block, False to attach to existing
+        """
+        self.frameShape = tuple(int(k) for k in frameShape)
+        self.dtype = np.dtype(dtype)
+        self.nSlots = int(nSlots)
+        self.isOwner = create
+
+        frameBytes = int(np.prod(self.frameShape)) * self.dtype.itemsize
+        seqBytes = self.nSlots * np.dtype(np.int64).itemsize
+
+        if create:
+            self.shm = shared_memory.SharedMemory(create = True, size = seqBytes + self.nSlots*frameBytes)
+        else:
+            self.shm = shared_memory.SharedMemory(name = name)
+
+        self.name = self.shm.name
+
+        # Sequence number held in each slot. -1 = empty or being written
+        self.slotSeq = np.ndarray((self.nSlots,), dtype = np.int64, buffer = self.shm.buf)
+        # Frame data, one slot per row
+        self.frames = np.ndarray((self.nSlots,) + self.frameShape,
+                                 dtype = self.dtype,
+                                 buffer = self.shm.buf,
+                                 offset = seqBytes)
+
+        if create:
+            self.slotSeq[:] = -1
+
+        self.nextSeq = 0 # Sequence number of next frame written (writer side only)
+
+        return
+
+    @classmethod
+    def attach(cls, description):
+        """
+        Attach to an existing buffer from its description() dict
+        """
+        return cls(description['frameShape'],
+                   dtype = description['dtype'],
+                   nSlots = description['nSlots'],
+                   name = description['name'],
+                   create = False)
+
+    def description(self):
+        """
+        Picklable dict with everything needed to attach from another process
+        """
+        return {'name' : self.name,
+                'frameShape' : self.frameShape,
+                'dtype' : self.dtype.str,
+                'nSlots' : self.nSlots}
+
+    def fits(self, frame):
+        """
+        True if frame can be stored in this buffer's slots
+        """
+        return (tuple(frame.shape) == self.frameShape) and (frame.dtype == self.dtype)
+
+    def put(self, frame):
+        """
+        Copy frame into next slot
+        Returns sequence number of stored frame
+
+        Single writer only (camera thread)
+        """
+        seq = self.nextSeq
+
+        self.reserve(seq)[...] = frame
+        self.publish(seq)
+
+        self.nextSeq = seq + 1
+
+        return seq
+
+    def reserve(self, seq):
+        """
+        Mark slot for frame seq invalid and return it as a writable view
+        Fill it (eg as dst of an OpenCV call), then publish(seq).
+
+        Lets several writers fill slots by an existing sequence number,
+        eg filter workers mirroring the camera buffer.
+        """
+        slot = seq % self.nSlots
+        self.slotSeq[slot] = -1
+
+        return self.frames[slot]
+
+    def publish(self, seq):
+        """
+        Make frame seq readable after reserve(seq)
+        """
+        self.slotSeq[seq % self.nSlots] = seq
+
+        return
+
+    def read(self, seq, copy = True):
+        """
+        Get frame with sequence number seq
+
+        copy = True returns a private copy, checked against overwrite
+        copy = False returns a view into shared memory. Cheaper, but can be
+            overwritten by camera once reader falls nSlots frames behind
+
+        Returns None if frame is no longer (or not yet) in the buffer
+        """
+        slot = seq % self.nSlots
+
+        if self.slotSeq[slot] != seq:
+            return None
+
+        if copy:
+            frame = self.frames[slot].copy()
+            if self.slotSeq[slot] != seq: # Overwritten during copy
+                return None
+        else:
+            frame = self.frames[slot]
+
+        return frame
+
+    def close(self):
+        """
+        Detach from shared memory block.
+        Owner also frees the block.
+        """
+        # Drop numpy views before closing underlying buffer
+        self.slotSeq = None
+        self.frames = None
+        self.shm.close()
+
+        if self.isOwner:
+            try:
+                self.shm.unlink()
+            except FileNotFoundError:
+                pass
+
+        return
+
+
+
+class frameRecord():
+    """
+    What travels through queues in place of a frame: sequence number in
+    frameRingBuffer, monotonic capture time + stage state at capture.
+    Frame data itself stays in shared memory.
+
+    Slots only, and pickled as a plain tuple, so one per frame is cheap
+    to make and to send to the writer process.
+    """
+
+    __slots__ = ('seq', 'timestamp', 'stage')
+
+    def __init__(self, seq, timestamp, stage = None):
+        self.seq = seq # frameRingBuffer sequence number
+        self.timestamp = timestamp # s, time.monotonic() when frame arrived from camera
+        self.stage = stage # dict of stage state at capture, or None
+
+        return
+
+    def __reduce__(self):
+        return (frameRecord, (self.seq, self.timestamp, self.stage))
+
+    def __repr__(self):
+        return 'frameRecord({}, {:.6f}, {})'.format(self.seq, self.timestamp, self.stage)
+
+    def meta(self):
+        """
+        Flat dict for writer metadata: seq, timestamp + stage state fields
+        """
+        meta = {'seq' : self.seq, 'timestamp' : self.timestamp}
+        if self.stage is not None:
+            meta.update(self.stage)
+
+        return meta
+
+
+
+class boundedFrameQueue(queue.Queue):
+    """
+    queue.Queue with fixed max size and a policy for when it is full
+
+    Policies:
+        - 'dropOldest' : discard oldest queued item to make room. 
+                         Producer never waits. Use for Live.
+        - 'block' : producer waits up to blockTimeout seconds for space, 
+                    then drops the new item. Use for Record.
+
+    Keeps counts of acquired (put), delivered (get) and dropped items.
+    """
+
+    def __init__(self, maxsize = 64, policy = 'dropOldest', blockTimeout = 1.0):
+        super().__init__(maxsize = maxsize)
+        self.setPolicy(policy)
+        self.blockTimeout = blockTimeout # seconds
+
+        self.resetCounts()
+
+        return
+
+    def setPolicy(self, policy):
+        """
+        Set full-queue policy. One of queuePolicies.
+        """
+        if policy not in queuePolicies:
+            raise ValueError("Queue policy must be one of {}, not {}".format(queuePolicies, policy))
+
+        self.policy = policy
+
+        return
+
+    def resetCounts(self):
+        """
+        Zero acquired, delivered and dropped counters
+        """
+        with self.mutex:
+            self.acquired = 0
+            self.delivered = 0
+            self.dropped = 0
+
+        return
+
+    def counts(self):
+        """
+        Snapshot of counters as dict
+        """
+        with self.mutex:
+            return {'acquired' : self.acquired,
+                    'delivered' : self.delivered,
+                    'dropped' : self.dropped,
+                    'queued' : self._qsize()}
+
+    def put(self, item, block = True, timeout = None):
+        """
+        Add item following policy. block and timeout are ignored; 
+        policy decides whether producer waits.
+        """
+        if self.policy == 'dropOldest':
+            with self.not_full:
+                self.acquired += 1
+
+                if self._qsize() >= self.maxsize > 0:
+                    self._get() # Discard oldest
+                    self.unfinished_tasks -= 1
+                    self.dropped += 1
+
+                self._put(item)
+                self.unfinished_tasks += 1
+                self.not_empty.notify()
+
+        else:
+            with self.mutex:
+                self.acquired += 1
+
+            try:
+                super().put(item, timeout = self.blockTimeout)
+            except queue.Full:
+                with self.mutex:
+                    self.dropped += 1
+
+        return
+
+    def get(self, block = True, timeout = None):
+        item = super().get(block = block, timeout = timeout)
+
+        with self.mutex:
+            self.delivered += 1
+
+        return item
@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+"""
+Fast frame -> Tk image conversion for live display
+
+Per displayed frame:
+    - downsample to display size first: integer pixel binning (cv2 INTER_AREA
+      fast path), then area resize of the small remainder, so everything
+      after works on the small image
+    - BGR -> RGB done by PIL while unpacking the buffer ('BGR' raw mode),
+      no channel-flipped copy of the frame
+    - mono frames (uint8 or uint16) mapped to 8-bit through a lookup table,
+      which sets display contrast. With autoContrast the table is rebuilt
+      from frame percentiles every lutInterval seconds, so contrast costs
+      one table lookup per displayed pixel.
+    - one persistent ImageTk.PhotoImage, updated in place with paste()
+
+Display size is worked out once per frame shape + window size and
+cached until either changes (setWindowSize from a <Configure> binding).
+
+@author: rusty
+"""
+
+import time
+
+import cv2
+import numpy as np
+from PIL import Image, ImageTk
+
+
+class frameDisplay():
+    """
+    Convert frames to a reused Tk image sized to fit a window
+    """
+
+    def __init__(self, winWidth = 648, winHeight = 486):
+        self.winSize = (winWidth, winHeight)
+
+        self.cacheKey = None # (frame shape, window size) displaySize was made for
+        self.displaySize = None # (width, height) of displayed image
+        self.binSize = None # (width, height) after integer binning, None if no binning
+        self.photo = None # Persistent ImageTk.PhotoImage
+        
+        # Mono display contrast
+        self.autoContrast = True # Stretch range to frame content. False uses setRange() limits.
+        self.contrastPercentiles = (0.1, 99.9) # Frame percentiles mapped to black + white
+        self.lutInterval = 0.5 # s between auto-contrast updates
+        self.lut = None # uint8 table, one entry per input level
+        self.lutRange = None # (lo, hi) input levels lut maps to 0, 255
+        self.lutTime = 0
+
+        return
+
+    def setRange(self, lo, hi, nLevels = None):
+        """
+        Build lut mapping input levels lo -> 0 and hi -> 255, linear between
+        nLevels = 256 for uint8 frames, 65536 for uint16. Default keeps current.
+        """
+        if nLevels is None:
+            nLevels = len(self.lut) if self.lut is not None else 256
+
+        hi = max(hi, lo + 1)
+        levels = np.arange(nLevels, dtype = np.float32)
+        self.lut = np.clip((levels - lo) * (255.0 / (hi - lo)), 0, 255).astype(np.uint8)
+        self.lutRange = (lo, hi)
+
+        return
+
+    def applyLut(self, img):
+        """
+        Mono uint8 / uint16 image -> uint8 through lut
+        """
+        nLevels = 256 if img.dtype == np.uint8 else 65536
+
+        if (self.lut is None) or (len(self.lut) != nLevels):
+            if self.autoContrast:
+                self.lutTime = 0 # Build from this frame
+            else:
+                self.setRange(0, nLevels - 1, nLevels) # Full range
+
+        now = time.monotonic()
+        if self.autoContrast and ((now - self.lutTime) > self.lutInterval):
+            lo, hi = np.percentile(img[::2, ::2], self.contrastPercentiles)
+            self.setRange(lo, hi, nLevels)
+            self.lutTime = now
+
+        if nLevels == 256:
+            return cv2.LUT(img, self.lut)
+
+        return np.take(self.lut, img)
+
+    def setWindowSize(self, winWidth, winHeight):
+        """
+        Window holding image changed size. Geometry recomputed on next frame.
+        """
+        self.winSize = (max(int(winWidth), 1), max(int(winHeight), 1))
+        return
+
+    def fitSize(self, frameShape):
+        """
+        Largest (width, height) with frame's aspect ratio that fits window
+        Cached until frame shape or window size changes.
+        """
+        key = (tuple(frameShape[:2]), self.winSize)
+
+        if key != self.cacheKey:
+            imgHeight, imgWidth = frameShape[:2]
+            winWidth, winHeight = self.winSize
+
+            deltaW = winWidth/imgWidth
+            deltaH = winHeight/imgHeight
+
+            if deltaW > deltaH:
+                # Shrink on height more than width
+                newHeight = winHeight
+                newWidth = int(imgWidth*deltaH)
+            else:
+                # Shrink width more than height
+                newWidth = winWidth
+                newHeight = int(imgHeight*deltaW)
+
+            self.displaySize = (max(newWidth, 1), max(newHeight, 1))
+            self.cacheKey = key
+            
+            # Integer bin factor that stays at or above display size
+            binFactor = int(min(imgWidth / self.displaySize[0], imgHeight / self.displaySize[1]))
+            if binFactor >= 2:
+                self.binSize = (imgWidth // binFactor, imgHeight // binFactor)
+            else:
+                self.binSize = None
+
+        return self.displaySize
+
+    def toImage(self, frame):
+        """
+        Frame (BGR uint8, or mono uint8 / uint16) -> PIL Image at display size
+        """
+        size = self.fitSize(frame.shape)
+
+        small = frame
+        if self.binSize is not None:
+            small = cv2.resize(small, self.binSize, interpolation = cv2.INTER_AREA)
+
+        if (small.shape[1], small.shape[0]) != size:
+            # Shrinking: area average. Growing: bilinear.
+            interp = cv2.INTER_AREA if size[0] < small.shape[1] else cv2.INTER_LINEAR
+            small = cv2.resize(small, size, interpolation = interp)
+        else:
+            small = np.ascontiguousarray(small)
+
+        if small.ndim == 2:
+            # Contrast set on the small image, after downsampling
+            return Image.frombuffer('L', size, self.applyLut(small), 'raw', 'L', 0, 1)
+
+        # PIL swaps channels while unpacking
+        return Image.frombuffer('RGB', size, small, 'raw', 'BGR', 0, 1)
+
+    def update(self, frame):
+        """
+        Show frame in persistent PhotoImage
+        Returns (photo, isNew). isNew is True when a new PhotoImage had to be
+        made (first frame or size change) and the widget must be pointed at it.
+        """
+        img = self.toImage(frame)
+
+        isNew = (self.photo is None) or ((self.photo.width(), self.photo.height()) != img.size)
+        if isNew:
+            self.photo = ImageTk.PhotoImage(image = img)
+        else:
+            self.photo.paste(img)
+
+        return self.photo, isNew
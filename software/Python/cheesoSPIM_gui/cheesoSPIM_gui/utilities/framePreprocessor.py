@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+"""
+Hot pixel filter stage between camera and its consumers
+
+Each frame is median filtered exactly once, in a thread pool
+(OpenCV releases the GIL, so workers run in parallel with each other
+and with the Tk event loop). The result goes straight into a second
+shared-memory ring buffer, mirroring the camera's frameBuffer slot
+for slot, and display, the writer process and Snap all read from there.
+
+If a hotPixelMap is set (hotPixels) and fits the frames, only the mapped
+hot + dead pixels are repaired instead of median filtering the whole frame.
+
+Results are handed on through callback(seq, meta) in acquisition
+order, whatever order the workers finish in.
+
+@author: rusty
+"""
+
+import concurrent.futures
+import queue
+import threading
+import time
+
+import numpy as np
+from cv2 import medianBlur
+
+from cheesoSPIM_gui.utilities.frameBuffer import frameRingBuffer
+
+
+class framePreprocessor():
+    """
+    Median filter frames from a camera frameBuffer into own frameBuffer
+    """
+
+    def __init__(self, filterSize = 3, nWorkers = 2, callback = None):
+        """
+        Arguments:
+            - filterSize = int, odd, median filter size. 1 copies frames unfiltered.
+            - nWorkers = int, filter threads
+            - callback = function(seq, meta), called in order for each filtered frame
+        """
+        self.filterSize = filterSize
+        self.nWorkers = nWorkers
+        self.callback = callback
+        self.timer = None # Optional stageTimer.stageTimer; times 'filter' per frame
+        self.hotPixels = None # Optional hotPixelMap.hotPixelMap; used in place of median filter
+
+        self.sourceBuffer = None # Camera frameBuffer frames are read from
+        self.frameBuffer = None # Filtered frames, same slots as sourceBuffer
+        self.nDropped = 0 # Frames overwritten in sourceBuffer before filtering
+
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers = nWorkers,
+                                                          thread_name_prefix = 'medianFilter')
+
+        # (seq, meta, future) in submit order. Bounded, so a slow filter
+        # backs up into the camera queue rather than growing here.
+        self.pending = queue.Queue(maxsize = 4 * nWorkers)
+        self.forwardThread = threading.Thread(target = self.forwardLoop, daemon = True)
+        self.forwardThread.start()
+
+        return
+
+    def allocateBuffer(self, sourceBuffer):
+        """
+        Set up output ring buffer matching sourceBuffer (camera frameBuffer)
+        Existing buffer is kept if it still matches.
+        Returns frameBuffer
+        """
+        if (self.frameBuffer is None) or (self.frameBuffer.frameShape != sourceBuffer.frameShape) \
+                or (self.frameBuffer.dtype != sourceBuffer.dtype) or (self.frameBuffer.nSlots != sourceBuffer.nSlots):
+            self.flush() # Nothing in flight on old buffer
+            self.releaseBuffer()
+            self.frameBuffer = frameRingBuffer(sourceBuffer.frameShape,
+                                               dtype = sourceBuffer.dtype,
+                                               nSlots = sourceBuffer.nSlots)
+
+        self.sourceBuffer = sourceBuffer
+
+        return self.frameBuffer
+
+    def releaseBuffer(self):
+        """
+        Free output ring buffer
+        """
+        if self.frameBuffer is not None:
+            self.frameBuffer.close()
+            self.frameBuffer = None
+
+        return
+
+    def apply(self, frame, dst = None):
+        """
+        Filter a single frame, into dst if given
+        Returns filtered frame
+        """
+        hotPixels = self.hotPixels # Local ref; GUI can swap map mid-stream
+        if (hotPixels is not None) and hotPixels.fits(frame):
+            return hotPixels.repair(frame, dst)
+        if self.filterSize > 1:
+            # OpenCV only does 3 + 5 for 16-bit
+            ksize = self.filterSize if frame.dtype == np.uint8 else min(self.filterSize, 5)
+            return medianBlur(frame, ksize, dst)
+        if dst is not None:
+            dst[...] = frame
+            return dst
+        return frame
+
+    def filterFrame(self, seq):
+        """
+        Filter frame seq from sourceBuffer into same slot of frameBuffer
+        Runs in pool. Returns False if frame was lost to overwrite.
+        """
+        t0 = time.monotonic()
+
+        src = self.sourceBuffer.read(seq, copy = False)
+        if src is None:
+            return False
+
+        self.apply(src, self.frameBuffer.reserve(seq))
+
+        if self.sourceBuffer.slotSeq[seq % self.sourceBuffer.nSlots] != seq:
+            return False # Camera overwrote source while filtering
+
+        self.frameBuffer.publish(seq)
+
+        if self.timer is not None:
+            self.timer.record('filter', seq, t0)
+
+        return True
+
+    def submit(self, sourceBuffer, seq, meta = None):
+        """
+        Queue frame seq in sourceBuffer for filtering
+        Waits if too many frames are already pending.
+        """
+        if (sourceBuffer is not self.sourceBuffer) or (self.frameBuffer is None):
+            self.allocateBuffer(sourceBuffer)
+
+        self.pending.put((seq, meta, self.pool.submit(self.filterFrame, seq)))
+
+        return
+
+    def forwardLoop(self):
+        """
+        Hand filtered frames to callback in submit order
+        Runs in own thread
+        """
+        while True:
+            item = self.pending.get()
+            if item is None:
+                self.pending.task_done()
+                break
+
+            seq, meta, future = item
+
+            try:
+                ok = future.result()
+            except Exception as e:
+                print('Filter failed on frame {} : {}'.format(seq, e))
+                ok = False
+
+            if ok:
+                if self.callback is not None:
+                    self.callback(seq, meta)
+            else:
+                self.nDropped += 1
+
+            self.pending.task_done()
+
+        return
+
+    def flush(self):
+        """
+        Wait until every submitted frame has been passed to callback
+        """
+        self.pending.join()
+
+        return
+
+    def close(self):
+        """
+        Finish pending frames, stop threads and free buffer
+        """
+        self.pending.put(None)
+        self.forwardThread.join(timeout = 2)
+        self.pool.shutdown(wait = True)
+        self.releaseBuffer()
+
+        return
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+"""
+Measured camera frame rate
+
+Many cameras (most through OpenCV) don't report a usable frame rate,
+and the one they do report is what was asked for, not what arrives.
+frameRateEstimator keeps the capture timestamps of the last nFrames
+frames in a fixed numpy array and works out the rate from their
+intervals in one pass (sort, diff, median), so it is cheap to ask for
+on every GUI update.
+
+Median interval is used so one late frame doesn't move the rate, but a
+camera held back by a slow writer shows up as a falling rate within
+nFrames frames.
+
+@author: rusty
+"""
+
+import numpy as np
+
+
+class frameRateEstimator():
+    """
+    Rolling frame rate from last nFrames capture timestamps
+
+    add() is called from the camera thread, rate() + stats() from anywhere.
+    Readers work on a sorted copy, so a timestamp landing mid-read is harmless.
+    """
+
+    def __init__(self, nFrames = 64):
+        """
+        Arguments:
+            - nFrames = int, timestamps kept
+        """
+        self.timestamps = np.full(int(nFrames), np.nan)
+        self.count = 0 # Timestamps added since reset()
+
+        return
+
+    def reset(self):
+        self.timestamps[:] = np.nan
+        self.count = 0
+        return
+
+    def add(self, timestamp):
+        """
+        Capture time of a new frame, s (time.monotonic())
+        """
+        self.timestamps[self.count % len(self.timestamps)] = timestamp
+        self.count += 1
+        return
+
+    def intervals(self):
+        """
+        Intervals between last nFrames frames, s, oldest first
+        """
+        t = self.timestamps[:min(self.count, len(self.timestamps))]
+        return np.diff(np.sort(t)) # Sort copies + puts ring back in time order
+
+    def rate(self):
+        """
+        Frames per second, None until 2 frames have arrived
+        """
+        dt = self.intervals()
+        if len(dt) == 0:
+            return None
+
+        median = float(np.median(dt))
+
+        return 1 / median if median > 0 else None
+
+    def stats(self):
+        """
+        dict of fps (from median interval), mean + max interval and jitter (std), ms
+        None until 2 frames have arrived
+        """
+        dt = self.intervals()
+        if len(dt) == 0:
+            return None
+
+        median = float(np.median(dt))
+
+        return {'fps' : 1 / median if median > 0 else None,
+                'meanInterval' : float(dt.mean()) * 1000,
+                'maxInterval' : float(dt.max()) * 1000,
+                'jitter' : float(dt.std()) * 1000,
+                'frames' : len(dt) + 1}
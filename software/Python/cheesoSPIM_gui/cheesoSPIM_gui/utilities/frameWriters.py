@@ -0,0 +1,859 @@
+# -*- coding: utf-8 -*-
+"""
+Recording backends for writeVideo(), the writer process run by vidRecorder
+
+Each writer takes frames one at a time with a dict of per-frame
+metadata (exposure, lens position, rotation step, ...) and appends
+them to disk. Per-frame metadata goes into a .csv sidecar next to
+the data file, so every backend records the same stage state.
+
+Frames from writeVideo() carry their capture sequence number + 
+timestamp, so the .csv doubles as a frame index (file frame ->
+camera seq, capture time). On close the writer also works out the
+real frame rate + missing frames from them and puts it in a .json 
+sidecar, with the nominal rate the file was opened with.
+
+Mono (h, w) frames are stored as single channel, uint16 kept as uint16,
+by every backend except 'avi'.
+
+Backends, selected by name from writerBackends:
+    - 'avi' : MJPG AVI through cv2.VideoWriter. Lossy, small files.
+              8-bit only; 16-bit frames are scaled down to 8 bits.
+    - 'raw' : uncompressed .npy stack. Frames appended as raw bytes,
+              header rewritten with final frame count on close.
+              Open with numpy.load(fileName, mmap_mode = 'r')
+    - 'tiff' : BigTIFF multi-page stack through tifffile. Lossless,
+               metadata also stored in each page description.
+    - 'zarr' : chunked, zlib-compressed (angle, z, y, x) volume in
+               Zarr v2 directory layout. Each frame is filed by its
+               rotation + lens position and written as its own chunks,
+               so any sub-volume can be read without loading the rest.
+               One frame per position, so sweeps only (not in streamFormats).
+    - 'segments' : crash-safe raw recording for long runs. Directory of
+                   fixed-size .npy segments + frame index + manifest,
+                   all flushed to disk every few seconds. A recording 
+                   cut short is repaired by recoverSegments() and can
+                   be resumed. Read back w/ readSegments().
+
+@author: rusty
+"""
+
+import csv
+import json
+import multiprocessing
+import os
+import pathlib
+import time
+import zlib
+from queue import Empty, Full
+
+import numpy as np
+from cv2 import medianBlur
+
+from cheesoSPIM_gui.utilities.frameBuffer import frameRingBuffer
+
+
+class frameWriter():
+    """
+    Base class for recording backends
+
+    Subclasses set extension and implement openFile, writeFrame, closeFile
+    """
+
+    extension = ''
+    streams = True # Keeps every frame, so can record a camera stream
+    floatFrames = True # Stores float32 frames (eg accumulated composites) as they are
+
+    def __init__(self, fileName, paramDict):
+        """
+        Arguments:
+            - fileName = str or pathlib.Path, output file. Extension is replaced.
+            - paramDict = dict, as passed to writeVideo()
+        """
+        self.fileName = pathlib.Path(fileName).with_suffix(self.extension)
+        self.paramDict = paramDict
+        self.frameCount = 0
+
+        self.metaFile = None
+        self.metaWriter = None
+
+        # Capture timing, from 'seq' + 'timestamp' in metadata
+        self.firstSeq = None
+        self.lastSeq = None
+        self.firstTimestamp = None
+        self.lastTimestamp = None
+        self.timedFrames = 0 # Frames w/ timestamps written by this writer
+
+        self.openFile()
+
+        return
+
+    def write(self, frame, meta = None):
+        """
+        Append frame to file, metadata dict to sidecar
+        """
+        self.writeFrame(frame, meta)
+        self.writeMeta(meta)
+        self.trackTiming(meta)
+        self.frameCount += 1
+        return
+
+    def trackTiming(self, meta):
+        if (meta is None) or ('timestamp' not in meta):
+            return
+
+        if self.firstTimestamp is None:
+            self.firstSeq = meta['seq']
+            self.firstTimestamp = meta['timestamp']
+        self.lastSeq = meta['seq']
+        self.lastTimestamp = meta['timestamp']
+        self.timedFrames += 1
+
+        return
+
+    def timing(self):
+        """
+        Frame count, real frame rate + missing frames from capture timestamps
+        and sequence numbers of frames written by this writer (not earlier 
+        parts of a resumed recording). Rate is None if fewer than 2 timed frames.
+        """
+        summary = {'frames' : self.frameCount,
+                   'nominalFps' : self.paramDict.get('frameRate'),
+                   'measuredFps' : None,
+                   'duration' : None,
+                   'missing' : None}
+
+        if self.firstTimestamp is not None:
+            summary['duration'] = self.lastTimestamp - self.firstTimestamp
+            summary['missing'] = (self.lastSeq - self.firstSeq + 1) - self.timedFrames # Gaps in seq = frames dropped upstream
+            if summary['duration'] > 0:
+                summary['measuredFps'] = (self.timedFrames - 1) / summary['duration']
+
+        return summary
+
+    def writeMeta(self, meta):
+        """
+        One sidecar row per frame. Columns set by first frame's metadata.
+        """
+        if meta is None:
+            return
+
+        if self.metaWriter is None:
+            self.openMeta(meta)
+
+        row = dict(meta)
+        row['frame'] = self.frameCount
+        self.metaWriter.writerow(row)
+
+        return
+
+    def metaFileName(self):
+        return self.fileName.with_suffix('.csv')
+
+    def openMeta(self, meta):
+        """
+        Open sidecar, columns from first frame's metadata
+        """
+        self.metaFile = open(self.metaFileName(), 'w', newline = '')
+        self.metaWriter = csv.DictWriter(self.metaFile,
+                                         fieldnames = ['frame'] + list(meta.keys()),
+                                         extrasaction = 'ignore')
+        self.metaWriter.writeheader()
+
+        return
+
+    def close(self):
+        self.closeFile()
+
+        if self.metaFile is not None:
+            self.metaFile.close()
+
+        if self.firstTimestamp is not None:
+            with open(self.fileName.with_suffix('.json'), 'w') as f:
+                json.dump(self.timing(), f, indent = 1)
+
+        return
+
+    def openFile(self):
+        return
+
+    def writeFrame(self, frame, meta):
+        return
+
+    def closeFile(self):
+        return
+
+
+class aviWriter(frameWriter):
+    """
+    MJPG AVI through OpenCV VideoWriter
+    Colour or mono + frame size set by first frame. Playback rate is
+    paramDict['frameRate'], measured from the first frames by the engine. Frames wider than 8 bits are
+    shifted down by paramDict['bitDepth'] - 8 (default: full container).
+    """
+
+    extension = '.avi'
+    floatFrames = False # Integer frames only
+
+    def openFile(self):
+        self.videoObject = None # Opened on first frame, once colour/mono is known
+        return
+
+    def writeFrame(self, frame, meta):
+        if frame.dtype != np.uint8:
+            bitDepth = self.paramDict.get('bitDepth', 8 * frame.dtype.itemsize)
+            frame = (frame >> max(bitDepth - 8, 0)).clip(0, 255).astype(np.uint8)
+        
+        if self.videoObject is None:
+            from cv2 import VideoWriter_fourcc, VideoWriter
+
+            fourcc = VideoWriter_fourcc('M','J','P','G')    # Init format
+            # Init openCV VideoWriter object
+            self.videoObject = VideoWriter(str(self.fileName),
+                                           fourcc,
+                                           self.paramDict['frameRate'],
+                                           (frame.shape[1], frame.shape[0]), # Size of real frames, whatever paramDict says
+                                           frame.ndim == 3) # isColor
+        
+        self.videoObject.write(frame)
+        return
+
+    def closeFile(self):
+        # Close videoObject file
+        if self.videoObject is not None:
+            while self.videoObject.isOpened():
+                self.videoObject.release()
+        return
+
+
+def npyHeader(dtype, shape, headerLength = 128):
+    """
+    npy v1.0 header for an array of shape, padded to headerLength bytes
+    Fixed length, so it can be rewritten in place as frames are appended.
+    """
+    header = "{{'descr': '{}', 'fortran_order': False, 'shape': {}, }}".format(np.dtype(dtype).str, tuple(shape))
+
+    prefix = b'\x93NUMPY\x01\x00'
+    nPad = headerLength - len(prefix) - 2 - len(header) - 1
+    header = (header + ' '*nPad + '\n').encode('latin1')
+
+    return prefix + np.uint16(len(header)).tobytes() + header
+
+
+class rawStackWriter(frameWriter):
+    """
+    Uncompressed .npy stack, frames appended as raw bytes
+
+    Fixed-length .npy header is written up front with a frame count of 0,
+    then rewritten in place with the real count on close. Frame data
+    is never encoded, so writes cost one memcpy to the OS page cache.
+    """
+
+    extension = '.npy'
+    headerLength = 128 # bytes, incl. magic string. Multiple of 64 for alignment.
+
+    def openFile(self):
+        self.file = open(self.fileName, 'wb')
+        self.frameShape = None
+        self.dtype = None
+        self.file.write(b'\x00' * self.headerLength) # Placeholder until shape is known
+        return
+
+    def makeHeader(self):
+        return npyHeader(self.dtype, (self.frameCount,) + self.frameShape, self.headerLength)
+
+    def writeFrame(self, frame, meta):
+        if self.frameShape is None:
+            self.frameShape = tuple(frame.shape)
+            self.dtype = frame.dtype
+
+        self.file.write(np.ascontiguousarray(frame).data)
+        return
+
+    def closeFile(self):
+        if self.frameShape is not None:
+            self.file.seek(0)
+            self.file.write(self.makeHeader())
+
+        self.file.close()
+        return
+
+
+class tiffStackWriter(frameWriter):
+    """
+    BigTIFF multi-page stack through tifffile
+    One page per frame, uncompressed, metadata as JSON page description
+    """
+
+    extension = '.tif'
+
+    def openFile(self):
+        import tifffile # Optional dependency, only needed for this backend
+
+        self.tiff = tifffile.TiffWriter(self.fileName, bigtiff = True)
+        return
+
+    def writeFrame(self, frame, meta):
+        if (frame.ndim == 3) and (frame.shape[2] == 3):
+            frame = frame[:, :, ::-1] # OpenCV BGR to RGB
+            photometric = 'rgb'
+        else:
+            photometric = 'minisblack'
+
+        self.tiff.write(frame,
+                        photometric = photometric,
+                        description = json.dumps(meta) if meta is not None else None,
+                        metadata = None)
+        return
+
+    def closeFile(self):
+        self.tiff.close()
+        return
+
+
+class volumeWriter(frameWriter):
+    """
+    Chunked, compressed (angle, z, y, x) volume store
+
+    Written in Zarr v2 format without needing zarr installed:
+    a directory holding .zarray (shape, chunks, dtype), .zattrs 
+    (stage coordinates of each angle + z index) and one zlib-compressed 
+    file per chunk. Open with zarr.open(fileName) or dask/napari.
+
+    Angle and z indices are assigned in order of first appearance of each
+    rotationPosition and lensPosition in frame metadata. There is one plane
+    per position, so a second frame at a position raises ValueError
+    (accumulate repeats before writing them).
+    Colour frames are stored as grayscale.
+    """
+
+    extension = '.zarr'
+    streams = False # Stream frames mostly share a position
+    compressionLevel = 1 # zlib level. Low for speed; planes are mostly dark.
+
+    def openFile(self):
+        self.fileName.mkdir(parents = True, exist_ok = True)
+        self.chunkSize = self.paramDict.get('chunkSize', 256) # y, x chunk edge, pixels
+
+        self.angles = [] # rotationPosition of each angle index
+        self.zPositions = [] # lensPosition of each z index
+        self.planeShape = None
+        self.dtype = None
+        self.written = set() # (angle, z) indices of planes written
+
+        return
+
+    def positionIndex(self, positions, value):
+        """
+        Index of value in positions list, appended if new
+        """
+        if value not in positions:
+            positions.append(value)
+        return positions.index(value)
+
+    def writeJSON(self, name, content):
+        # Write to temp file then rename so readers never see a partial file
+        tmpName = self.fileName / (name + '.tmp')
+        with open(tmpName, 'w') as f:
+            json.dump(content, f)
+        os.replace(tmpName, self.fileName / name)
+        return
+
+    def writeHeader(self):
+        """
+        (Re)write .zarray + .zattrs for current volume shape
+        """
+        self.writeJSON('.zarray', {'zarr_format' : 2,
+                                   'shape' : [len(self.angles), len(self.zPositions)] + list(self.planeShape),
+                                   'chunks' : [1, 1, self.chunkSize, self.chunkSize],
+                                   'dtype' : self.dtype.str,
+                                   'compressor' : {'id' : 'zlib', 'level' : self.compressionLevel},
+                                   'fill_value' : 0,
+                                   'order' : 'C',
+                                   'filters' : None,
+                                   'dimension_separator' : '.'})
+
+        self.writeJSON('.zattrs', {'_ARRAY_DIMENSIONS' : ['angle', 'z', 'y', 'x'],
+                                   'rotationPosition' : self.angles,
+                                   'lensPosition' : self.zPositions})
+        return
+
+    def writeFrame(self, frame, meta):
+        if frame.ndim == 3:
+            from cv2 import cvtColor, COLOR_BGR2GRAY
+            frame = cvtColor(frame, COLOR_BGR2GRAY)
+
+        if self.planeShape is None:
+            self.planeShape = tuple(frame.shape)
+            self.dtype = frame.dtype
+
+        meta = meta if meta is not None else {}
+        nIndices = (len(self.angles), len(self.zPositions))
+        a = self.positionIndex(self.angles, meta.get('rotationPosition', 0))
+        z = self.positionIndex(self.zPositions, meta.get('lensPosition', 0))
+
+        if (a, z) in self.written:
+            raise ValueError('Second frame at rotation {}, lens {}; zarr holds one plane per position'.format(self.angles[a], self.zPositions[z]))
+        self.written.add((a, z))
+
+        # Cut plane into chunks. Edge chunks are zero-padded to full size.
+        c = self.chunkSize
+        for yc in range(0, self.planeShape[0], c):
+            for xc in range(0, self.planeShape[1], c):
+                block = frame[yc:yc+c, xc:xc+c]
+                if block.shape != (c, c):
+                    padded = np.zeros((c, c), dtype = self.dtype)
+                    padded[:block.shape[0], :block.shape[1]] = block
+                    block = padded
+
+                chunkName = '{}.{}.{}.{}'.format(a, z, yc // c, xc // c)
+                with open(self.fileName / chunkName, 'wb') as f:
+                    f.write(zlib.compress(np.ascontiguousarray(block).data, self.compressionLevel))
+
+        if (len(self.angles), len(self.zPositions)) != nIndices:
+            self.writeHeader() # Volume grew
+
+        return
+
+    def closeFile(self):
+        if self.planeShape is not None:
+            self.writeHeader()
+        return
+
+class segmentedWriter(frameWriter):
+    """
+    Crash-safe raw recording: directory of fixed-size .npy segments
+
+        name.seg/
+            manifest.json - frame shape, dtype, segments + frame counts
+            index.csv - one row per frame (seq, capture time, stage state)
+            segment_00000.npy, segment_00001.npy, ... - segmentFrames frames each
+
+    Manifest + first segment are on disk from the first frame. After that,
+    every flushInterval seconds and whenever a segment fills, the open
+    segment's header is rewritten w/ its current frame count, data +
+    index are fsync'd and the manifest is replaced atomically. Each
+    segment is a valid .npy file up to the last flush, so a crash costs
+    at most flushInterval seconds of frames. Existing segment files are
+    never opened for writing again; a resumed recording starts a new one.
+
+    paramDict keys used:
+        - 'segmentFrames' : int, frames per segment (default 256)
+        - 'flushInterval' : float, s between flushes (default 2)
+        - 'resume' : bool, append to an existing recording in fileName
+                     after recoverSegments() instead of starting over
+    """
+
+    extension = '.seg'
+    headerLength = 128 # bytes, as rawStackWriter
+    manifestName = 'manifest.json'
+    indexName = 'index.csv'
+
+    def openFile(self):
+        self.segmentFrames = int(self.paramDict.get('segmentFrames', 256))
+        self.flushInterval = self.paramDict.get('flushInterval', 2.0)
+
+        self.segment = None # Open segment file
+        self.segmentCount = 0 # Frames in open segment
+        self.lastFlush = None # Flushed straight after first frame
+        self.resumed = False
+
+        existing = (self.fileName / self.manifestName).exists() or (len(list(self.fileName.glob('segment_*.npy'))) > 0)
+
+        if existing and self.paramDict.get('resume', False):
+            self.manifest = recoverSegments(self.fileName)
+            self.frameCount = self.manifest['frames'] # Index rows carry on from last frame
+            self.lastFlush = time.monotonic()
+            self.resumed = True
+        elif existing:
+            raise FileExistsError('{} already holds a recording; resume it or pick a new name'.format(self.fileName))
+        else:
+            self.fileName.mkdir(parents = True, exist_ok = True)
+            self.manifest = None # Written on first frame, once shape is known
+
+        return
+
+    def metaFileName(self):
+        return self.fileName / self.indexName
+
+    def openMeta(self, meta):
+        indexFile = self.metaFileName()
+        if not(self.resumed) or not(indexFile.exists()):
+            return super().openMeta(meta)
+
+        # Carry on w/ columns of existing index
+        with open(indexFile, 'r', newline = '') as f:
+            fieldnames = next(csv.reader(f))
+        self.metaFile = open(indexFile, 'a', newline = '')
+        self.metaWriter = csv.DictWriter(self.metaFile, fieldnames = fieldnames, extrasaction = 'ignore')
+
+        return
+
+    def write(self, frame, meta = None):
+        super().write(frame, meta)
+
+        if self.segmentCount >= self.segmentFrames:
+            self.closeSegment() # Flushes
+        elif (self.lastFlush is None) or ((time.monotonic() - self.lastFlush) > self.flushInterval):
+            self.flush()
+
+        return
+
+    def writeFrame(self, frame, meta):
+        if self.manifest is None:
+            self.manifest = {'format' : 'cheesoSPIM segments',
+                             'version' : 1,
+                             'frameShape' : list(frame.shape),
+                             'dtype' : frame.dtype.str,
+                             'segmentFrames' : self.segmentFrames,
+                             'headerLength' : self.headerLength,
+                             'frameRate' : self.paramDict.get('frameRate'),
+                             'segments' : [],
+                             'frames' : 0,
+                             'complete' : False}
+        elif (list(frame.shape) != self.manifest['frameShape']) or (frame.dtype.str != self.manifest['dtype']):
+            raise ValueError('Frame {} {} does not match recording {} {}'.format(frame.shape, frame.dtype, 
+                                                                                 self.manifest['frameShape'], 
+                                                                                 self.manifest['dtype']))
+
+        if self.segment is None:
+            self.openSegment()
+
+        self.segment.write(np.ascontiguousarray(frame).data)
+        self.segmentCount += 1
+        self.manifest['segments'][-1]['frames'] = self.segmentCount
+
+        return
+
+    def openSegment(self):
+        if len(self.manifest['segments']) > 0:
+            number = int(self.manifest['segments'][-1]['file'][8:13]) + 1 # After last segment_NNNNN.npy
+        else:
+            number = 0
+        name = 'segment_{:05d}.npy'.format(number)
+
+        self.segment = open(self.fileName / name, 'xb') # Fails rather than truncate an existing segment
+        self.segmentCount = 0
+        self.segment.write(self.segmentHeader()) # Valid (empty) .npy until first flush
+        self.manifest['segments'].append({'file' : name, 'frames' : 0})
+
+        return
+
+    def segmentHeader(self):
+        return npyHeader(self.manifest['dtype'],
+                         [self.segmentCount] + self.manifest['frameShape'],
+                         self.headerLength)
+
+    def flush(self):
+        """
+        Make everything written so far readable after a crash
+        Data first, then index, then manifest that points at them.
+        """
+        if self.segment is not None:
+            self.segment.seek(0)
+            self.segment.write(self.segmentHeader())
+            self.segment.seek(0, os.SEEK_END)
+            self.segment.flush()
+            os.fsync(self.segment.fileno())
+
+        if self.metaFile is not None:
+            self.metaFile.flush()
+            os.fsync(self.metaFile.fileno())
+
+        if self.manifest is not None:
+            self.manifest['frames'] = sum(seg['frames'] for seg in self.manifest['segments'])
+            writeManifest(self.fileName, self.manifest)
+
+        self.lastFlush = time.monotonic()
+
+        return
+
+    def closeSegment(self):
+        self.flush()
+        self.segment.close()
+        self.segment = None
+        self.segmentCount = 0
+
+        return
+
+    def close(self):
+        if self.segment is not None:
+            self.closeSegment()
+
+        if self.manifest is not None:
+            self.manifest['complete'] = True
+            self.flush()
+
+        super().close()
+
+        return
+
+
+def writeManifest(path, manifest):
+    """
+    Replace manifest.json in recording path atomically (temp file + rename)
+    """
+    path = pathlib.Path(path)
+    tmpName = path / (segmentedWriter.manifestName + '.tmp')
+    with open(tmpName, 'w') as f:
+        json.dump(manifest, f, indent = 1)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmpName, path / segmentedWriter.manifestName)
+
+    return
+
+def recoverSegments(path):
+    """
+    Repair a 'segments' recording that was cut short, eg by a crash
+
+    Frames on disk are counted from segment file sizes, so frames written
+    after the last flush are kept too. A partly written last frame is cut
+    off, each segment header is rewritten w/ its real count, index rows
+    past the last whole frame (or a half written row) are dropped, and the
+    manifest is rewritten to match. If there is no manifest it is rebuilt
+    from the segment headers (frame rate is then unknown).
+    Returns manifest dict. Safe to run on a complete recording.
+    """
+    path = pathlib.Path(path)
+    manifestFile = path / segmentedWriter.manifestName
+    if manifestFile.exists():
+        with open(manifestFile, 'r') as f:
+            manifest = json.load(f)
+    else:
+        manifest = rebuildManifest(path)
+
+    frameBytes = int(np.prod(manifest['frameShape'])) * np.dtype(manifest['dtype']).itemsize
+    headerLength = manifest['headerLength']
+
+    segments = []
+    for segmentFile in sorted(path.glob('segment_*.npy')):
+        nFrames = max(segmentFile.stat().st_size - headerLength, 0) // frameBytes
+
+        with open(segmentFile, 'r+b') as f:
+            f.truncate(headerLength + nFrames * frameBytes)
+            f.seek(0)
+            f.write(npyHeader(manifest['dtype'], [nFrames] + manifest['frameShape'], headerLength))
+            f.flush()
+            os.fsync(f.fileno())
+
+        segments.append({'file' : segmentFile.name, 'frames' : nFrames})
+
+    manifest['segments'] = segments
+    manifest['frames'] = sum(seg['frames'] for seg in segments)
+
+    indexFile = path / segmentedWriter.indexName
+    if indexFile.exists():
+        with open(indexFile, 'r', newline = '') as f:
+            lines = f.readlines()
+        if (len(lines) > 0) and not(lines[-1].endswith('\n')):
+            lines = lines[:-1] # Half written row
+        lines = lines[:manifest['frames'] + 1] # Header + one row per frame on disk
+        with open(indexFile, 'w', newline = '') as f:
+            f.writelines(lines)
+        manifest['indexedFrames'] = max(len(lines) - 1, 0)
+
+    writeManifest(path, manifest)
+
+    return manifest
+
+def rebuildManifest(path):
+    """
+    Manifest for a 'segments' recording from the .npy headers of its segments
+    Frame shape + dtype come from the first segment w/ a readable header.
+    """
+    path = pathlib.Path(path)
+    segmentFiles = sorted(path.glob('segment_*.npy'))
+
+    for segmentFile in segmentFiles:
+        try:
+            with open(segmentFile, 'rb') as f:
+                if np.lib.format.read_magic(f) != (1, 0): # npyHeader() writes v1.0
+                    continue
+                shape, fortranOrder, dtype = np.lib.format.read_array_header_1_0(f)
+                headerLength = f.tell()
+        except ValueError:
+            continue # Header never written
+
+        return {'format' : 'cheesoSPIM segments',
+                'version' : 1,
+                'frameShape' : list(shape[1:]),
+                'dtype' : dtype.str,
+                'segmentFrames' : max(shape[0], 1),
+                'headerLength' : headerLength,
+                'frameRate' : None,
+                'segments' : [],
+                'frames' : 0,
+                'complete' : False}
+
+    raise ValueError('No manifest or readable segment in {}, nothing to recover'.format(path))
+
+def readSegments(path):
+    """
+    Frames of a 'segments' recording as list of read-only memory-mapped 
+    (n, h, w) arrays, one per segment. np.concatenate() for one array.
+    """
+    path = pathlib.Path(path)
+    with open(path / segmentedWriter.manifestName, 'r') as f:
+        manifest = json.load(f)
+
+    return [np.load(path / seg['file'], mmap_mode = 'r') for seg in manifest['segments'] if seg['frames'] > 0]
+
+
+writerBackends = {'avi' : aviWriter,
+                  'raw' : rawStackWriter,
+                  'tiff' : tiffStackWriter,
+                  'zarr' : volumeWriter,
+                  'segments' : segmentedWriter}
+
+# Backends that can record a camera stream (Record button, acquisitionEngine.record())
+streamFormats = [name for name, writer in writerBackends.items() if writer.streams]
+
+
+traceInterval = 0.5 # s between batches of timing events from writeVideo
+
+
+def sendTrace(traceQueue, events):
+    '''
+    Put batch of timing events on traceQueue w/o waiting.
+    Batch is dropped if nobody is draining the queue.
+    '''
+    if len(events) > 0:
+        try:
+            traceQueue.put_nowait(events)
+        except Full:
+            pass
+    return
+
+
+def writeVideo(queue, paramDict):
+    """
+    Video write method
+    Separate method to support multiprocessing
+    
+    Frames are read by sequence number from the camera's shared-memory
+    frameBuffer, so only frameRecords (seq, capture time, stage state) 
+    travel through queue.
+    Median filter for hot pixels is applied here, off the GUI process, 
+    unless frames come from an already filtered buffer (framePreprocessor).
+    
+    Arguments:
+        - queue = multiprocessing.Queue() or equivalent
+                    Queue to pull frameBuffer.frameRecord items from, None to finish
+        - paramDict = dict with keys = values:
+                    'fileName' - str, file path of output
+                    'format' - str, key in frameWriters.writerBackends
+                    'frameRate' - float, frame rate of camera
+                    'size' - tuple of ints, width x height
+                    'frameBuffer' - dict, frameRingBuffer.description()
+                    'medianFilterSize' - int, odd, hot pixel filter size. 
+                                         1 or None if frames are already filtered.
+                    'timingQueue' - optional multiprocessing.Queue. If given, 
+                                    gets dict of (seq, write time) pairs, 
+                                    overwritten frame count + writer.timing() on close. 
+                                    time.monotonic() clock, for benchmarking.
+                    'traceQueue' - optional multiprocessing.Queue. If given, gets 
+                                   lists of (seq, stage, start, end) 'filter' + 
+                                   'write' events for stageTimer.merge(), 
+                                   every traceInterval seconds.
+                    'overwrittenCount' - optional multiprocessing.Value. If given,
+                                         counts frames overwritten before write, live.
+                    + any options of the writer backend (eg 'segmentFrames', 'resume')
+    
+    Ends on None from queue, or once queue is empty if the acquiring 
+    process has died. Run as a non-daemon process so it isn't killed 
+    w/ the acquiring process before the file is closed.
+    """
+    frameBuffer = frameRingBuffer.attach(paramDict['frameBuffer'])
+    
+    # Init writer for requested format
+    writer = writerBackends[paramDict['format']](paramDict['fileName'], paramDict)
+    
+    timingQueue = paramDict.get('timingQueue', None)
+    writeTimes = [] # (seq, time written), only kept if timingQueue given
+    nOverwritten = 0
+    overwrittenCount = paramDict.get('overwrittenCount', None)
+    
+    filterSize = paramDict.get('medianFilterSize', None)
+    doFilter = (filterSize is not None) and (filterSize > 1)
+    
+    traceQueue = paramDict.get('traceQueue', None)
+    traceEvents = [] # Batched so queue traffic stays ~independent of frame rate
+    lastTraceSend = time.monotonic()
+
+    # Acquiring process. If it dies mid-record, frames already queued are
+    # still written and file is closed properly instead of left half done.
+    parent = multiprocessing.parent_process()
+
+    while (True):
+        # Pull last frame out of queue
+        try:
+            item = queue.get(timeout = 1)
+        except Empty:
+            if (parent is not None) and not(parent.is_alive()):
+                print('Acquiring process gone, closing {}'.format(paramDict['fileName']))
+                break
+            continue
+
+        if item is None: # Return from closed queue
+            break # Get out of while loop
+        
+        # item is frameRecord. Pull frame from shared memory.
+        seq = item.seq
+        # Filter output is already a copy; unfiltered frame is copied so
+        # camera can't reuse the slot while it is being written
+        t0 = time.monotonic()
+        frame = frameBuffer.read(seq, copy = not(doFilter))
+        
+        if (frame is not None) and doFilter:
+            frame = medianBlur(frame, filterSize)
+            if frameBuffer.slotSeq[seq % frameBuffer.nSlots] != seq:
+                frame = None # Overwritten while filtering from live view
+        t1 = time.monotonic()
+        
+        if frame is None:
+            # Camera has already overwritten this slot
+            print('Frame {} overwritten before write!'.format(seq))
+            nOverwritten += 1
+            if overwrittenCount is not None:
+                overwrittenCount.value += 1 # Only this process writes it
+        else:
+            # Write filtered frame to file.
+            writer.write(frame, item.meta())
+            t2 = time.monotonic()
+            
+            if timingQueue is not None:
+                writeTimes.append((seq, t2))
+                
+            if traceQueue is not None:
+                if doFilter:
+                    traceEvents.append((seq, 'filter', t0, t1))
+                traceEvents.append((seq, 'write', t1, t2))
+                
+                if (t2 - lastTraceSend) > traceInterval:
+                    sendTrace(traceQueue, traceEvents)
+                    traceEvents = []
+                    lastTraceSend = t2
+        
+    # Executed after break call
+    # Close file
+    writer.close()
+    
+    timing = writer.timing()
+    if timing['measuredFps'] is not None:
+        print('Wrote {} frames : {:.2f} fps measured ({} nominal), {} missing'.format(timing['frames'],
+                                                                                     timing['measuredFps'],
+                                                                                     timing['nominalFps'],
+                                                                                     timing['missing']))
+        
+    frameBuffer.close() # Detach from shared memory
+    
+    if traceQueue is not None:
+        sendTrace(traceQueue, traceEvents)
+    
+    if timingQueue is not None:
+        timingQueue.put({'writeTimes' : writeTimes, 
+                         'overwritten' : nOverwritten,
+                         'timing' : timing})
+
+    return
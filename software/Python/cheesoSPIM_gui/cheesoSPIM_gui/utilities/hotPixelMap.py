@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+"""
+Hot + dead pixel map from dark frames
+
+Alternative to a full-frame median blur for hot pixel removal.
+A stack of dark frames (laser off, camera covered) is reduced to
+a per-pixel mean and temporal standard deviation:
+    - hot pixels : mean far above the rest of the chip
+    - dead / stuck pixels : (almost) no temporal noise where the rest of the chip has some
+Only those pixels are repaired on each frame, each replaced by the
+mean of its good 8-connected neighbours. Everything else is untouched,
+so fine detail survives, and the cost scales with the number of bad
+pixels instead of the frame size.
+
+Maps depend on sensor, exposure and frame shape, so they are cached
+on disk under a name made from all three (see cacheFile()).
+
+@author: rusty
+"""
+
+import pathlib
+import re
+
+import numpy as np
+
+
+minDeadFrames = 8 # Dark frames needed before zero temporal noise flags a dead pixel
+
+class hotPixelMap():
+    """
+    Bad pixel coordinates + neighbour lookup for repair
+    """
+
+    def __init__(self, frameShape, badIndex, neighbourIndex, neighbourWeight, nHot = 0, nDead = 0):
+        """
+        Normally made with calibrate() or load()
+
+        Arguments:
+            - frameShape = tuple of ints, (h, w) or (h, w, c)
+            - badIndex = int array (nBad,), flat pixel index (y * w + x) of bad pixels
+            - neighbourIndex = int array (nBad, 8), flat index of each bad pixel's neighbours
+            - neighbourWeight = float32 array (nBad, 8), 1 for usable neighbour, 0 otherwise
+        """
+        self.frameShape = tuple(int(k) for k in frameShape)
+        self.badIndex = np.asarray(badIndex, dtype = np.intp)
+        self.neighbourIndex = np.asarray(neighbourIndex, dtype = np.intp)
+        self.neighbourWeight = np.asarray(neighbourWeight, dtype = np.float32)
+        self.nHot = int(nHot)
+        self.nDead = int(nDead)
+        self.fileName = None # Set when saved or loaded
+
+        # Normalise once so repair is a single weighted sum
+        wSum = self.neighbourWeight.sum(axis = 1, keepdims = True)
+        self.neighbourWeight = self.neighbourWeight / np.maximum(wSum, 1)
+
+        return
+
+    @classmethod
+    def calibrate(cls, darkFrames, hotSigma = 6.0, deadFraction = 0.05):
+        """
+        Build map from iterable of dark frames (all same shape)
+
+        Arguments:
+            - darkFrames = iterable of numpy arrays, (h, w) or (h, w, c)
+            - hotSigma = float, mean this many robust SDs above chip median is hot
+            - deadFraction = float, temporal SD below this fraction of chip median SD is dead.
+                             Only checked w/ minDeadFrames or more frames.
+        """
+        total = None
+        totalSq = None
+        n = 0
+        for frame in darkFrames:
+            f = frame.astype(np.float64)
+            if total is None:
+                frameShape = frame.shape
+                total = np.zeros_like(f)
+                totalSq = np.zeros_like(f)
+            total += f
+            totalSq += f * f
+            n += 1
+
+        if n < 2:
+            raise ValueError("Need at least 2 dark frames, got {}".format(n))
+
+        mean = total / n
+        sd = np.sqrt(np.maximum(totalSq / n - mean * mean, 0))
+
+        if mean.ndim == 3:
+            # Defect on any colour channel marks the whole pixel
+            mean = mean.max(axis = 2)
+            sd = sd.min(axis = 2)
+
+        # Robust spread of chip, so hot pixels themselves don't inflate it
+        med = np.median(mean)
+        robustSD = 1.4826 * np.median(np.abs(mean - med))
+        robustSD = max(robustSD, np.median(sd), 1e-3) # Flat dark frames (eg 8-bit, all 0s) have MAD 0
+
+        hot = mean > (med + hotSigma * robustSD)
+        
+        # Stuck pixels. Needs enough frames for 'no noise' to mean something,
+        # and pixels clipped at 0 are quiet w/o being faulty, so they're left out.
+        dead = (sd < (deadFraction * np.median(sd))) & (mean > 0) & ~hot
+        if (n < minDeadFrames) or (np.median(sd) == 0):
+            dead[:] = False # No noise to judge by
+
+        badMask = hot | dead
+
+        return cls.fromMask(frameShape, badMask, nHot = hot.sum(), nDead = dead.sum())
+
+    @classmethod
+    def fromMask(cls, frameShape, badMask, nHot = 0, nDead = 0):
+        """
+        Build neighbour lookup for every True pixel in badMask (h, w)
+        """
+        h, w = badMask.shape
+        ys, xs = np.nonzero(badMask)
+
+        offsets = [(-1, -1), (-1, 0), (-1, 1), (0, -1), (0, 1), (1, -1), (1, 0), (1, 1)]
+        dy = np.array([o[0] for o in offsets])
+        dx = np.array([o[1] for o in offsets])
+
+        ny = ys[:, None] + dy[None, :]
+        nx = xs[:, None] + dx[None, :]
+        inside = (ny >= 0) & (ny < h) & (nx >= 0) & (nx < w)
+        ny = np.clip(ny, 0, h - 1)
+        nx = np.clip(nx, 0, w - 1)
+
+        # Neighbours that are themselves bad don't count
+        usable = inside & ~badMask[ny, nx]
+
+        return cls(frameShape,
+                   ys * w + xs,
+                   ny * w + nx,
+                   usable.astype(np.float32),
+                   nHot = nHot,
+                   nDead = nDead)
+
+    def __len__(self):
+        return len(self.badIndex)
+
+    def fits(self, frame):
+        """
+        True if map was made for frames of this shape
+        """
+        return tuple(frame.shape) == self.frameShape
+
+    def repair(self, frame, dst = None):
+        """
+        Replace bad pixels w/ mean of good neighbours
+
+        frame is left alone unless it is also dst. Pass dst = frame to repair in place.
+        Returns repaired frame
+        """
+        if dst is None:
+            dst = frame.copy()
+        elif dst is not frame:
+            dst[...] = frame
+
+        if len(self.badIndex) == 0:
+            return dst
+
+        h, w = self.frameShape[:2]
+        src = frame.reshape(h * w, -1) # (pixels, channels), view
+        out = dst.reshape(h * w, -1)
+
+        # (nBad, 8, channels) -> weighted sum over neighbours
+        values = src[self.neighbourIndex].astype(np.float32)
+        fixed = np.einsum('bnc,bn->bc', values, self.neighbourWeight)
+
+        if np.issubdtype(dst.dtype, np.integer):
+            fixed = np.rint(fixed)
+        out[self.badIndex] = fixed.astype(dst.dtype)
+
+        return dst
+
+    def save(self, fileName):
+        """
+        Write map to .npz
+        """
+        np.savez(fileName,
+                 frameShape = np.array(self.frameShape),
+                 badIndex = self.badIndex,
+                 neighbourIndex = self.neighbourIndex,
+                 neighbourMask = self.neighbourWeight > 0,
+                 counts = np.array([self.nHot, self.nDead]))
+        self.fileName = pathlib.Path(fileName)
+        return
+
+    @classmethod
+    def load(cls, fileName):
+        """
+        Read map written by save()
+        """
+        with np.load(fileName) as d:
+            newMap = cls(tuple(d['frameShape']),
+                         d['badIndex'],
+                         d['neighbourIndex'],
+                         d['neighbourMask'].astype(np.float32),
+                         nHot = d['counts'][0],
+                         nDead = d['counts'][1])
+        newMap.fileName = pathlib.Path(fileName)
+
+        return newMap
+
+
+def cacheFile(cacheDir, cameraID, exposureTime, frameShape):
+    """
+    Path of cached map for this camera, exposure (ms) and frame shape
+    """
+    camTag = re.sub(r'[^A-Za-z0-9]+', '_', str(cameraID)).strip('_')
+    shapeTag = 'x'.join(str(k) for k in frameShape)
+
+    return pathlib.Path(cacheDir) / 'hotPixels_{}_{}ms_{}.npz'.format(camTag, exposureTime, shapeTag)
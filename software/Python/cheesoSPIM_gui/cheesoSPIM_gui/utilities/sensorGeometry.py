@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""
+Region of interest (ROI) + pixel binning done on frames in software
+
+Fallback for cameras that can't crop or bin on the chip. Applied by
+the camera object to each frame before it goes into the frame buffer,
+so everything downstream (filter, display, writer) only ever sees the
+smaller frame.
+    - crop is a numpy view, no copy
+    - binning is a block mean over binning x binning pixels (cv2
+      INTER_AREA w/ an integer factor), so dtype + bit depth are kept
+
+ROIs are (x, y, width, height) tuples in pixels.
+
+@author: rusty
+"""
+
+import cv2
+
+
+def checkROI(roi):
+    """
+    ROI as tuple of ints, or None for full frame
+    Raises ValueError if it isn't 4 values w/ positive size
+    """
+    if roi is None:
+        return None
+
+    roi = tuple(int(v) for v in roi)
+    if (len(roi) != 4) or (roi[0] < 0) or (roi[1] < 0) or (roi[2] < 1) or (roi[3] < 1):
+        raise ValueError("ROI must be (x, y, width, height) w/ x, y >= 0 and size >= 1, got {}".format(roi))
+
+    return roi
+
+def scaleROI(roi, binning):
+    """
+    ROI in unbinned pixels -> ROI in pixels binned by binning
+    """
+    if (roi is None) or (binning == 1):
+        return roi
+
+    x, y, w, h = roi
+    return (x // binning, y // binning, max(w // binning, 1), max(h // binning, 1))
+
+def outputSize(width, height, roi = None, binning = 1):
+    """
+    (width, height) of a width x height frame after cropAndBin()
+    """
+    if roi is not None:
+        x, y, w, h = roi
+        width = max(min(w, width - x), 0)
+        height = max(min(h, height - y), 0)
+
+    return (width // binning, height // binning)
+
+def cropAndBin(frame, roi = None, binning = 1):
+    """
+    Crop frame to roi, then bin binning x binning pixels into one
+    Rows / columns that don't fill a whole bin are dropped.
+    Returns frame unchanged (no copy) if there's nothing to do.
+    """
+    if roi is not None:
+        x, y, w, h = roi
+        frame = frame[y:y + h, x:x + w]
+
+    if binning > 1:
+        h, w = frame.shape[:2]
+        w, h = w // binning, h // binning
+        frame = cv2.resize(frame[:h * binning, :w * binning], (w, h), interpolation = cv2.INTER_AREA)
+
+    return frame
@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+"""
+Synthetic camera for running the GUI and acquisition pipeline w/o hardware
+
+Registered as the 'synthetic' camera backend (cameraBackends.openCamera).
+Runs the OpenCV backend (cv2Camera.camera) unchanged, w/ frames from
+syntheticSource, which stands in for cv2.VideoCapture, so capability
+probing + parameter setting go through the same code as a real camera.
+Frame size, rate, bit depth and channel count are configurable.
+Exposure (ms) and gain (dB) can be set through the usual
+CAP_PROP_EXPOSURE / CAP_PROP_GAIN and scale frame brightness;
+exposure longer than the frame interval slows the frame rate.
+With hardwareGeometry, ROI + binning are done by the source, as on a
+scientific camera, and fps scales up as fewer sensor rows are read out.
+A small bank of frames (noisy Gaussian spot at a few positions) is made
+up front and cycled, so generating frames costs ~nothing and the rate
+you get is the rate the rest of the pipeline can take.
+
+@author: rusty
+"""
+
+import time
+
+import cv2
+import numpy as np
+
+from cheesoSPIM_gui.utilities import cv2Camera
+from cheesoSPIM_gui.utilities import sensorGeometry
+
+
+simDefaults = {'width' : 1280,
+               'height' : 720,
+               'fps' : 30, # frames per second, full chip. 0 for as fast as possible.
+               'bitDepth' : 16, # 8 (uint8) or 16 (uint16, 12-bit data)
+               'channels' : 1, # 1 for mono like a scientific camera, 3 for BGR like a webcam
+               'exposureTime' : 10, # ms. Signal scales w/ exposure relative to this default.
+               'gainValue' : 0, # dB
+               'hardwareGeometry' : False, # True reports ROI + binning capability and does them in source
+               'nBank' : 16} # distinct frames generated, then cycled
+
+
+class syntheticSource():
+    """
+    Stand-in for cv2.VideoCapture. read() paces itself to fps.
+    """
+
+    def __init__(self, simParams):
+        self.params = dict(simDefaults)
+        self.params.update(simParams)
+        self.refExposure = self.params['exposureTime'] # Exposure for nominal brightness
+        self.roi = None # Source ROI, (x, y, w, h) in binned pixels. None for full chip.
+        self.binning = 1 # Source binning
+
+        self.bank = self.makeBank()
+        self.count = 0
+        self.nextTime = time.monotonic()
+
+        return
+
+    def makeBank(self):
+        """
+        nBank frames of a Gaussian spot drifting across a noisy background
+        """
+        p = self.params
+        h, w = p['height'], p['width']
+        maxVal = 255 if p['bitDepth'] == 8 else 4095 # 12-bit sensor in 16-bit container
+        dtype = np.uint8 if p['bitDepth'] == 8 else np.uint16
+
+        rng = np.random.default_rng(0)
+        y = np.arange(h, dtype = np.float32)[:, None]
+        x = np.arange(w, dtype = np.float32)[None, :]
+        sigma = min(h, w) / 10
+        scale = (p['exposureTime'] / self.refExposure) * 10**(p['gainValue'] / 20)
+
+        bank = []
+        for k in range(p['nBank']):
+            cx = w * (0.25 + 0.5 * k / max(p['nBank'] - 1, 1))
+            spot = np.exp(-((x - cx)**2 + (y - h/2)**2) / (2 * sigma**2))
+            frame = scale * (0.6 * maxVal * spot + rng.normal(0.05 * maxVal, 0.02 * maxVal, (h, w)))
+            frame = np.clip(frame, 0, maxVal).astype(dtype)
+
+            # Binned on chip, then ROI in binned pixels
+            frame = sensorGeometry.cropAndBin(frame, None, self.binning)
+            frame = np.ascontiguousarray(sensorGeometry.cropAndBin(frame, self.roi))
+
+            if p['channels'] == 3:
+                frame = np.repeat(frame[:, :, None], 3, axis = 2)
+            bank.append(frame)
+
+        return bank
+
+    def read(self):
+        """
+        Next frame, after waiting for its slot at fps
+        Returns (True, frame) as cv2.VideoCapture.read()
+        """
+        if self.params['fps'] > 0:
+            # Can't read out faster than exposure allows
+            self.nextTime += max(self.readoutTime(), self.params['exposureTime'] / 1000)
+            delay = self.nextTime - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                self.nextTime = time.monotonic() # Fell behind; don't try to catch up
+
+        frame = self.bank[self.count % len(self.bank)].copy()
+        self.count += 1
+
+        return True, frame
+
+    def readoutTime(self):
+        """
+        s to read out a frame. Full chip at fps; fewer rows (ROI / binning) are quicker.
+        """
+        rows = self.bank[0].shape[0] * self.binning
+        return (1.0 / self.params['fps']) * rows / self.params['height']
+
+    def setGeometry(self, roi, binning):
+        """
+        Source-side ROI (binned pixels, None for full chip) + binning
+        """
+        self.binning = binning
+        self.roi = roi
+        self.bank = self.makeBank()
+
+        return True
+
+    def set(self, propID, value):
+        """
+        Set fps, exposure (ms) or gain (dB) as cv2.VideoCapture.set()
+        Returns False for anything else.
+        """
+        if propID == cv2.CAP_PROP_FPS:
+            self.params['fps'] = max(float(value), 0)
+        elif propID == cv2.CAP_PROP_EXPOSURE:
+            self.params['exposureTime'] = max(float(value), 0.01)
+            self.bank = self.makeBank()
+        elif propID == cv2.CAP_PROP_GAIN:
+            self.params['gainValue'] = float(value)
+            self.bank = self.makeBank()
+        else:
+            return False
+
+        return True
+
+    def get(self, propID):
+        """
+        Read property as cv2.VideoCapture.get(). 0 if unsupported.
+        """
+        if propID == cv2.CAP_PROP_FPS:
+            if self.params['fps'] <= 0:
+                return 0
+            return min(1 / self.readoutTime(), 1000 / self.params['exposureTime'])
+
+        props = {cv2.CAP_PROP_FRAME_WIDTH : self.bank[0].shape[1],
+                 cv2.CAP_PROP_FRAME_HEIGHT : self.bank[0].shape[0],
+                 cv2.CAP_PROP_EXPOSURE : self.params['exposureTime'],
+                 cv2.CAP_PROP_GAIN : self.params['gainValue']}
+
+        return props.get(propID, 0)
+
+    def getBackendName(self):
+        return 'SYNTHETIC'
+
+    def release(self):
+        return
+
+
+class camera(cv2Camera.camera):
+    """
+    cv2Camera.camera fed by syntheticSource
+    """
+
+    backendName = 'synthetic'
+
+    def __init__(self, camSourceID = 0, simParams = None):
+        """
+        simParams - dict, overrides for simDefaults
+        """
+        self.simParams = simParams if simParams is not None else {}
+
+        super().__init__(camSourceID)
+
+        self.camName = 'Simulated camera'
+        self.bitDepth = self.cam.params['bitDepth']
+        self.camID = '{}x{} @ {} fps'.format(self.cam.params['width'],
+                                            self.cam.params['height'],
+                                            self.cam.params['fps'])
+        return
+
+    def openSource(self, camSourceID):
+        return syntheticSource(self.simParams)
+
+    def probeCapabilities(self):
+        caps = super().probeCapabilities()
+        caps['roi'] = self.cam.params['hardwareGeometry']
+        caps['binning'] = self.cam.params['hardwareGeometry']
+        return caps
+
+    def applyParameter(self, name, value):
+        if name == 'binning':
+            return self.cam.setGeometry(self.cam.roi, value)
+        if name == 'roi':
+            return self.cam.setGeometry(value, self.cam.binning)
+
+        return super().applyParameter(name, value)
@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+"""
+Simulated cheesoSPIM serial device
+
+Stands in for serial.Serial connected to an Arduino running cheesoSPIM.ino.
+Pass to cheesoSPIM_driver in place of a real port:
+    scope = cheesoSPIM_driver(simSerial())
+
+Implements the sketch's command set, including ';' batches, !<token>
+acknowledgements and sequence mode. Commands run in a device thread in
+order, with move latencies modelled on the hardware, so timing through
+the driver looks like the real thing.
+
+@author: rusty
+"""
+
+import queue
+import threading
+import time
+
+
+simTiming = {'stepTime' : 0.0015, # s per motor step. 20 steps/rev at setSpeed(2000) rpm
+             'lensByteDelay' : 0.030, # s after each of 4 SPI bytes per lens move
+             'lensEndTime' : 0.5, # s for lens to drive to an end stop (V, B)
+             'lineTime' : 0.0001} # s to receive + parse one line
+
+
+class simSerial():
+    """
+    Subset of serial.Serial used by cheesoSPIM_driver
+    """
+
+    def __init__(self, port = 'SIM', timing = None):
+        self.port = port
+        self.timeout = 1
+        self.is_open = True
+
+        self.timing = dict(simTiming)
+        if timing is not None:
+            self.timing.update(timing)
+
+        # Device state, as in sketch
+        self.focusPosition = 800
+        self.laserPower = 128
+        self.motorPosition = 0 # Not in sketch; handy for checking moves
+        self.sequence = []
+        self.sequenceStop = threading.Event()
+
+        self.inBytes = b''
+        self.lineQueue = queue.Queue() # Host -> device lines
+        self.outQueue = queue.Queue() # Device -> host lines
+
+        self.deviceThread = threading.Thread(target = self.deviceLoop, daemon = True)
+        self.deviceThread.start()
+
+        return
+
+    # Host side, serial.Serial API
+
+    def write(self, data):
+        self.inBytes += data
+        while b'\n' in self.inBytes:
+            line, self.inBytes = self.inBytes.split(b'\n', 1)
+            self.lineQueue.put(line.decode('utf8').strip('\r'))
+        return len(data)
+
+    def readline(self):
+        try:
+            return self.outQueue.get(timeout = self.timeout)
+        except queue.Empty:
+            return b''
+
+    @property
+    def in_waiting(self):
+        return self.outQueue.qsize()
+
+    def reset_input_buffer(self):
+        while not self.outQueue.empty():
+            try:
+                self.outQueue.get_nowait()
+            except queue.Empty:
+                break
+        return
+
+    def reset_output_buffer(self):
+        return
+
+    def flushInput(self):
+        self.reset_input_buffer()
+        return
+
+    def close(self):
+        self.is_open = False
+        self.sequenceStop.set()
+        self.lineQueue.put(None)
+        return
+
+    # Device side
+
+    def println(self, value):
+        self.outQueue.put('{}\r\n'.format(value).encode('utf8'))
+        return
+
+    def deviceLoop(self):
+        """
+        Handle one line at a time, as sketch loop() does
+        """
+        while True:
+            line = self.lineQueue.get()
+            if line is None:
+                break
+
+            time.sleep(self.timing['lineTime'])
+
+            for cmd in line.split(';'):
+                self.runTokenCommand(cmd.strip(' '))
+
+        return
+
+    def runTokenCommand(self, cmd):
+        if cmd.startswith('!'):
+            token, _, rest = cmd[1:].partition(' ')
+            self.runCommand(rest.strip(' '))
+            self.println('!{}'.format(int(token)))
+        elif len(cmd) > 0:
+            self.runCommand(cmd)
+        return
+
+    def parseValue(self, cmd):
+        """
+        Signed integer after command character, as serialInputToLong()
+        """
+        digits = ''.join(c for c in cmd[2:] if c.isdigit())
+        value = int(digits) if digits else 0
+        return -value if '-' in cmd[2:] else value
+
+    def moveLens(self, value):
+        self.focusPosition = value if value >= 0 else 65535 + value
+        time.sleep(4 * self.timing['lensByteDelay'])
+        return
+
+    def moveMotor(self, steps):
+        self.motorPosition += steps
+        time.sleep(abs(steps) * self.timing['stepTime'])
+        return
+
+    def runCommand(self, cmd):
+        c = cmd[:1]
+
+        if c == 'D':
+            self.println('loop')
+            self.println('Demo lens')
+            time.sleep(3)
+            self.println('demo motors')
+            time.sleep(2)
+        elif c in ('E', 'Q'):
+            self.moveLens(self.focusPosition)
+        elif c == 'F':
+            self.moveLens(self.parseValue(cmd))
+        elif c in ('N', 'O'):
+            pass
+        elif c == 'I':
+            self.laserPower = min(self.laserPower + 1, 255)
+        elif c == 'K':
+            self.laserPower = max(self.laserPower - 1, 0)
+        elif c in ('V', 'B'):
+            time.sleep(self.timing['lensEndTime'])
+        elif c == 'P':
+            self.laserPower = self.parseValue(cmd) % 256
+        elif c == 'L':
+            self.moveMotor(1)
+        elif c == 'R':
+            self.moveMotor(-1)
+        elif c == 'M':
+            self.moveMotor(self.parseValue(cmd))
+        elif c == 'Y':
+            self.println('cheesoSPIM')
+        elif c == '?':
+            if cmd[2:3] == 'L':
+                self.println(self.laserPower)
+            elif cmd[2:3] == 'F':
+                self.println(self.focusPosition)
+        elif c == 'S':
+            self.sequenceCommand(cmd)
+        else:
+            self.println('15')
+
+        return
+
+    def sequenceCommand(self, cmd):
+        sub = cmd[2:3]
+
+        if sub == 'C':
+            self.sequence = []
+        elif sub == 'A':
+            values = [int(v) for v in cmd[3:].split()]
+            if (len(values) == 4) and (len(self.sequence) < 64):
+                self.sequence.append(values)
+            else:
+                self.println('15')
+        elif sub == 'R':
+            self.sequenceStop.clear()
+            threading.Thread(target = self.runSequence, daemon = True).start()
+        elif sub == 'X':
+            self.sequenceStop.set()
+        elif sub == 'N':
+            self.println(len(self.sequence))
+        else:
+            self.println('15')
+
+        return
+
+    def runSequence(self):
+        """
+        Sequence runs alongside command handling, as in sketch
+        """
+        for index, (focusMove, motorSteps, laserSet, dwell) in enumerate(self.sequence):
+            if self.sequenceStop.is_set():
+                break
+
+            if motorSteps != 0:
+                self.moveMotor(motorSteps)
+            if focusMove != 0:
+                self.moveLens(focusMove)
+            if laserSet >= 0:
+                self.laserPower = laserSet
+
+            self.println('T {}'.format(index))
+            self.sequenceStop.wait(dwell / 1000)
+
+        self.println('T E')
+
+        return
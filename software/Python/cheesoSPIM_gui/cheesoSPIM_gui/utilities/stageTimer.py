@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+"""
+Per-stage timing for the acquisition hot path
+
+Each frame is timed through the stages it passes:
+    - 'capture' : camera read() + copy into frameBuffer
+    - 'dequeue' : wait in camera frameQueue, from end of capture to routing
+    - 'filter' : hot pixel median filter (display + writer)
+    - 'display' : frame to Tk image (convert, resize, PhotoImage)
+    - 'write' : encode + write to disk, in writer process
+
+Timestamps are time.monotonic(), so events from the writer process
+line up with those from the GUI process (same clock on one machine).
+
+Durations go into a rolling window per stage for live stats + histograms.
+Every event also goes into a bounded trace that can be exported as CSV or JSON.
+
+@author: rusty
+"""
+
+import collections
+import json
+import pathlib
+import threading
+import time
+
+import numpy as np
+
+
+stageNames = ('capture', 'dequeue', 'filter', 'display', 'write')
+
+# Histogram bin edges, ms. Log spaced 0.01 ms - 10 s.
+histogramBins = np.logspace(-2, 4, 25)
+
+
+class stageTimer():
+    """
+    Collect (seq, stage, start, end) timing events
+
+    Safe to call record() from camera, routing and GUI threads at once.
+    """
+
+    def __init__(self, window = 500, traceLength = 100000):
+        """
+        Arguments:
+            - window = int, most recent events per stage used for stats
+            - traceLength = int, most recent events kept for export
+        """
+        self.window = int(window)
+        self.lock = threading.Lock()
+
+        self.durations = {s : collections.deque(maxlen = self.window) for s in stageNames}
+        self.endTimes = {s : collections.deque(maxlen = self.window) for s in stageNames}
+        self.trace = collections.deque(maxlen = int(traceLength))
+        self.captureEnd = collections.OrderedDict() # seq : end of capture, for dequeue stage
+
+        return
+
+    def reset(self):
+        """
+        Clear stats + trace
+        """
+        with self.lock:
+            for s in stageNames:
+                self.durations[s].clear()
+                self.endTimes[s].clear()
+            self.trace.clear()
+            self.captureEnd.clear()
+
+        return
+
+    def record(self, stage, seq, start, end = None):
+        """
+        Add one timing event
+
+        Arguments:
+            - stage = str, one of stageNames
+            - seq = int, frame sequence number (None if not known)
+            - start = float, time.monotonic() at start of stage
+            - end = float, time.monotonic() at end. Now if None.
+        """
+        if end is None:
+            end = time.monotonic()
+
+        with self.lock:
+            self.durations[stage].append(end - start)
+            self.endTimes[stage].append(end)
+            self.trace.append((seq, stage, start, end))
+
+            if stage == 'capture':
+                self.captureEnd[seq] = end
+                if len(self.captureEnd) > 4 * self.window:
+                    self.captureEnd.popitem(last = False)
+
+        return
+
+    def dequeued(self, seq):
+        """
+        Record 'dequeue' stage for frame seq, ending now
+        """
+        end = time.monotonic()
+
+        with self.lock:
+            start = self.captureEnd.pop(seq, None)
+
+        if start is not None:
+            self.record('dequeue', seq, start, end)
+
+        return
+
+    def merge(self, events):
+        """
+        Add list of (seq, stage, start, end) events, eg from writer process
+        """
+        for seq, stage, start, end in events:
+            self.record(stage, seq, start, end)
+
+        return
+
+    def histogram(self, stage):
+        """
+        Counts of recent durations of stage in histogramBins (ms)
+        Returns (counts, bin edges)
+        """
+        with self.lock:
+            ms = np.array(self.durations[stage]) * 1000
+
+        return np.histogram(ms, bins = histogramBins)
+
+    def summary(self):
+        """
+        Rolling stats per stage, over last window events
+        Returns dict of stage : dict w/ n, rate (events/s) + mean, p50, p99, max (ms)
+        Stages with no events are left out
+        """
+        stats = {}
+
+        with self.lock:
+            for s in stageNames:
+                if len(self.durations[s]) == 0:
+                    continue
+
+                ms = np.array(self.durations[s]) * 1000
+                ends = self.endTimes[s]
+                span = ends[-1] - ends[0]
+
+                stats[s] = {'n' : len(ms),
+                            'rate' : (len(ends) - 1) / span if span > 0 else 0.0,
+                            'mean' : float(ms.mean()),
+                            'p50' : float(np.percentile(ms, 50)),
+                            'p99' : float(np.percentile(ms, 99)),
+                            'max' : float(ms.max())}
+
+        return stats
+
+    def overlayText(self):
+        """
+        Summary as fixed-width text, one line per stage
+        """
+        lines = ['{:8s} {:>6s} {:>7s} {:>7s} {:>7s}'.format('stage', 'Hz', 'p50 ms', 'p99 ms', 'max ms')]
+
+        for s, v in self.summary().items():
+            lines.append('{:8s} {:6.1f} {:7.2f} {:7.2f} {:7.2f}'.format(s, v['rate'], v['p50'], v['p99'], v['max']))
+
+        return '\n'.join(lines)
+
+    def exportTrace(self, fileName):
+        """
+        Write trace to fileName
+        .json gets events + summary + histograms; anything else is CSV of events
+        """
+        fileName = pathlib.Path(fileName)
+
+        with self.lock:
+            events = list(self.trace)
+
+        if fileName.suffix.lower() == '.json':
+            out = {'events' : [{'seq' : seq, 'stage' : stage, 'start' : start, 'end' : end}
+                               for seq, stage, start, end in events],
+                   'summary' : self.summary(),
+                   'histogramBinsMs' : histogramBins.tolist(),
+                   'histograms' : {s : self.histogram(s)[0].tolist() for s in stageNames}}
+
+            with open(fileName, 'w') as f:
+                json.dump(out, f, indent = 1)
+        else:
+            with open(fileName, 'w') as f:
+                f.write('seq,stage,start,end,durationMs\n')
+                for seq, stage, start, end in events:
+                    f.write('{},{},{:.6f},{:.6f},{:.3f}\n'.format('' if seq is None else seq,
+                                                                 stage, start, end,
+                                                                 (end - start) * 1000))
+
+        return fileName
@@ -0,0 +1,291 @@
+# -*- coding: utf-8 -*-
+"""
+Scripted Z-stack / angle-sweep acquisition
+
+Steps the cheesoSPIM through a sweep of rotation angles and excitation
+lens positions. At each position: move, wait for settle, grab N frames
+from the camera, tag them with stage state and hand them to a writer
+thread. Writer runs while the next move happens, so disk I/O overlaps
+motion.
+
+Sweep definition is a dict, see sweepDefaults. Positions are in the
+same units the GUI uses: motor steps for rotation, lens counts for focus.
+Both axes are relative on the hardware, so positions are tracked here
+from startPositions. Moves for a position go out as one acknowledged
+batch, so settleTime only needs to cover mechanical settling.
+
+@author: rusty
+"""
+
+import queue
+import threading
+import time
+
+import numpy as np
+from cv2 import medianBlur
+
+from cheesoSPIM_gui.utilities.frameWriters import writerBackends
+from cheesoSPIM_gui.utilities.frameAccumulator import frameAccumulator
+
+
+sweepDefaults = {'focusStart' : 0, # lens position of first plane
+                 'focusStop' : 0, # lens position of last plane (inclusive)
+                 'focusStep' : 10, # lens counts between planes
+                 'angles' : [0], # rotation positions, motor steps
+                 'framesPerPosition' : 1, # frames grabbed at each (angle, z)
+                 'accumulate' : None, # None to write every frame, or 'sum', 'mean', 'median' 
+                                      # to write one composite per position
+                 'settleTime' : 0.2, # seconds to wait after a move
+                 'format' : 'zarr', # key in frameWriters.writerBackends
+                 'medianFilterSize' : 3, # pixels, odd. 0 or 1 for no filter. Unused if a preprocessor is given.
+                 'frameRate' : 1.0} # playback rate written to 'avi' stacks
+
+
+def checkSweep(sweep):
+    """
+    Raise ValueError for a sweep dict (overrides for sweepDefaults) that 
+    would lose frames: several frames per position, not accumulated, 
+    into a format that keeps one frame per position ('zarr')
+    """
+    sweep = dict(sweepDefaults, **sweep)
+
+    if (sweep['framesPerPosition'] > 1) and (sweep['accumulate'] is None) \
+        and not(writerBackends[sweep['format']].streams):
+        raise ValueError("{} frames per position need 'accumulate' set for {} format, "
+                         "which keeps one frame per position".format(sweep['framesPerPosition'], sweep['format']))
+
+    return
+
+
+class sweepAcquisition():
+    """
+    Run one sweep on a scope + camera pair
+
+    scope is cheesoSPIM_driver, camera is cv2Camera.camera (or same interface)
+    Camera must not be streaming while the sweep runs.
+    """
+
+    def __init__(self, scope, camera, sweep, fileName, startPositions = None, preprocessor = None):
+        """
+        Arguments:
+            - scope = cheesoSPIM_driver
+            - camera = camera object w/ grab() method
+            - sweep = dict, overrides for sweepDefaults
+            - fileName = str or pathlib.Path, output file (extension set by writer)
+            - startPositions = dict w/ 'lensPosition', 'rotationPosition'
+                               of stage before sweep. Both 0 if None.
+            - preprocessor = framePreprocessor whose apply() corrects hot pixels
+                             (map or median, as set up by acquisitionEngine.configurePreprocessor()).
+                             None for a median filter of sweep['medianFilterSize'].
+        """
+        self.scope = scope
+        self.camera = camera
+        self.fileName = fileName
+        self.preprocessor = preprocessor
+
+        checkSweep(sweep)
+        self.sweep = dict(sweepDefaults)
+        self.sweep.update(sweep)
+
+        startPositions = startPositions if startPositions is not None else {}
+        self.lensPosition = startPositions.get('lensPosition', 0)
+        self.rotationPosition = startPositions.get('rotationPosition', 0)
+
+        self.positions = self.makePositions()
+        self.nDone = 0 # Positions completed
+        self.isRunning = False
+        self.abortFlag = False
+        self.error = None # Exception that ended the sweep early, from motion, camera or writer
+
+        self.writeQueue = queue.Queue(maxsize = 4) # Positions waiting for writer
+        self.writer = None # Writer backend, open while writer thread runs
+        self.thread = None
+
+        return
+
+    def makePositions(self):
+        """
+        List of (rotation, lens) positions in acquisition order
+        All planes at one angle before moving to next angle
+        """
+        start = self.sweep['focusStart']
+        stop = self.sweep['focusStop']
+        step = abs(self.sweep['focusStep']) if stop >= start else -abs(self.sweep['focusStep'])
+
+        if step == 0:
+            zList = [start]
+        else:
+            zList = list(range(start, stop + (1 if step > 0 else -1), step))
+
+        return [(a, z) for a in self.sweep['angles'] for z in zList]
+
+    def progress(self):
+        """
+        (positions done, total positions)
+        """
+        return self.nDone, len(self.positions)
+
+    def stageState(self):
+        return {'lensPosition' : self.lensPosition,
+                'rotationPosition' : self.rotationPosition}
+
+    def moveTo(self, rotation, lens):
+        """
+        Relative moves on whichever axes need them
+        Sent as one acknowledged batch; returns once the sketch reports
+        every move finished. Tracked positions are only updated then, so 
+        a failed move raises w/ them still at the last confirmed position.
+        """
+        commands = []
+        
+        if rotation != self.rotationPosition:
+            commands.append('M {}'.format(int(rotation - self.rotationPosition)))
+
+        if lens != self.lensPosition:
+            commands.append('F {}'.format(int(lens - self.lensPosition)))
+            
+        if len(commands) == 0:
+            return
+        
+        results = self.scope.sendBatch(commands)
+        if (len(results) != len(commands)) or (None in results):
+            # None is what a driver closed mid-batch leaves
+            raise RuntimeError('Move to rotation {}, lens {} not confirmed : {} of {} commands acknowledged'.format(rotation, lens, 
+                                                                                                                  len([r for r in results if r is not None]), 
+                                                                                                                  len(commands)))
+        
+        self.rotationPosition = rotation
+        self.lensPosition = lens
+
+        return
+
+    def start(self):
+        """
+        Run sweep in own thread. Returns immediately.
+        An error ends the thread quietly; it is in self.error.
+        """
+        self.thread = threading.Thread(target = self.runQuietly, daemon = True)
+        self.thread.start()
+        return
+
+    def runQuietly(self):
+        try:
+            self.run()
+        except Exception:
+            pass # Kept in self.error for caller
+        return
+
+    def abort(self):
+        """
+        Stop after current position. Frames already grabbed are still written.
+        """
+        self.abortFlag = True
+        return
+
+    def run(self):
+        """
+        Run full sweep. Blocks until all frames are on disk.
+        An error stops the sweep; frames already grabbed are still
+        written, file is closed and the error is kept in self.error + raised.
+        """
+        self.isRunning = True
+        self.abortFlag = False
+        self.error = None
+
+        writeThread = threading.Thread(target = self.writeFrames, daemon = True)
+        writeThread.start()
+
+        try:
+            for (rotation, lens) in self.positions:
+                if self.abortFlag:
+                    break
+
+                self.moveTo(rotation, lens)
+                time.sleep(self.sweep['settleTime'])
+
+                frames = [self.camera.grab() for k in range(self.sweep['framesPerPosition'])]
+                
+                # Writer thread handles filtering + disk while next move happens
+                self.writeQueue.put(([f for f in frames if f is not None], self.stageState()))
+
+                self.nDone += 1
+        except Exception as e:
+            self.error = e
+            raise
+        finally:
+            self.writeQueue.put(None) # End of sweep
+            writeThread.join()
+            self.isRunning = False
+
+        if self.error is not None:
+            raise self.error # From writer thread
+
+        return
+
+    def writeFrames(self):
+        """
+        Writer thread. Filters and writes frames from writeQueue until None.
+        With 'accumulate' set, each position's frames are combined 
+        and only the composite is written.
+        Writer backend is opened on first frame so size is known.
+        A write error aborts the sweep; queue is still drained so run() can finish.
+        """
+        self.writer = None
+        
+        if self.sweep['accumulate'] is not None:
+            accumulator = frameAccumulator(self.sweep['accumulate'], self.sweep['framesPerPosition'])
+        else:
+            accumulator = None
+
+        while True:
+            item = self.writeQueue.get()
+            if item is None:
+                break
+
+            if self.error is not None:
+                continue # Sweep already failed, just drain
+
+            try:
+                self.writePosition(accumulator, *item)
+            except Exception as e:
+                self.error = e
+                self.abortFlag = True
+
+        if self.writer is not None:
+            try:
+                self.writer.close()
+            except Exception as e:
+                self.error = self.error if self.error is not None else e
+            self.writer = None
+
+        return
+
+    def writePosition(self, accumulator, frames, meta):
+        """
+        Filter, combine + write frames of one position
+        Writer is opened on first frame
+        """
+        if self.preprocessor is not None:
+            frames = [self.preprocessor.apply(f) for f in frames] # Same hot pixel correction as streamed frames
+        elif self.sweep['medianFilterSize'] > 1:
+            # OpenCV only does 3 + 5 for 16-bit
+            frames = [medianBlur(f, self.sweep['medianFilterSize'] if f.dtype == np.uint8 else min(self.sweep['medianFilterSize'], 5)) 
+                      for f in frames]
+            
+        if accumulator is not None and len(frames) > 0:
+            accumulator.reset()
+            for f in frames:
+                accumulator.add(f)
+            # float32 composite, or back to frames' own type if format can't store floats
+            floatFrames = writerBackends[self.sweep['format']].floatFrames
+            frames = [accumulator.result(None if floatFrames else frames[0].dtype)]
+            meta = dict(meta, framesCombined = accumulator.count)
+
+        for k, frame in enumerate(frames):
+            if self.writer is None:
+                self.writer = writerBackends[self.sweep['format']](self.fileName,
+                                                                   {'frameRate' : self.sweep['frameRate'],
+                                                                    'size' : (frame.shape[1], frame.shape[0])})
+            self.writer.write(frame, dict(meta, frameAtPosition = k))
+
+        return
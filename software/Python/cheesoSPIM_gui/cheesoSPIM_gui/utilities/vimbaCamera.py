@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+"""
+Camera backend for Allied Vision cameras through Vimba X (vmbpy)
+Install Vimba X w/ python support (vmbpy) before selecting this backend.
+vmbpy is only imported when a camera is opened, so the rest of the
+package runs without it.
+
+Frames are pushed by the SDK: start_streaming() calls frameHandler()
+on the SDK's thread for each frame, which copies it straight from the
+driver's frame buffer into frameBuffer and hands the buffer back to the
+driver w/ queue_frame(). No polling thread and no intermediate copy.
+
+Exposure, gain, binning etc. are GenICam features on the camera
+(ExposureTime in us, Gain in dB, BinningHorizontal, ...). Capabilities
+are worked out from which features the camera has.
+
+@author: rusty
+"""
+
+import contextlib
+import time
+
+from cheesoSPIM_gui.utilities.cameraBase import cameraBase
+
+
+# Pixel formats to try, most bits first -> bit depth of data
+monoFormats = (('Mono16', 16),
+               ('Mono14', 14),
+               ('Mono12', 12),
+               ('Mono10', 10),
+               ('Mono8', 8))
+
+class camera(cameraBase):
+
+    backendName = 'vimba'
+
+    def __init__(self, camSourceID = 0):
+        """
+        camSourceID - int index into cameras found, or str camera ID
+        """
+        import vmbpy # Optional dependency, only needed for this backend
+        self.vmbpy = vmbpy
+
+        super().__init__()
+
+        self.nSdkBuffers = 16 # Frame buffers announced to driver while streaming
+        self.frameTimeout = 2000 # ms, grab() / snap()
+
+        # Keep Vimba + camera open for life of object
+        self.context = contextlib.ExitStack()
+        vmb = self.context.enter_context(vmbpy.VmbSystem.get_instance())
+
+        if isinstance(camSourceID, str):
+            self.cam = vmb.get_camera_by_id(camSourceID)
+        else:
+            cams = vmb.get_all_cameras()
+            if camSourceID >= len(cams):
+                self.context.close()
+                raise RuntimeError('Vimba camera {} not found, {} connected'.format(camSourceID, len(cams)))
+            self.cam = cams[camSourceID]
+        self.context.enter_context(self.cam)
+
+        self.camSource = camSourceID
+        self.camName = self.cam.get_name()
+        self.camID = self.cam.get_id()
+        print('Connected to {} ({})'.format(self.camName, self.camID))
+
+        self.bitDepth = self.configureFormat()
+
+        return
+
+    def configureFormat(self):
+        '''
+        Pick deepest mono pixel format camera has
+        Returns bit depth of frame data
+        '''
+        available = {str(fmt) for fmt in self.cam.get_pixel_formats()}
+
+        for name, depth in monoFormats:
+            if name in available:
+                self.cam.set_pixel_format(getattr(self.vmbpy.PixelFormat, name))
+                return depth
+
+        print('No mono pixel format on camera, using {}'.format(self.cam.get_pixel_format()))
+        return 8
+
+    def feature(self, name):
+        '''
+        GenICam feature, or None if camera doesn't have it
+        '''
+        try:
+            return self.cam.get_feature_by_name(name)
+        except self.vmbpy.VmbFeatureError:
+            return None
+
+    def featureWritable(self, name):
+        feature = self.feature(name)
+        return (feature is not None) and feature.is_writeable()
+
+    def probeCapabilities(self):
+        return {'exposure' : self.featureWritable('ExposureTime'),
+                'autoExposure' : self.featureWritable('ExposureAuto'),
+                'gain' : self.featureWritable('Gain'),
+                'autoGain' : self.featureWritable('GainAuto'),
+                'roi' : self.featureWritable('OffsetX') and self.featureWritable('Width'),
+                'binning' : self.featureWritable('BinningHorizontal'),
+                'bitDepths' : (self.bitDepth,),
+                'hardwareTrigger' : self.featureWritable('TriggerMode') and self.featureWritable('TriggerSource'),
+                'frameTimestamps' : True,
+                'callbackDelivery' : True}
+
+    def featureStep(self, feature, value):
+        '''
+        value rounded down to a step of integer feature + clipped to its range
+        Camera ROI sizes + offsets come in steps (eg multiples of 8)
+        '''
+        lo, hi = feature.get_range()
+        step = max(feature.get_increment(), 1)
+        value = lo + ((int(value) - lo) // step) * step
+
+        return min(max(value, lo), hi)
+
+    def applyParameter(self, name, value):
+        c = self.cam
+
+        try:
+            if name == 'autoExposure':
+                c.ExposureAuto.set('Continuous' if value else 'Off') # On-board autoexposure per frame
+            elif name == 'exposureTime':
+                c.ExposureTime.set(value*1000) # milli to microseconds
+            elif name == 'autoGain':
+                c.GainAuto.set('Continuous' if value else 'Off') # On-board autoGain per frame
+            elif name == 'gainValue':
+                c.Gain.set(value) # Set gain value in dB
+            elif (name == 'binning') and (value >= 1):
+                # Camera supports binning in two directions independently
+                # Set number of pixels to combine into one on the output
+                c.BinningHorizontal.set(value)
+                c.BinningVertical.set(value)
+
+                # Make sure that regardless of binning setting, the full chip is being used
+                # With pixel count change (such as decreasing binning value) you can
+                # get camera that sends part of chip instead of chip w/ pixels binned
+                c.Height.set(int(c.SensorHeight.get()/value))
+                c.Width.set(int(c.SensorWidth.get()/value))
+            elif name == 'roi':
+                # Offsets to 0 first so any width + height is in range
+                c.OffsetX.set(0)
+                c.OffsetY.set(0)
+                if value is None:
+                    c.Width.set(c.WidthMax.get())
+                    c.Height.set(c.HeightMax.get())
+                else:
+                    x, y, w, h = value
+                    c.Width.set(self.featureStep(c.Width, w))
+                    c.Height.set(self.featureStep(c.Height, h))
+                    c.OffsetX.set(self.featureStep(c.OffsetX, x))
+                    c.OffsetY.set(self.featureStep(c.OffsetY, y))
+            else:
+                return False
+        except self.vmbpy.VmbFeatureError as e:
+            print('Camera refused {} = {} : {}'.format(name, value, e))
+            return False
+
+        return True
+
+    def getProperty(self, name):
+        features = {'fps' : ('AcquisitionFrameRate', 1),
+                    'width' : ('Width', 1),
+                    'height' : ('Height', 1),
+                    'exposureTime' : ('ExposureTime', 1/1000), # us -> ms
+                    'gainValue' : ('Gain', 1)}
+
+        if name == 'bitDepth':
+            return self.bitDepth
+        if name not in features:
+            return None
+
+        featureName, scale = features[name]
+        feature = self.feature(featureName)
+        if feature is None:
+            return None
+
+        return feature.get() * scale
+
+    def toArray(self, frame):
+        '''
+        Vimba frame -> numpy view of driver's buffer, (h, w) for mono
+        '''
+        img = frame.as_numpy_ndarray()
+
+        return img[:, :, 0] if img.shape[2] == 1 else img
+
+    def readFrame(self):
+        '''
+        Single frame outside of streaming
+        Returns None on timeout or incomplete frame
+        '''
+        try:
+            frame = self.cam.get_frame(timeout_ms = self.frameTimeout)
+        except self.vmbpy.VmbTimeout:
+            return None
+
+        if frame.get_status() != self.vmbpy.FrameStatus.Complete:
+            return None
+
+        return self.toArray(frame)
+
+    def frameHandler(self, cam, stream, frame):
+        '''
+        Called by SDK thread for each streamed frame
+        '''
+        if frame.get_status() == self.vmbpy.FrameStatus.Complete:
+            t0 = time.monotonic()
+            seq = self.storeFrame(self.shapeFrame(self.toArray(frame)), t0) # Only copy: driver buffer -> frameBuffer
+
+            if self.timer is not None:
+                self.timer.record('capture', seq, t0)
+
+        cam.queue_frame(frame) # Buffer back to driver
+
+        return
+
+    def startAcquisition(self):
+        self.cam.start_streaming(handler = self.frameHandler, buffer_count = self.nSdkBuffers)
+        return
+
+    def stopAcquisition(self):
+        self.cam.stop_streaming() # Returns after last frameHandler call
+        return
+
+    def closeSource(self):
+        self.context.close()
+        return
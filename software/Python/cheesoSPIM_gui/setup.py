@@ -9,6 +9,7 @@ setup(name='cheesoSPIM_gui',
       author_email='rusty@cajalneuro.com',
       packages = ['cheesoSPIM_gui', 'cheesoSPIM_gui.gui', 'cheesoSPIM_gui.utilities'],
       include_package_data=True,
+      entry_points={'console_scripts' : ['cheesospim-run = cheesoSPIM_gui.batchRun:main']},
       install_requires=[])
 	  
 # ^ incomplete list of required packages.
\ No newline at end of file
@@ -0,0 +1,11 @@
+# -*- coding: utf-8 -*-
+"""
+pytest setup: make cheesoSPIM_gui importable w/o installing it
+
+@author: rusty
+"""
+
+import pathlib
+import sys
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
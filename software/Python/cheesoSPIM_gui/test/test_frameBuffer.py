@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+"""
+frameRingBuffer overwrite detection + boundedFrameQueue accounting
+
+@author: rusty
+"""
+
+import numpy as np
+import pytest
+
+from cheesoSPIM_gui.utilities.frameBuffer import frameRingBuffer, boundedFrameQueue
+
+
+@pytest.fixture
+def ring():
+    buffer = frameRingBuffer((4, 6), dtype = 'uint16', nSlots = 8)
+    yield buffer
+    buffer.close()
+
+
+def frame(k):
+    return np.full((4, 6), k, dtype = np.uint16)
+
+
+def test_read_returns_frame_by_seq(ring):
+    seqs = [ring.put(frame(k)) for k in range(5)]
+
+    assert seqs == [0, 1, 2, 3, 4]
+    for k in seqs:
+        assert np.array_equal(ring.read(k), frame(k))
+
+
+def test_overwritten_frame_reads_none(ring):
+    for k in range(ring.nSlots + 3):
+        ring.put(frame(k))
+
+    # First 3 slots now hold frames nSlots..nSlots+2
+    for k in range(3):
+        assert ring.read(k) is None
+        assert ring.read(k, copy = False) is None
+    assert np.array_equal(ring.read(ring.nSlots), frame(ring.nSlots))
+    assert np.array_equal(ring.read(3), frame(3)) # Oldest still in ring
+
+
+def test_unwritten_and_reserved_frames_read_none(ring):
+    assert ring.read(0) is None # Not written yet
+
+    ring.put(frame(0))
+    slot = ring.reserve(ring.nSlots) # Camera starts overwriting slot of frame 0
+    assert ring.read(0) is None
+    assert ring.read(ring.nSlots) is None # Not published yet
+
+    slot[...] = frame(7)
+    ring.publish(ring.nSlots)
+    assert np.array_equal(ring.read(ring.nSlots), frame(7))
+
+
+def test_attached_buffer_sees_owner_frames(ring):
+    other = frameRingBuffer.attach(ring.description())
+    try:
+        seq = ring.put(frame(3))
+        assert np.array_equal(other.read(seq), frame(3))
+        for k in range(ring.nSlots):
+            ring.put(frame(k))
+        assert other.read(seq) is None
+    finally:
+        other.close()
+
+
+def test_queue_drop_oldest_counts():
+    frameQueue = boundedFrameQueue(maxsize = 2, policy = 'dropOldest')
+    for k in range(5):
+        frameQueue.put(k)
+
+    assert frameQueue.get_nowait() == 3 # Oldest dropped
+    counts = frameQueue.counts()
+    assert counts['acquired'] == 5
+    assert counts['dropped'] == 3
+    assert counts['acquired'] == counts['delivered'] + counts['dropped'] + counts['queued']
@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+"""
+'segments' recording: flush on first frame, crash recovery + resume
+
+Crashes are faked by closing the writer's files w/o writer.close(), so
+segment headers + manifest are only as fresh as the last flush.
+
+@author: rusty
+"""
+
+import json
+
+import numpy as np
+import pytest
+
+from cheesoSPIM_gui.utilities.frameBuffer import frameRecord
+from cheesoSPIM_gui.utilities.frameWriters import segmentedWriter, recoverSegments, readSegments
+
+
+frameShape = (4, 6)
+
+
+def frame(k):
+    return np.full(frameShape, k, dtype = np.uint16)
+
+
+def newWriter(path, resume = False):
+    return segmentedWriter(path / 'run', {'segmentFrames' : 4,
+                                          'flushInterval' : 1000, # Only flush on first frame + full segments
+                                          'frameRate' : 10.0,
+                                          'resume' : resume})
+
+
+def writeFrames(writer, start, stop):
+    for k in range(start, stop):
+        writer.write(frame(k), frameRecord(k, k / 10).meta())
+    return
+
+
+def crash(writer, partialBytes = 0, partialRow = False):
+    '''
+    Abandon writer as if its process died, optionally mid-frame / mid-row
+    '''
+    if writer.segment is not None:
+        writer.segment.write(b'\x01' * partialBytes)
+        writer.segment.close()
+    if partialRow:
+        writer.metaFile.write('99,9')
+    writer.metaFile.close()
+    return
+
+
+def readAll(path):
+    return np.concatenate(readSegments(path))
+
+
+def indexRows(path):
+    with open(path / segmentedWriter.indexName) as f:
+        return f.read().splitlines()[1:]
+
+
+def test_manifest_and_segment_valid_after_first_frame(tmp_path):
+    writer = newWriter(tmp_path)
+    writeFrames(writer, 0, 1)
+
+    with open(writer.fileName / segmentedWriter.manifestName) as f:
+        manifest = json.load(f)
+    assert manifest['frames'] == 1
+    assert manifest['frameShape'] == list(frameShape)
+    assert np.array_equal(np.load(writer.fileName / 'segment_00000.npy'), frame(0)[None])
+
+    writer.close()
+
+
+def test_complete_recording(tmp_path):
+    writer = newWriter(tmp_path)
+    writeFrames(writer, 0, 10)
+    writer.close()
+
+    data = readAll(writer.fileName)
+    assert data.shape == (10,) + frameShape
+    assert np.array_equal(data[:, 0, 0], np.arange(10))
+
+    manifest = recoverSegments(writer.fileName) # No-op on a closed recording
+    assert manifest['frames'] == 10
+    assert manifest['complete']
+
+
+def test_recover_truncated_segment(tmp_path):
+    writer = newWriter(tmp_path)
+    writeFrames(writer, 0, 7) # Last flush at frame 4, frames 4-6 unflushed
+    crash(writer, partialBytes = 10, partialRow = True)
+
+    manifest = recoverSegments(writer.fileName)
+
+    assert manifest['frames'] == 7 # Whole frames past last flush kept, partial one cut
+    assert [seg['frames'] for seg in manifest['segments']] == [4, 3]
+    assert not(manifest['complete'])
+    assert np.array_equal(readAll(writer.fileName)[:, 0, 0], np.arange(7))
+    assert len(indexRows(writer.fileName)) == 7 # Half written row dropped
+
+
+def test_recover_without_manifest(tmp_path):
+    writer = newWriter(tmp_path)
+    writeFrames(writer, 0, 6)
+    crash(writer)
+    (writer.fileName / segmentedWriter.manifestName).unlink()
+
+    manifest = recoverSegments(writer.fileName)
+
+    assert manifest['frames'] == 6
+    assert manifest['frameShape'] == list(frameShape)
+    assert manifest['dtype'] == np.dtype(np.uint16).str
+    assert np.array_equal(readAll(writer.fileName)[:, 0, 0], np.arange(6))
+
+
+def test_recover_empty_recording_raises(tmp_path):
+    (tmp_path / 'empty.seg').mkdir()
+    with pytest.raises(ValueError):
+        recoverSegments(tmp_path / 'empty.seg')
+
+
+def test_resume_appends_without_touching_segments(tmp_path):
+    writer = newWriter(tmp_path)
+    writeFrames(writer, 0, 6)
+    crash(writer, partialBytes = 5)
+    firstSegment = (writer.fileName / 'segment_00000.npy').read_bytes()
+
+    writer = newWriter(tmp_path, resume = True)
+    writeFrames(writer, 6, 11)
+    writer.close()
+
+    assert (writer.fileName / 'segment_00000.npy').read_bytes() == firstSegment
+    assert np.array_equal(readAll(writer.fileName)[:, 0, 0], np.arange(11))
+    assert [int(row.split(',')[0]) for row in indexRows(writer.fileName)] == list(range(11)) # 'frame' column carries on
+
+
+def test_resume_without_manifest(tmp_path):
+    writer = newWriter(tmp_path)
+    writeFrames(writer, 0, 3)
+    crash(writer)
+    (writer.fileName / segmentedWriter.manifestName).unlink()
+
+    writer = newWriter(tmp_path, resume = True)
+    writeFrames(writer, 3, 5)
+    writer.close()
+
+    assert np.array_equal(readAll(writer.fileName)[:, 0, 0], np.arange(5))
+
+
+def test_new_recording_over_existing_raises(tmp_path):
+    writer = newWriter(tmp_path)
+    writeFrames(writer, 0, 2)
+    writer.close()
+
+    with pytest.raises(FileExistsError):
+        newWriter(tmp_path)
+    assert readAll(writer.fileName).shape[0] == 2
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+"""
+sweepAcquisition w/ a stand-in scope + camera: accumulated composites
+written to integer-only and float-capable formats, failed moves
+
+@author: rusty
+"""
+
+import numpy as np
+import pytest
+
+from cheesoSPIM_gui.utilities.sweepAcquisition import sweepAcquisition
+
+
+class fakeScope():
+    def __init__(self, failBatch = None):
+        self.batches = []
+        self.failBatch = failBatch # Index of batch that isn't acknowledged
+
+    def sendBatch(self, commands):
+        self.batches.append(commands)
+        if len(self.batches) - 1 == self.failBatch:
+            return [None] * len(commands) # As left by a driver closed mid-batch
+        return [0] * len(commands)
+
+
+class fakeCamera():
+    def __init__(self, dtype):
+        self.dtype = dtype
+        self.n = 0
+
+    def grab(self):
+        self.n += 1
+        return np.full((32, 48), 1000 + self.n, dtype = self.dtype) if self.dtype == np.uint16 \
+            else np.full((32, 48), self.n % 200, dtype = self.dtype)
+
+
+def runSweep(tmp_path, sweep, dtype = np.uint16):
+    sweep = dict({'focusStop' : 20, 'focusStep' : 10, 'framesPerPosition' : 3,
+                  'settleTime' : 0, 'medianFilterSize' : 1}, **sweep)
+    acquisition = sweepAcquisition(fakeScope(), fakeCamera(dtype), sweep, tmp_path / 'sweep')
+    acquisition.start()
+    acquisition.thread.join(timeout = 30)
+    assert acquisition.error is None
+    assert not(acquisition.isRunning)
+    return acquisition
+
+
+@pytest.mark.parametrize('mode', ['sum', 'mean', 'median'])
+def test_accumulated_sweep_to_avi(tmp_path, mode):
+    cv2 = pytest.importorskip('cv2')
+
+    runSweep(tmp_path, {'accumulate' : mode, 'format' : 'avi'})
+
+    video = cv2.VideoCapture(str(tmp_path / 'sweep.avi'))
+    nFrames = 0
+    while video.read()[0]:
+        nFrames += 1
+    video.release()
+    assert nFrames == 3 # One composite per position
+
+
+def test_accumulated_sweep_to_raw_keeps_float(tmp_path):
+    runSweep(tmp_path, {'accumulate' : 'mean', 'format' : 'raw'})
+
+    data = np.load(tmp_path / 'sweep.npy')
+    assert data.dtype == np.float32
+    assert data.shape == (3, 32, 48)
+    assert np.allclose(data[:, 0, 0], [1002, 1005, 1008]) # Mean of 3 grabs per position
+
+
+def test_unconfirmed_move_stops_sweep_at_last_position(tmp_path):
+    sweep = dict({'focusStop' : 20, 'focusStep' : 10, 'settleTime' : 0, 
+                  'medianFilterSize' : 1, 'format' : 'raw'})
+    acquisition = sweepAcquisition(fakeScope(failBatch = 1), fakeCamera(np.uint16), sweep, tmp_path / 'sweep')
+    acquisition.start()
+    acquisition.thread.join(timeout = 30)
+
+    assert isinstance(acquisition.error, RuntimeError)
+    assert acquisition.nDone == 2 # Lens 0 + 10; move to 20 failed
+    assert acquisition.lensPosition == 10 # Last confirmed